@@ -0,0 +1,275 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2011 Ivan Vladimirov Ivanov (ivan.vladimirov.ivanov@gmail.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+This module implements the assembler for the Hack platform described in
+chapter 6 of the book "The Elements of Computing Systems: Building a Modern
+Computer from First Principles" (http://www1.idc.ac.il/tecs/).
+"""
+
+
+__author__ = "Ivan Vladimirov Ivanov (ivan.vladimirov.ivanov@gmail.com)"
+
+
+import array
+import os
+import sys
+
+
+# The number of words in the instruction memory of the Hack computer.
+ROM_WORDS = 32768
+
+
+class AssemblerError(Exception):
+  def __init__(self, message):
+    Exception.__init__(self, message)
+    self.message = message
+
+
+class HackAssembler(object):
+  """This class translates Hack assembly into Hack machine code.
+
+  The translation makes two passes over the instructions. The first pass
+  strips comments and label declarations, records the address of every
+  label and encodes every instruction that does not refer to a symbol. The
+  second pass resolves the remaining symbols, allocating a RAM address for
+  every symbol that is not a label.
+  """
+
+  _PREDEFINED_SYMBOLS = dict(
+      [("SP", 0), ("LCL", 1), ("ARG", 2), ("THIS", 3), ("THAT", 4),
+       ("SCREEN", 16384), ("KBD", 24576)] +
+      [("R%d" % (register,), register) for register in range(16)])
+
+  # The RAM address of the first variable.
+  _FIRST_VARIABLE_ADDRESS = 16
+
+  # The largest constant an A-instruction can load.
+  _MAX_CONSTANT = 32767
+
+  # Mapping from computations to their a-bit and c-bits.
+  _COMP_CODES = {
+      "0": 0x2A,
+      "1": 0x3F,
+      "-1": 0x3A,
+      "D": 0x0C,
+      "A": 0x30,
+      "!D": 0x0D,
+      "!A": 0x31,
+      "-D": 0x0F,
+      "-A": 0x33,
+      "D+1": 0x1F,
+      "A+1": 0x37,
+      "D-1": 0x0E,
+      "A-1": 0x32,
+      "D+A": 0x02,
+      "A+D": 0x02,
+      "D-A": 0x13,
+      "A-D": 0x07,
+      "D&A": 0x00,
+      "A&D": 0x00,
+      "D|A": 0x15,
+      "A|D": 0x15,
+      "M": 0x70,
+      "!M": 0x71,
+      "-M": 0x73,
+      "M+1": 0x77,
+      "M-1": 0x72,
+      "D+M": 0x42,
+      "M+D": 0x42,
+      "D-M": 0x53,
+      "M-D": 0x47,
+      "D&M": 0x40,
+      "M&D": 0x40,
+      "D|M": 0x55,
+      "M|D": 0x55
+  }
+
+  # Mapping from destination registers to their d-bits.
+  _DEST_BITS = {"A": 4, "D": 2, "M": 1}
+
+  _JUMP_CODES = {
+      "": 0,
+      "JGT": 1,
+      "JEQ": 2,
+      "JGE": 3,
+      "JLT": 4,
+      "JNE": 5,
+      "JLE": 6,
+      "JMP": 7
+  }
+
+  @staticmethod
+  def Assemble(program_asm):
+    """Translates Hack assembly into Hack machine code.
+
+    Args:
+      program_asm: An iterable of Hack assembly strings.
+
+    Returns:
+      A (words, symbols) tuple, where words is a list with one 16 bit
+      integer per instruction and symbols is a dict mapping every label and
+      variable to its address.
+
+    Raises:
+      AssemblerError: If an instruction is invalid or the program does not
+          fit into the ROM.
+    """
+    instructions, labels = HackAssembler.ParseInstructions(program_asm)
+    return HackAssembler.ResolveSymbols(instructions, labels)
+
+  @staticmethod
+  def ParseInstructions(program_asm):
+    """Makes the first pass over Hack assembly.
+
+    Args:
+      program_asm: An iterable of Hack assembly strings.
+
+    Returns:
+      An (instructions, labels) tuple. instructions is a list with one
+      element per instruction: either its 16 bit encoding or, for an
+      A-instruction referring to a symbol, the name of the symbol. labels is
+      a dict mapping every label to its ROM address.
+
+    Raises:
+      AssemblerError: If an instruction is invalid or a label is declared
+          more than once.
+    """
+    instructions = []
+    labels = {}
+    errors = []
+    # Generated code repeats a few instructions over and over, so every
+    # distinct line is only encoded once.
+    encodings = {}
+    for line_number, line in enumerate(program_asm):
+      encoded = encodings.get(line)
+      if encoded is not None:
+        instructions.append(encoded)
+        continue
+      instruction = line.split("//", 1)[0].strip()
+      if not instruction:
+        continue
+      if instruction.startswith("("):
+        label = instruction[1:-1]
+        if not instruction.endswith(")") or not label:
+          errors.append("%d: %s" % (line_number + 1, line))
+        elif label in labels:
+          errors.append(
+              "%d: duplicate label %s" % (line_number + 1, label))
+        else:
+          labels[label] = len(instructions)
+        continue
+      encoded = HackAssembler._EncodeInstruction(instruction)
+      if encoded is None:
+        errors.append("%d: %s" % (line_number + 1, line))
+      else:
+        encodings[line] = encoded
+        instructions.append(encoded)
+
+    if len(instructions) > ROM_WORDS:
+      errors.append("the program has %d instructions, but the ROM only %d "
+                    "words" % (len(instructions), ROM_WORDS))
+    if len(errors) > 0:
+      raise AssemblerError("Error: " + os.linesep.join(errors))
+    return (instructions, labels)
+
+  @staticmethod
+  def ResolveSymbols(instructions, labels):
+    """Makes the second pass over Hack assembly.
+
+    Args:
+      instructions: A list of instructions as returned by ParseInstructions.
+      labels: A dict mapping labels to ROM addresses.
+
+    Returns:
+      A (words, symbols) tuple, see Assemble.
+    """
+    symbols = dict(HackAssembler._PREDEFINED_SYMBOLS)
+    symbols.update(labels)
+    next_variable = HackAssembler._FIRST_VARIABLE_ADDRESS
+    words = []
+    for instruction in instructions:
+      if isinstance(instruction, str):
+        address = symbols.get(instruction)
+        if address is None:
+          address = next_variable
+          symbols[instruction] = address
+          next_variable += 1
+        instruction = address
+      words.append(instruction)
+    return (words, symbols)
+
+  @staticmethod
+  def _EncodeInstruction(instruction):
+    # Returns the encoding of an instruction, the symbol of an A-instruction
+    # referring to one or None if the instruction is invalid.
+    if instruction.startswith("@"):
+      value = instruction[1:]
+      if value.isdigit():
+        value = int(value)
+        if value > HackAssembler._MAX_CONSTANT:
+          return None
+        return value
+      if not value or value[0].isdigit():
+        return None
+      return value
+
+    dest, comp, jump = "", instruction, ""
+    if "=" in comp:
+      dest, comp = comp.split("=", 1)
+    if ";" in comp:
+      comp, jump = comp.split(";", 1)
+    comp_code = HackAssembler._COMP_CODES.get(comp.replace(" ", ""))
+    jump_code = HackAssembler._JUMP_CODES.get(jump.strip())
+    if comp_code is None or jump_code is None:
+      return None
+    dest_code = 0
+    for register in dest.strip():
+      bit = HackAssembler._DEST_BITS.get(register)
+      if bit is None or dest_code & bit:
+        return None
+      dest_code |= bit
+    return 0xE000 | (comp_code << 6) | (dest_code << 3) | jump_code
+
+
+def WriteHack(words, hack_file):
+  """Writes machine code in the textual .hack format.
+
+  Args:
+    words: An iterable of 16 bit instruction words.
+    hack_file: A file object opened for writing.
+  """
+  hack_file.write(os.linesep.join(format(word, "016b") for word in words))
+
+
+def WriteImage(words, image_file):
+  """Writes machine code as a raw ROM image of big-endian 16 bit words.
+
+  Args:
+    words: An iterable of 16 bit instruction words.
+    image_file: A file object opened for writing in binary mode.
+  """
+  image = array.array("H", words)
+  if sys.byteorder == "little":
+    image.byteswap()
+  image_file.write(image.tostring())
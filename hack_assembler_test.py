@@ -0,0 +1,96 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2011 Ivan Vladimirov Ivanov (ivan.vladimirov.ivanov@gmail.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Test cases for the hack_assembler module.
+"""
+
+
+__author__ = "Ivan Vladimirov Ivanov (ivan.vladimirov.ivanov@gmail.com)"
+
+
+import StringIO
+import unittest
+
+import hack_assembler
+
+
+class TestHackAssembler(unittest.TestCase):
+
+  def testAssemble(self):
+    words, symbols = hack_assembler.HackAssembler.Assemble([
+        "// Adds R0 and R1.",
+        "@R0",
+        "D=M",
+        "@R1",
+        "D=D+M  // The sum.",
+        "@sum",
+        "M=D",
+        "(END)",
+        "@END",
+        "0;JMP"
+    ])
+    self.assertEqual([
+        0x0000,
+        0xFC10,
+        0x0001,
+        0xF090,
+        0x0010,
+        0xE308,
+        0x0006,
+        0xEA87
+    ], words)
+    self.assertEqual(16, symbols["sum"])
+    self.assertEqual(6, symbols["END"])
+
+  def testAssembleEncodings(self):
+    words, _ = hack_assembler.HackAssembler.Assemble(
+        ["AMD=M+1;JLT", "A=A-1", "M=!M", "D;JNE", "@32767"])
+    self.assertEqual(["1111110111111100", "1110110010100000",
+                      "1111110001001000", "1110001100000101",
+                      "0111111111111111"],
+                     [format(word, "016b") for word in words])
+
+  def testAssembleErrors(self):
+    try:
+      hack_assembler.HackAssembler.Assemble(
+          ["(L)", "(L)", "D=D*A", "@32768", "B=1", "@1x"])
+      self.fail("AssemblerError expected")
+    except hack_assembler.AssemblerError as error:
+      self.assertEqual(5, error.message.count("\n") + 1)
+
+  def testWriteHack(self):
+    hack_file = StringIO.StringIO()
+    hack_assembler.WriteHack([0x0010, 0xEA87], hack_file)
+    self.assertEqual(
+        ["0000000000010000", "1110101010000111"],
+        hack_file.getvalue().splitlines())
+
+  def testWriteImage(self):
+    image_file = StringIO.StringIO()
+    hack_assembler.WriteImage([0x0010, 0xEA87], image_file)
+    self.assertEqual("\x00\x10\xea\x87", image_file.getvalue())
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,483 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2011 Ivan Vladimirov Ivanov (ivan.vladimirov.ivanov@gmail.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+This module implements an emulator of the Hack CPU described in chapter 5 of
+the book "The Elements of Computing Systems: Building a Modern Computer from
+First Principles" (http://www1.idc.ac.il/tecs/).
+
+The emulator executes the machine code produced by the hack_assembler module
+and counts the executed instructions, which makes it possible to compare the
+speed of the code generated by the hack_vm module under different options.
+"""
+
+
+__author__ = "Ivan Vladimirov Ivanov (ivan.vladimirov.ivanov@gmail.com)"
+
+
+import argparse
+import os
+import re
+
+import hack_assembler
+
+
+# The number of words in the data memory of the Hack computer, including the
+# screen and keyboard memory maps.
+RAM_WORDS = 32768
+
+
+class EmulatorError(Exception):
+  def __init__(self, message):
+    Exception.__init__(self, message)
+    self.message = message
+
+
+class HackEmulator(object):
+  """This class executes Hack machine code one instruction at a time.
+
+  Every instruction takes one cycle. The emulator stops when the program
+  halts, which on the Hack computer means entering an infinite loop of the
+  form "(END) @END 0;JMP", when the program counter leaves the program, or
+  when the cycle limit of a run is reached.
+
+  All register and memory values are unsigned 16 bit integers.
+
+  Attributes:
+    rom: The list of instruction words.
+    ram: The list of data memory words.
+    a: The A register.
+    d: The D register.
+    pc: The program counter.
+    cycles: The number of instructions executed so far.
+    peak_sp: The largest value the stack pointer (RAM[0]) has held.
+    halted: Whether the program has halted.
+  """
+
+  # Mapping from the c-bits of a C-instruction to the computation. x is the
+  # D register and y either the A register or M, as selected by the a-bit.
+  _COMPUTATIONS = {
+      0x2A: lambda x, y: 0,
+      0x3F: lambda x, y: 1,
+      0x3A: lambda x, y: 0xFFFF,
+      0x0C: lambda x, y: x,
+      0x30: lambda x, y: y,
+      0x0D: lambda x, y: x ^ 0xFFFF,
+      0x31: lambda x, y: y ^ 0xFFFF,
+      0x0F: lambda x, y: -x & 0xFFFF,
+      0x33: lambda x, y: -y & 0xFFFF,
+      0x1F: lambda x, y: (x + 1) & 0xFFFF,
+      0x37: lambda x, y: (y + 1) & 0xFFFF,
+      0x0E: lambda x, y: (x - 1) & 0xFFFF,
+      0x32: lambda x, y: (y - 1) & 0xFFFF,
+      0x02: lambda x, y: (x + y) & 0xFFFF,
+      0x13: lambda x, y: (x - y) & 0xFFFF,
+      0x07: lambda x, y: (y - x) & 0xFFFF,
+      0x00: lambda x, y: x & y,
+      0x15: lambda x, y: x | y
+  }
+
+  # Mapping from the j-bits of a C-instruction to the jump condition on the
+  # computed value.
+  _JUMPS = [
+      None,
+      lambda value: 0 < value < 0x8000,
+      lambda value: value == 0,
+      lambda value: value < 0x8000,
+      lambda value: value >= 0x8000,
+      lambda value: value != 0,
+      lambda value: value == 0 or value >= 0x8000,
+      lambda value: True
+  ]
+
+  # The encoding of "0;JMP", the unconditional jump of a halt loop.
+  _HALT_JUMP = 0xEA87
+
+  def __init__(self, rom):
+    if len(rom) > hack_assembler.ROM_WORDS:
+      raise EmulatorError("The program does not fit into the ROM.")
+    self.rom = rom
+    self._program = [HackEmulator._DecodeInstruction(word) for word in rom]
+    # Every halt loop, as well as every address past the end of the
+    # program, is marked by None.
+    for address in range(len(rom) - 1):
+      if (rom[address] == address
+          and rom[address + 1] == HackEmulator._HALT_JUMP):
+        self._program[address] = None
+    self._program += [None] * (hack_assembler.ROM_WORDS + 1 - len(rom))
+    self.Reset()
+
+  def Reset(self):
+    """Clears the registers and the data memory."""
+    self.ram = [0] * RAM_WORDS
+    self.a = 0
+    self.d = 0
+    self.pc = 0
+    self.cycles = 0
+    self.peak_sp = 0
+    self.halted = False
+
+  def Run(self, max_cycles=None):
+    """Executes instructions until the program halts.
+
+    Args:
+      max_cycles: An optional limit on the total number of cycles, after
+          which the execution stops even if the program did not halt.
+
+    Returns:
+      True if the program halted, False if the cycle limit was reached.
+    """
+    program = self._program
+    ram = self.ram
+    a, d, pc = self.a, self.d, self.pc
+    cycles = self.cycles
+    peak_sp = self.peak_sp
+    limit = max_cycles if max_cycles is not None else float("inf")
+    try:
+      while cycles < limit:
+        instruction = program[pc]
+        if instruction is None:
+          self.halted = True
+          break
+        cycles += 1
+        if instruction[0]:
+          compute, uses_m, dest_a, dest_d, dest_m, jump = instruction[1:]
+          value = compute(d, ram[a & 0x7FFF] if uses_m else a)
+          if dest_m:
+            ram[a & 0x7FFF] = value
+            if a == 0 and value > peak_sp:
+              peak_sp = value
+          if jump is not None and jump(value):
+            pc = a & 0x7FFF
+          else:
+            pc += 1
+          if dest_a:
+            a = value
+          if dest_d:
+            d = value
+        else:
+          a = instruction[1]
+          pc += 1
+    finally:
+      self.a, self.d, self.pc = a, d, pc
+      self.cycles = cycles
+      self.peak_sp = peak_sp
+    return self.halted
+
+  def Peek(self, address):
+    """Returns the signed value of the data memory word at address."""
+    value = self.ram[address]
+    return value - 0x10000 if value & 0x8000 else value
+
+  @staticmethod
+  def _DecodeInstruction(word):
+    # Returns (False, value) for an A-instruction and (True, compute, uses_m,
+    # dest_a, dest_d, dest_m, jump) for a C-instruction.
+    if not word & 0x8000:
+      return (False, word)
+    control = (word >> 6) & 0x3F
+    compute = HackEmulator._COMPUTATIONS.get(control)
+    if compute is None:
+      compute = HackEmulator._AluComputation(control)
+    return (True, compute, bool(word & 0x1000), bool(word & 0x20),
+            bool(word & 0x10), bool(word & 0x08), HackEmulator._JUMPS[word & 7])
+
+  @staticmethod
+  def _AluComputation(control):
+    # Builds the computation for control bits without a mnemonic by following
+    # the ALU specification: zx, nx, zy, ny, f, no.
+    def Compute(x, y):
+      if control & 0x20:
+        x = 0
+      if control & 0x10:
+        x ^= 0xFFFF
+      if control & 0x08:
+        y = 0
+      if control & 0x04:
+        y ^= 0xFFFF
+      value = (x + y) & 0xFFFF if control & 0x02 else x & y
+      if control & 0x01:
+        value ^= 0xFFFF
+      return value
+    return Compute
+
+
+class HackCompilingEmulator(HackEmulator):
+  """This class executes Hack machine code by compiling it to Python.
+
+  The program is split into basic blocks, each running from its entry
+  address up to and including the next jump. Every block is compiled once,
+  when it is first entered, into a Python function that executes all of its
+  instructions and returns the address of its successor, and is cached by
+  its entry address. Within a block the value of the A register is tracked
+  at compile time, so that memory accesses through constant addresses are
+  plain list accesses and A is only assigned when the block exits.
+
+  Every block adds its number of instructions to the cycles, so the cycle
+  accounting is exactly the one of HackEmulator. When a block would exceed
+  the cycle limit of a run, the remaining cycles are executed one
+  instruction at a time.
+  """
+
+  # Mapping from the c-bits of a C-instruction to a Python expression of the
+  # computation, see HackEmulator._COMPUTATIONS.
+  _EXPRESSIONS = {
+      0x2A: "0",
+      0x3F: "1",
+      0x3A: "65535",
+      0x0C: "%(x)s",
+      0x30: "%(y)s",
+      0x0D: "%(x)s ^ 65535",
+      0x31: "%(y)s ^ 65535",
+      0x0F: "-%(x)s & 65535",
+      0x33: "-%(y)s & 65535",
+      0x1F: "(%(x)s + 1) & 65535",
+      0x37: "(%(y)s + 1) & 65535",
+      0x0E: "(%(x)s - 1) & 65535",
+      0x32: "(%(y)s - 1) & 65535",
+      0x02: "(%(x)s + %(y)s) & 65535",
+      0x13: "(%(x)s - %(y)s) & 65535",
+      0x07: "(%(y)s - %(x)s) & 65535",
+      0x00: "%(x)s & %(y)s",
+      0x15: "%(x)s | %(y)s"
+  }
+
+  # Matches the Python expressions that depend on the state of the machine.
+  _RE_VARIABLE = re.compile("[a-z]")
+
+  # The largest number of instructions compiled into one block.
+  _MAX_BLOCK_LENGTH = 1024
+
+  # Python expressions of the jump conditions on the computed value v.
+  _CONDITIONS = [
+      None,
+      "0 < v < 32768",
+      "v == 0",
+      "v < 32768",
+      "v >= 32768",
+      "v != 0",
+      "v == 0 or v >= 32768",
+      "True"
+  ]
+
+  def Reset(self):
+    HackEmulator.Reset(self)
+    # The compiled (function, length) of the block entered at every address.
+    self._blocks = [None] * len(self._program)
+
+  def Run(self, max_cycles=None):
+    program = self._program
+    blocks = self._blocks
+    ram = self.ram
+    a, d, pc = self.a, self.d, self.pc
+    cycles = self.cycles
+    peak_sp = self.peak_sp
+    limit = max_cycles if max_cycles is not None else float("inf")
+    try:
+      while True:
+        block = blocks[pc]
+        if block is None:
+          if program[pc] is None:
+            self.halted = True
+            break
+          block = self._CompileBlock(pc)
+          blocks[pc] = block
+        function, length = block
+        if cycles + length > limit:
+          break
+        a, d, pc, peak_sp, executed = function(a, d, ram, peak_sp)
+        cycles += executed
+    finally:
+      self.a, self.d, self.pc = a, d, pc
+      self.cycles = cycles
+      self.peak_sp = peak_sp
+    if not self.halted and cycles < limit:
+      return HackEmulator.Run(self, max_cycles)
+    return self.halted
+
+  def _CompileBlock(self, start):
+    # Returns the (function, length) of the block entered at address start.
+    # The block follows the fall-through path of conditional jumps, which
+    # leave the block when taken, and the targets of unconditional jumps to
+    # constant addresses, up to the first address it visits a second time.
+    # The function returns the number of instructions it executed, length
+    # is the largest such number.
+    cls = HackCompilingEmulator
+    lines = ["def Block(a, d, ram, peak):"]
+    namespace = {}
+    # The values of A and D if they are known at compile time; they are only
+    # assigned to the variables a and d when the block exits.
+    known_a = None
+    known_d = None
+    address = start
+    length = 0
+    visited = set()
+    while (self._program[address] is not None and address not in visited
+           and length < cls._MAX_BLOCK_LENGTH):
+      visited.add(address)
+      word = self.rom[address]
+      address += 1
+      length += 1
+      if not word & 0x8000:
+        known_a = word
+        continue
+
+      control = (word >> 6) & 0x3F
+      jump = word & 7
+      writes_m = word & 0x08
+      writes_d = word & 0x10
+      writes_a = word & 0x20
+      old_a = known_a
+      if old_a is not None:
+        a_value, m_address = str(old_a), str(old_a & 0x7FFF)
+      else:
+        a_value, m_address = "a", "a & 32767"
+      operands = {
+          "x": "d" if known_d is None else str(known_d),
+          "y": "ram[%s]" % (m_address,) if word & 0x1000 else a_value
+      }
+      expression = cls._EXPRESSIONS.get(control)
+      if expression is None:
+        namespace["alu%d" % (control,)] = HackEmulator._AluComputation(
+            control)
+        expression = "alu%d(%%(x)s, %%(y)s)" % (control,)
+      value = expression % operands
+      if control in (0x02, 0x13) and operands["y"] == "0":
+        # Adding or subtracting 0 yields x, which is already a 16 bit value.
+        value = operands["x"]
+      constant = not cls._RE_VARIABLE.search(value)
+      if constant:
+        value = str(eval(value, namespace))
+
+      # M is written and the jump target taken through the old value of A.
+      if not (constant or value == "d") and (
+          jump or writes_m or (writes_a and writes_d)):
+        lines.append("  v = " + value)
+        value = "v"
+      if writes_m:
+        lines.append("  ram[%s] = %s" % (m_address, value))
+        if value == "0":
+          pass
+        elif old_a == 0:
+          lines.append("  if %s > peak: peak = %s" % (value, value))
+        elif old_a is None:
+          lines.append(
+              "  if a == 0 and %s > peak: peak = %s" % (value, value))
+      if jump and old_a is None:
+        lines.append("  t = a & 32767")
+      if writes_d:
+        known_d = int(value) if constant else None
+        if not constant and value != "d":
+          lines.append("  d = " + value)
+      if writes_a:
+        known_a = int(value) if constant else None
+        if not constant:
+          lines.append("  a = " + value)
+      if not jump:
+        continue
+
+      condition = cls._CONDITIONS[jump].replace("v", value)
+      if constant and not eval(condition):
+        continue
+      target = "t" if old_a is None else str(old_a & 0x7FFF)
+      exit_line = cls._ExitLine(known_a, known_d, target, length)
+      if constant or jump == 7:
+        if old_a is None:
+          lines.append(exit_line)
+          break
+        address = old_a & 0x7FFF
+      else:
+        lines += ["  if %s:" % (condition,), "  " + exit_line]
+    else:
+      lines.append(cls._ExitLine(known_a, known_d, str(address), length))
+
+    exec compile(os.linesep.join(lines), "<block %d>" % (start,), "exec") in (
+        namespace)
+    return (namespace["Block"], length)
+
+  @staticmethod
+  def _ExitLine(known_a, known_d, target, length):
+    # Returns the line of a block exit to target after length instructions.
+    return "  return (%s, %s, %s, peak, %d)" % (
+        "a" if known_a is None else known_a,
+        "d" if known_d is None else known_d, target, length)
+
+
+def RunAsm(program_asm, max_cycles=None, emulator_type=HackEmulator):
+  """Assembles and executes Hack assembly.
+
+  Args:
+    program_asm: An iterable of Hack assembly strings, e.g. the output of
+        hack_vm.AttachBootstrapCode.
+    max_cycles: An optional limit on the number of cycles.
+    emulator_type: HackEmulator or a subclass like HackCompilingEmulator.
+
+  Returns:
+    A (emulator, symbols) tuple with the HackEmulator after the run and the
+    dict mapping every symbol of the program to its address.
+  """
+  words, symbols = hack_assembler.HackAssembler.Assemble(program_asm)
+  emulator = emulator_type(words)
+  emulator.Run(max_cycles)
+  return (emulator, symbols)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="Executes a Hack assembly program and reports its cycles.")
+  parser.add_argument("path", help="a .asm file")
+  parser.add_argument(
+      "--max-cycles", type=int,
+      help="stop after this many cycles if the program does not halt")
+  parser.add_argument(
+      "--peek", metavar="SYMBOL", action="append", default=[],
+      help="print the RAM word at an address or symbol after the run")
+  parser.add_argument(
+      "--step", action="store_true",
+      help="execute one instruction at a time instead of compiling blocks")
+  arguments = parser.parse_args()
+
+  try:
+    emulator_type = HackCompilingEmulator
+    if arguments.step:
+      emulator_type = HackEmulator
+    with open(arguments.path, "r") as asm_file:
+      emulator, symbols = RunAsm(
+          asm_file, arguments.max_cycles, emulator_type)
+    print "Cycles: %d" % (emulator.cycles,)
+    print "Halted: %s" % (emulator.halted,)
+    print "Peak SP: %d" % (emulator.peak_sp,)
+    for symbol in arguments.peek:
+      address = int(symbol) if symbol.isdigit() else symbols.get(symbol)
+      if address is None:
+        print "%s: unknown symbol" % (symbol,)
+      else:
+        print "%s: %d" % (symbol, emulator.Peek(address))
+  except (hack_assembler.AssemblerError, EmulatorError) as error:
+    print error.message
+  except IOError as error:
+    print error
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,183 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2011 Ivan Vladimirov Ivanov (ivan.vladimirov.ivanov@gmail.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Test cases for the hack_emulator module.
+"""
+
+
+__author__ = "Ivan Vladimirov Ivanov (ivan.vladimirov.ivanov@gmail.com)"
+
+
+import unittest
+
+import hack_assembler
+import hack_emulator
+import hack_vm
+
+
+class TestHackEmulator(unittest.TestCase):
+
+  def testRun(self):
+    words, _ = hack_assembler.HackAssembler.Assemble([
+        "@5",
+        "D=A",
+        "@SP",
+        "M=D",
+        "(LOOP)",
+        "@SP",
+        "MD=M-1",
+        "@LOOP",
+        "D;JGT",
+        "(END)",
+        "@END",
+        "0;JMP"
+    ])
+    emulator = hack_emulator.HackEmulator(words)
+    self.assertFalse(emulator.Run(10))
+    self.assertEqual(10, emulator.cycles)
+    self.assertTrue(emulator.Run())
+    self.assertEqual(4 + 5 * 4, emulator.cycles)
+    self.assertEqual(5, emulator.peak_sp)
+    self.assertEqual(0, emulator.Peek(0))
+    self.assertEqual(8, emulator.pc)
+
+  def testArithmetic(self):
+    emulator, _ = hack_emulator.RunAsm([
+        "@3",
+        "D=-A",
+        "@R1",
+        "M=D",
+        "D=D-1",
+        "@R2",
+        "M=!D",
+        "@R3",
+        "M=D|M",
+        "A=-1",
+        "D=A+1"
+    ])
+    self.assertEqual(-3, emulator.Peek(1))
+    self.assertEqual(3, emulator.Peek(2))
+    self.assertEqual(-4, emulator.Peek(3))
+    self.assertEqual(0, emulator.d)
+    self.assertTrue(emulator.halted)
+
+  def testRunTranslatedProgram(self):
+    program_lines = [
+        "function Main.sum 0",
+        "  push argument 0",
+        "  push argument 1",
+        "  add",
+        "  return",
+        "function Sys.init 0",
+        "  push constant 7",
+        "  push constant 8",
+        "  neg",
+        "  call Main.sum 2",
+        "  pop static 0",
+        "label HALT",
+        "  goto HALT"
+    ]
+    for options in [hack_vm.TranslationOptions(),
+                    hack_vm.TranslationOptions(
+                        stack_caching=True, trampolines=True)]:
+      program_asm = hack_vm.AttachBootstrapCode(
+          hack_vm.LinkPrograms([("Main", program_lines)], options=options),
+          options)
+      emulator, symbols = hack_emulator.RunAsm(program_asm)
+      self.assertTrue(emulator.halted)
+      self.assertEqual(-1, emulator.Peek(symbols["Main.0"]))
+      self.assertEqual(261, emulator.Peek(0))
+
+  def testCompilingEmulatorMatchesEmulator(self):
+    program_lines = [
+        "function Main.sum 1",
+        "  push constant 0",
+        "  pop local 0",
+        "label LOOP",
+        "  push argument 0",
+        "  push constant 0",
+        "  eq",
+        "  if-goto END",
+        "  push local 0",
+        "  push argument 0",
+        "  add",
+        "  pop local 0",
+        "  push argument 0",
+        "  push constant 1",
+        "  sub",
+        "  pop argument 0",
+        "  goto LOOP",
+        "label END",
+        "  push local 0",
+        "  return",
+        "function Sys.init 0",
+        "  push constant 100",
+        "  call Main.sum 1",
+        "  pop static 0",
+        "label HALT",
+        "  goto HALT"
+    ]
+    for options in [hack_vm.TranslationOptions(),
+                    hack_vm.TranslationOptions(
+                        stack_caching=True, shared_comparisons=True),
+                    hack_vm.TranslationOptions(fuse_commands=True)]:
+      words, symbols = hack_assembler.HackAssembler.Assemble(
+          hack_vm.AttachBootstrapCode(
+              hack_vm.LinkPrograms([("Main", program_lines)], options=options),
+              options))
+      for max_cycles in [1, 99, 1000, None]:
+        emulator = hack_emulator.HackEmulator(words)
+        emulator.Run(max_cycles)
+        compiling_emulator = hack_emulator.HackCompilingEmulator(words)
+        compiling_emulator.Run(max_cycles)
+        for attribute in ["a", "d", "pc", "cycles", "peak_sp", "halted",
+                          "ram"]:
+          self.assertEqual(getattr(emulator, attribute),
+                           getattr(compiling_emulator, attribute))
+      self.assertEqual(5050, compiling_emulator.Peek(symbols["Main.0"]))
+
+  def testCompilingEmulatorResumes(self):
+    words, _ = hack_assembler.HackAssembler.Assemble([
+        "@100",
+        "D=A",
+        "(LOOP)",
+        "@R1",
+        "M=M+1",
+        "D=D-1",
+        "@LOOP",
+        "D;JGT",
+        "A=-1",
+        "M=-1"
+    ])
+    emulator = hack_emulator.HackCompilingEmulator(words)
+    cycles = 0
+    while not emulator.Run(cycles):
+      cycles += 7
+    self.assertEqual(2 + 100 * 5 + 2, emulator.cycles)
+    self.assertEqual(100, emulator.Peek(1))
+    self.assertEqual(-1, emulator.Peek(32767))
+
+
+if __name__ == "__main__":
+  unittest.main()
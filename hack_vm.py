@@ -31,97 +31,239 @@ Building a Modern Computer from First Principles"
 
 __author__ = "Ivan Vladimirov Ivanov (ivan.vladimirov.ivanov@gmail.com)"
 
-
+# The version of the translator. It is part of the key of every AssemblyCache
+# entry, so it must change whenever the generated assembly changes.
+__version__ = "1.2"
+
+
+import argparse
+import bisect
+import collections
+import contextlib
+import copy
+import hashlib
+import itertools
+import json
+import multiprocessing
 import os
+import Queue
 import re
+import resource
 import sys
+import threading
+import time
+
+import hack_assembler
+
+
+# The number of assembly instructions buffered before each write to disk.
+_WRITE_BUFFER_LINES = 4096
 
+# The default size limit of an AssemblyCache in bytes.
+_DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
 
-# The following classes model the hack virtual machine commands.
+# The number of words in the instruction memory of the Hack computer.
+_ROM_WORDS = 32768
 
+# The number of programs ReadAhead reads before they are translated.
+_READ_AHEAD_PROGRAMS = 2
 
-class AddCommand(object): pass
 
+# The following classes model the hack virtual machine commands. Command
+# instances are never modified after they are created, so that the parser
+# can share one instance between all lines with the same command. They have
+# no __dict__, which keeps the parsed form of large programs small.
 
-class SubCommand(object): pass
 
+class AddCommand(object):
+  __slots__ = ()
 
-class NegCommand(object): pass
 
+class SubCommand(object):
+  __slots__ = ()
 
-class EqCommand(object): pass
 
+class NegCommand(object):
+  __slots__ = ()
 
-class GtCommand(object): pass
 
+class EqCommand(object):
+  __slots__ = ()
 
-class LtCommand(object): pass
 
+class GtCommand(object):
+  __slots__ = ()
 
-class AndCommand(object): pass
 
+class LtCommand(object):
+  __slots__ = ()
 
-class OrCommand(object): pass
 
+class AndCommand(object):
+  __slots__ = ()
 
-class NotCommand(object): pass
+
+class OrCommand(object):
+  __slots__ = ()
+
+
+class NotCommand(object):
+  __slots__ = ()
 
 
 class PushCommand(object):
+  __slots__ = ("segment", "index")
+
   def __init__(self, segment, index):
     self.segment = segment
     self.index = index
 
 
 class PopCommand(object):
+  __slots__ = ("segment", "index")
+
   def __init__(self, segment, index):
     self.segment = segment
     self.index = index
 
 
 class LabelCommand(object):
+  __slots__ = ("label_name",)
+
   def __init__(self, label_name):
     self.label_name = label_name
 
 
 class GotoCommand(object):
+  __slots__ = ("label_name",)
+
   def __init__(self, label_name):
     self.label_name = label_name
 
 
 class IfGotoCommand(object):
+  __slots__ = ("label_name",)
+
   def __init__(self, label_name):
     self.label_name = label_name
 
 
 class FunctionCommand(object):
+  __slots__ = ("function_name", "local_variables")
+
   def __init__(self, function_name, local_variables):
     self.function_name = function_name
     self.local_variables = local_variables
 
 
 class CallCommand(object):
+  __slots__ = ("function_name", "arguments")
+
   def __init__(self, function_name, arguments):
     self.function_name = function_name
     self.arguments = arguments
 
 
-class ReturnCommand(object): pass
+class ReturnCommand(object):
+  __slots__ = ()
+
+
+class EmptyCommand(object):
+  __slots__ = ()
 
 
-class EmptyCommand(object): pass
+class FusedCommand(object):
+  """A sequence of commands translated as one, see HackCommandFuser."""
+  __slots__ = ("fusion_name", "commands")
+
+  def __init__(self, fusion_name, commands):
+    self.fusion_name = fusion_name
+    self.commands = commands
 
 
 class ErrorCommand(object):
+  __slots__ = ("line",)
+
   def __init__(self, line):
     self.line = line
 
 
+def CommandFields(command):
+  """Returns a list of (field_name, value) tuples describing a command."""
+  return [(name, getattr(command, name)) for name in command.__slots__]
+
+
 class VMError(Exception):
   def __init__(self, message):
+    Exception.__init__(self, message)
     self.message = message
 
 
+class TranslationOptions(object):
+  """Settings that control how VM programs are translated to assembly.
+
+  Every setting defaults to the plain translation described in the book.
+
+  Attributes:
+    eliminate_dead_functions: Whether the linker drops the functions that
+        can never be called, starting from Sys.init.
+    fuse_commands: Whether frequent sequences of VM commands are translated
+        as one by the HackCommandFuser.
+    inline_budget: The maximum number of commands of a leaf function whose
+        calls are replaced by its body, or 0 to inline no calls.
+    optimize_commands: Whether the VM commands of every program are
+        rewritten by the HackCommandOptimizer before code generation.
+    stack_caching: Whether the code is generated by the
+        HackStackCachingCodeGenerator instead of the HackCodeGenerator.
+    peephole: Whether the generated assembly of every program is rewritten
+        by the HackPeepholeOptimizer.
+    shared_comparisons: Whether eq, gt and lt commands jump to shared
+        routines instead of inlining the comparison at every site.
+    trampolines: Whether call and return commands jump to shared routines
+        instead of inlining the calling convention at every site.
+  """
+
+  _DEFAULTS = {
+      "eliminate_dead_functions": False,
+      "fuse_commands": False,
+      "inline_budget": 0,
+      "optimize_commands": False,
+      "peephole": False,
+      "shared_comparisons": False,
+      "stack_caching": False,
+      "trampolines": False
+  }
+
+  def __init__(self, **settings):
+    for name, value in TranslationOptions._DEFAULTS.items():
+      setattr(self, name, value)
+    for name, value in settings.items():
+      if name not in TranslationOptions._DEFAULTS:
+        raise TypeError("Unknown translation option: " + name)
+      setattr(self, name, value)
+
+  def Fingerprint(self):
+    """Returns a string identifying the settings, e.g. for cache keys."""
+    return ",".join(
+        "%s=%r" % (name, getattr(self, name))
+        for name in sorted(TranslationOptions._DEFAULTS))
+
+  def NeedsLinkPlan(self):
+    """Returns whether the settings require looking at all programs."""
+    return self.eliminate_dead_functions or self.inline_budget > 0
+
+  def ChangedSettings(self):
+    """Returns the names of the settings that differ from their defaults."""
+    return [name for name in sorted(TranslationOptions._DEFAULTS)
+            if getattr(self, name) != TranslationOptions._DEFAULTS[name]]
+
+  def WithDefault(self, name):
+    """Returns a copy of the options with setting name reset to its default."""
+    options = copy.copy(self)
+    setattr(options, name, TranslationOptions._DEFAULTS[name])
+    return options
+
+
 class HackParser(object):
   """This class is responsible for all parsing logic.
 
@@ -140,32 +282,42 @@ class HackParser(object):
       "temp"
   ]
 
-  # specifies the order in which commands will attempt to be parsed.
-  _COMMAND_PARSE_ORDER = [
-      AddCommand,
-      SubCommand,
-      NegCommand,
-      EqCommand,
-      GtCommand,
-      LtCommand,
-      AndCommand,
-      OrCommand,
-      NotCommand,
-      PushCommand,
-      PopCommand,
-      LabelCommand,
-      GotoCommand,
-      IfGotoCommand,
-      FunctionCommand,
-      CallCommand,
-      ReturnCommand,
-      EmptyCommand,
-      ErrorCommand
-  ]
+  _SEGMENT_SET = frozenset(_SEGMENT_NAMES)
+
+  # Maps segment names to one shared string object per segment.
+  _SEGMENTS = dict((name, name) for name in _SEGMENT_NAMES)
+
+  # Kinds of command syntax, classified by the arguments a command takes.
+  _NO_ARGUMENTS, _MEMORY_ACCESS, _LABEL_ARGUMENT, _FUNCTION_ARGUMENTS = range(4)
+
+  # Maps the first token of a program line to the kind of syntax and the
+  # type of the command it introduces. ParseCommand dispatches on this table
+  # after splitting the line into tokens exactly once.
+  _COMMAND_TABLE = {
+      "add": (_NO_ARGUMENTS, AddCommand),
+      "sub": (_NO_ARGUMENTS, SubCommand),
+      "neg": (_NO_ARGUMENTS, NegCommand),
+      "eq": (_NO_ARGUMENTS, EqCommand),
+      "gt": (_NO_ARGUMENTS, GtCommand),
+      "lt": (_NO_ARGUMENTS, LtCommand),
+      "and": (_NO_ARGUMENTS, AndCommand),
+      "or": (_NO_ARGUMENTS, OrCommand),
+      "not": (_NO_ARGUMENTS, NotCommand),
+      "return": (_NO_ARGUMENTS, ReturnCommand),
+      "push": (_MEMORY_ACCESS, PushCommand),
+      "pop": (_MEMORY_ACCESS, PopCommand),
+      "label": (_LABEL_ARGUMENT, LabelCommand),
+      "goto": (_LABEL_ARGUMENT, GotoCommand),
+      "if-goto": (_LABEL_ARGUMENT, IfGotoCommand),
+      "function": (_FUNCTION_ARGUMENTS, FunctionCommand),
+      "call": (_FUNCTION_ARGUMENTS, CallCommand)
+  }
 
   _RE_LABEL = re.compile(r"[a-zA-Z_\.:][a-zA-Z0-9_\.:]*")
 
-  _RE_NUMBER = re.compile(r"\d+")
+  # The bulk parsers remember the command of up to this many distinct lines,
+  # so that repeated lines are tokenized only once and share one command.
+  _MAX_PARSED_LINES = 4096
 
   @staticmethod
   def ParseCommand(line):
@@ -177,136 +329,515 @@ class HackParser(object):
     Returns:
       An instance of one of the command types or an instance ErrorCommand.
     """
-    line = HackParser._TrimProgramLine(line)
-    for command in HackParser._COMMAND_PARSE_ORDER:
-      result = getattr(HackParser, "Parse" + command.__name__)(line)
-      if result:
-        return result
+    constructor, arguments = HackParser._ParseTokens(
+        line.split("//", 1)[0].split(), line)
+    return constructor(*arguments)
 
   @staticmethod
-  def ParseAddCommand(line):
-    return HackParser._ParseSimpleCommand(line, "add", AddCommand)
+  def ParseLines(lines):
+    """Parses all lines of a program at once.
 
-  @staticmethod
-  def ParseSubCommand(line):
-    return HackParser._ParseSimpleCommand(line, "sub", SubCommand)
+    This is equivalent to map(HackParser.ParseCommand, lines), but every
+    distinct line is tokenized only once, which pays off since VM code is
+    highly repetitive. Lines with the same text share one command instance.
 
-  @staticmethod
-  def ParseNegCommand(line):
-    return HackParser._ParseSimpleCommand(line, "neg", NegCommand)
+    Args:
+      lines: An iterable of strings with the lines to be parsed.
 
-  @staticmethod
-  def ParseEqCommand(line):
-    return HackParser._ParseSimpleCommand(line, "eq", EqCommand)
+    Returns:
+      A list with an instance of one of the command types or an instance of
+      ErrorCommand for every line.
+    """
+    return list(HackParser.StreamLines(lines))
 
   @staticmethod
-  def ParseGtCommand(line):
-    return HackParser._ParseSimpleCommand(line, "gt", GtCommand)
+  def StreamLines(lines):
+    """Lazily parses the lines of a program, see ParseLines.
 
-  @staticmethod
-  def ParseLtCommand(line):
-    return HackParser._ParseSimpleCommand(line, "lt", LtCommand)
+    Args:
+      lines: An iterable of strings with the lines to be parsed.
 
-  @staticmethod
-  def ParseAndCommand(line):
-    return HackParser._ParseSimpleCommand(line, "and", AndCommand)
+    Yields:
+      An instance of one of the command types or an instance of ErrorCommand
+      for every line.
+    """
+    parse_tokens = HackParser._ParseTokens
+    parsed_lines = {}
+    for line in lines:
+      command = parsed_lines.get(line)
+      if command is None:
+        if len(parsed_lines) >= HackParser._MAX_PARSED_LINES:
+          parsed_lines.clear()
+        constructor, arguments = parse_tokens(
+            line.split("//", 1)[0].split(), line)
+        command = constructor(*arguments)
+        parsed_lines[line] = command
+      yield command
+
+  @staticmethod
+  def _ParseTokens(parts, line):
+    """Determines the command for a line already split into tokens.
 
-  @staticmethod
-  def ParseOrCommand(line):
-    return HackParser._ParseSimpleCommand(line, "or", OrCommand)
+    Args:
+      parts: A list with the tokens of the line, comments excluded.
+      line: The original line, used for reporting errors.
 
-  @staticmethod
-  def ParseNotCommand(line):
-    return HackParser._ParseSimpleCommand(line, "not", NotCommand)
+    Returns:
+      A (constructor, arguments) tuple. Calling constructor(*arguments)
+      creates an instance of one of the command types, an EmptyCommand or an
+      ErrorCommand.
+    """
+    if not parts:
+      return (EmptyCommand, ())
+    entry = HackParser._COMMAND_TABLE.get(parts[0])
+    if entry is not None:
+      kind, constructor = entry
+      if kind == HackParser._NO_ARGUMENTS:
+        if len(parts) == 1:
+          return (constructor, ())
+      elif kind == HackParser._MEMORY_ACCESS:
+        if (len(parts) == 3 and parts[1] in HackParser._SEGMENT_SET
+            and parts[2].isdigit()
+            and (constructor is PushCommand or parts[1] != "constant")):
+          return (constructor,
+                  (HackParser._SEGMENTS[parts[1]], int(parts[2])))
+      elif kind == HackParser._LABEL_ARGUMENT:
+        if len(parts) == 2 and HackParser._RE_LABEL.match(parts[1]):
+          return (constructor, (intern(parts[1]),))
+      elif (len(parts) == 3 and HackParser._RE_LABEL.match(parts[1])
+            and parts[2].isdigit()):
+        return (constructor, (intern(parts[1]), int(parts[2])))
+    return (ErrorCommand, (HackParser._TrimProgramLine(line),))
 
   @staticmethod
-  def ParsePushCommand(line):
-    parts = line.split()
-    if (len(parts) == 3 and parts[0] == "push"
-        and parts[1] in HackParser._SEGMENT_NAMES
-        and parts[2].isdigit()):
-      return PushCommand(parts[1], int(parts[2]))
-    else:
-      return False
+  def _TrimProgramLine(line):
+    try:
+      return line[:line.index("//")].strip()
+    except ValueError:
+      return line.strip()
 
-  @staticmethod
-  def ParsePopCommand(line):
-    parts = line.split()
-    if (len(parts) == 3 and parts[0] == "pop"
-        and parts[1] in HackParser._SEGMENT_NAMES
-        and parts[1] != "constant" and parts[2].isdigit()):
-      return PopCommand(parts[1], int(parts[2]))
-    else:
-      return False
 
-  @staticmethod
-  def ParseLabelCommand(line):
-    return HackParser._ParseGenericLabelCommand(line, "label", LabelCommand)
+class HackCommandOptimizer(object):
+  """This class optimizes decorated VM commands before code generation.
 
-  @staticmethod
-  def ParseGotoCommand(line):
-    return HackParser._ParseGenericLabelCommand(line, "goto", GotoCommand)
+  The optimizations are passes over the decorated commands of one function
+  at a time. Every pass takes a list of (command, program_name,
+  enclosing_function, line_number) tuples and returns a shorter or equal
+  list with the same behavior. Replacement commands take over the
+  decoration of the last command they replace.
+  """
 
-  @staticmethod
-  def ParseIfGotoCommand(line):
-    return HackParser._ParseGenericLabelCommand(line, "if-goto", IfGotoCommand)
+  _BINARY_OPERATIONS = {
+      AddCommand: lambda x, y: x + y,
+      SubCommand: lambda x, y: x - y,
+      AndCommand: lambda x, y: x & y,
+      OrCommand: lambda x, y: x | y,
+      # The comparisons test the sign of y - x, just like the generated code,
+      # including its behavior on overflow.
+      EqCommand: lambda x, y: -1 if HackCommandOptimizer._ToWord(y - x) == 0
+                              else 0,
+      GtCommand: lambda x, y: -1 if HackCommandOptimizer._ToWord(y - x) < 0
+                              else 0,
+      LtCommand: lambda x, y: -1 if HackCommandOptimizer._ToWord(y - x) > 0
+                              else 0
+  }
 
-  @staticmethod
-  def ParseFunctionCommand(line):
-    return HackParser._ParseGenericFunctionCommand(line, "function", FunctionCommand)
+  _UNARY_OPERATIONS = {
+      NegCommand: lambda x: -x,
+      NotCommand: lambda x: ~x
+  }
 
   @staticmethod
-  def ParseCallCommand(line):
-    return HackParser._ParseGenericFunctionCommand(line, "call", CallCommand)
+  def StreamOptimize(decorated_program_commands, statistics=None):
+    """Lazily applies all passes to a stream of decorated commands.
 
-  @staticmethod
-  def ParseReturnCommand(line):
-    if line == "return":
-      return ReturnCommand()
+    Empty commands are dropped, since they generate no code.
+
+    Args:
+      decorated_program_commands: An iterable of (command, program_name,
+          enclosing_function, line_number) tuples.
+      statistics: An optional collections.Counter receiving the number of
+          commands each pass eliminated, keyed by "ir.<pass name>".
+
+    Yields:
+      The optimized decorated commands.
+    """
+    passes = [
+        ("unreachable-code", HackCommandOptimizer.RemoveUnreachableCode),
+        ("constant-folding", HackCommandOptimizer.FoldConstants),
+        ("redundant-moves", HackCommandOptimizer.RemoveRedundantMoves)
+    ]
+    for function_commands in HackCommandOptimizer._StreamFunctions(
+        decorated_program_commands):
+      for name, optimization in passes:
+        optimized_commands = optimization(function_commands)
+        if statistics is not None:
+          statistics["ir." + name] += (
+              len(function_commands) - len(optimized_commands))
+        function_commands = optimized_commands
+      for decorated_command in function_commands:
+        yield decorated_command
+
+  @staticmethod
+  def RemoveUnreachableCode(decorated_commands):
+    """Removes the commands between a goto or return and the next label."""
+    result = []
+    reachable = True
+    for decorated_command in decorated_commands:
+      command_type = decorated_command[0].__class__
+      if command_type in (LabelCommand, FunctionCommand):
+        reachable = True
+      if reachable:
+        result.append(decorated_command)
+      if command_type in (GotoCommand, ReturnCommand):
+        reachable = False
+    return result
+
+  @staticmethod
+  def FoldConstants(decorated_commands):
+    """Evaluates arithmetic and comparisons on constant operands.
+
+    A constant operand is a push of a constant, optionally followed by a neg
+    or not, since negative numbers can only be expressed that way. An
+    expression is only replaced when its value can be pushed with fewer
+    commands.
+    """
+    result = []
+    for decorated_command in decorated_commands:
+      result.append(decorated_command)
+      command_type = decorated_command[0].__class__
+      if command_type in HackCommandOptimizer._UNARY_OPERATIONS:
+        operand = HackCommandOptimizer._MatchConstant(result, len(result) - 1)
+        if operand is None:
+          continue
+        value = HackCommandOptimizer._UNARY_OPERATIONS[command_type](
+            operand[0])
+        start = len(result) - 1 - operand[1]
+      elif command_type in HackCommandOptimizer._BINARY_OPERATIONS:
+        second = HackCommandOptimizer._MatchConstant(result, len(result) - 1)
+        if second is None:
+          continue
+        first = HackCommandOptimizer._MatchConstant(
+            result, len(result) - 1 - second[1])
+        if first is None:
+          continue
+        value = HackCommandOptimizer._BINARY_OPERATIONS[command_type](
+            first[0], second[0])
+        start = len(result) - 1 - second[1] - first[1]
+      else:
+        continue
+
+      replacement = HackCommandOptimizer._ConstantCommands(
+          HackCommandOptimizer._ToWord(value), decorated_command)
+      if len(replacement) < len(result) - start:
+        result[start:] = replacement
+    return result
+
+  @staticmethod
+  def RemoveRedundantMoves(decorated_commands):
+    """Removes pushes directly popped back into the same location."""
+    result = []
+    for decorated_command in decorated_commands:
+      command = decorated_command[0]
+      if (command.__class__ is PopCommand and result
+          and result[-1][0].__class__ is PushCommand
+          and result[-1][0].segment == command.segment
+          and result[-1][0].index == command.index
+          and result[-1][1] == decorated_command[1]):
+        result.pop()
+      else:
+        result.append(decorated_command)
+    return result
+
+  @staticmethod
+  def _StreamFunctions(decorated_program_commands):
+    # Groups the commands by function, dropping empty commands.
+    function_commands = []
+    for decorated_command in decorated_program_commands:
+      command_type = decorated_command[0].__class__
+      if command_type is EmptyCommand:
+        continue
+      if command_type is FunctionCommand and function_commands:
+        yield function_commands
+        function_commands = []
+      function_commands.append(decorated_command)
+    if function_commands:
+      yield function_commands
+
+  @staticmethod
+  def _MatchConstant(decorated_commands, end):
+    # Returns the (value, length) of the constant operand whose last command
+    # is at index end - 1, or None.
+    if end >= 1:
+      command = decorated_commands[end - 1][0]
+      if command.__class__ is PushCommand and command.segment == "constant":
+        return (command.index, 1)
+    if end >= 2:
+      command = decorated_commands[end - 2][0]
+      operation = HackCommandOptimizer._UNARY_OPERATIONS.get(
+          decorated_commands[end - 1][0].__class__)
+      if (operation is not None and command.__class__ is PushCommand
+          and command.segment == "constant"):
+        return (HackCommandOptimizer._ToWord(operation(command.index)), 2)
+    return None
+
+  @staticmethod
+  def _ConstantCommands(value, decorated_command):
+    # Returns the shortest list of decorated commands pushing value.
+    decoration = decorated_command[1:]
+    if value >= 0:
+      commands = [PushCommand("constant", value)]
+    elif value == -32768:
+      commands = [PushCommand("constant", 32767), NotCommand()]
     else:
-      return False
+      commands = [PushCommand("constant", -value), NegCommand()]
+    return [(command,) + decoration for command in commands]
 
   @staticmethod
-  def ParseEmptyCommand(line):
-    return HackParser._ParseSimpleCommand(line, "", EmptyCommand)
+  def _ToWord(value):
+    # Wraps value to the range of a signed 16 bit word.
+    return ((value + 32768) & 0xFFFF) - 32768
 
-  @staticmethod
-  def ParseErrorCommand(line):
-    return ErrorCommand(line)
 
-  @staticmethod
-  def _TrimProgramLine(line):
-    try:
-      return line[:line.index("//")].strip()
-    except ValueError:
-      return line.strip()
+class InlineFunction(object):
+  """A leaf function whose calls can be replaced by its body.
 
-  @staticmethod
-  def _ParseSimpleCommand(line, command_name, constructor):
-    if line == command_name:
-      return constructor()
-    else:
-      return False
+  Attributes:
+    program_name: The name of the file that defines the function.
+    commands: The list of commands of the function body.
+    arguments: The number of arguments the body accesses.
+    local_variables: The number of local variables of the function.
+    saved_pointers: The sorted pointer indices the body pops to.
+    uses_static: Whether the body accesses the static segment.
+  """
 
-  @staticmethod
-  def _ParseGenericLabelCommand(line, command_name, constructor):
-    parts = line.split()
-    if (len(parts) == 2 and parts[0] == command_name
-        and re.match(HackParser._RE_LABEL, parts[1])):
-      return constructor(parts[1])
-    else:
-      return False
+  def __init__(self, program_name, commands, arguments, local_variables,
+               saved_pointers, uses_static):
+    self.program_name = program_name
+    self.commands = commands
+    self.arguments = arguments
+    self.local_variables = local_variables
+    self.saved_pointers = saved_pointers
+    self.uses_static = uses_static
+
+
+class HackFunctionInliner(object):
+  """This class replaces calls to small leaf functions by their bodies.
+
+  A leaf function calls no other function, so nothing can run between
+  entering and leaving an inlined body. This is why the arguments and local
+  variables of all inlined bodies can share one block of variables, the
+  "inline" pseudo segment: argument i becomes inline i and local i becomes
+  inline arguments + i. The inlined commands are decorated as commands of the
+  calling function, with labels qualified by the line number of the call and
+  fresh line numbers past the end of the calling file.
+  """
+
+  # The stack effect of the commands that neither jump nor return.
+  _STACK_EFFECTS = {
+      AddCommand: -1,
+      SubCommand: -1,
+      NegCommand: 0,
+      EqCommand: -1,
+      GtCommand: -1,
+      LtCommand: -1,
+      AndCommand: -1,
+      OrCommand: -1,
+      NotCommand: 0,
+      PushCommand: 1,
+      PopCommand: -1
+  }
 
   @staticmethod
-  def _ParseGenericFunctionCommand(line, command_name, constructor):
-    parts = line.split()
-    if len(parts) != 3: return False
-    if (len(parts) == 3 and parts[0] == command_name
-        and re.match(HackParser._RE_LABEL, parts[1])
-        and re.match(HackParser._RE_NUMBER, parts[2])):
-      return constructor(parts[1], int(parts[2]))
-    else:
-      return False
+  def FindInlineFunctions(programs, budget):
+    """Finds the leaf functions that are small enough to be inlined.
+
+    Args:
+      programs: An iterable of (program_name, program_lines) tuples.
+      budget: The maximum number of commands in the body of a function.
+
+    Returns:
+      A dict mapping function names to InlineFunction instances.
+    """
+    inline_functions = {}
+    for program_name, program_lines in programs:
+      function_command = None
+      body = []
+      for command in HackParser.ParseLines(program_lines) + [None]:
+        command_type = command.__class__
+        if command_type is EmptyCommand:
+          continue
+        if command is None or command_type is FunctionCommand:
+          if function_command is not None and len(body) <= budget:
+            inline_function = HackFunctionInliner._AnalyzeFunction(
+                program_name, function_command, body)
+            if inline_function is not None:
+              inline_functions[function_command.function_name] = (
+                  inline_function)
+          function_command = command
+          body = []
+        else:
+          body.append(command)
+    return inline_functions
+
+  @staticmethod
+  def StreamInline(decorated_program_commands, inline_functions,
+                   first_line_number, statistics=None, call_sites=None):
+    """Lazily replaces calls to inline functions by their bodies.
+
+    Args:
+      decorated_program_commands: An iterable of (command, program_name,
+          enclosing_function, line_number) tuples.
+      inline_functions: A dict mapping function names to InlineFunction
+          instances.
+      first_line_number: The first line number past the end of the program,
+          used to number the inlined commands.
+      statistics: An optional collections.Counter receiving the number of
+          inlined calls, keyed by "inline.<function name>".
+      call_sites: An optional dict receiving the line number of the call
+          every inlined command replaces, keyed by the line number of the
+          inlined command.
+
+    Yields:
+      Decorated commands.
+    """
+    line_number = first_line_number
+    for decorated_command in decorated_program_commands:
+      command, name, function_name, number = decorated_command
+      inline_function = None
+      if command.__class__ is CallCommand:
+        inline_function = inline_functions.get(command.function_name)
+      if (inline_function is None
+          or command.arguments < inline_function.arguments
+          or (inline_function.uses_static
+              and inline_function.program_name != name)):
+        yield decorated_command
+        continue
+
+      if statistics is not None:
+        statistics["inline." + command.function_name] += 1
+      for inlined_command in HackFunctionInliner._ExpandCall(
+          command, number, inline_function):
+        if call_sites is not None:
+          call_sites[line_number] = number
+        yield (inlined_command, name, function_name, line_number)
+        line_number += 1
+
+  @staticmethod
+  def _AnalyzeFunction(program_name, function_command, body):
+    # Returns an InlineFunction for the body or None if it cannot be inlined.
+    arguments = 0
+    saved_pointers = set()
+    uses_static = False
+    for command in body:
+      command_type = command.__class__
+      if command_type not in HackFunctionInliner._STACK_EFFECTS and (
+          command_type not in (
+              LabelCommand, GotoCommand, IfGotoCommand, ReturnCommand)):
+        return None
+      if command_type in (PushCommand, PopCommand):
+        if command.segment == "argument":
+          arguments = max(arguments, command.index + 1)
+        elif command.segment == "local":
+          if command.index >= function_command.local_variables:
+            return None
+        elif command.segment == "static":
+          uses_static = True
+        elif command.segment == "pointer" and command_type is PopCommand:
+          saved_pointers.add(command.index)
+    if not HackFunctionInliner._IsStackBalanced(body):
+      return None
+    return InlineFunction(
+        program_name, body, arguments, function_command.local_variables,
+        sorted(saved_pointers), uses_static)
+
+  @staticmethod
+  def _IsStackBalanced(body):
+    # Checks that the stack depth at every label is the same on all paths,
+    # never drops below zero, and is exactly one (the return value) at every
+    # return. Control must not fall through the end of the body.
+    labels = set(command.label_name for command in body
+                 if command.__class__ is LabelCommand)
+    label_depths = {}
+
+    def Jump(label_name, depth):
+      if label_name not in labels:
+        return False
+      return label_depths.setdefault(label_name, depth) == depth
+
+    depth = 0
+    for command in body:
+      command_type = command.__class__
+      if command_type is LabelCommand:
+        if depth is None:
+          depth = label_depths.get(command.label_name)
+          if depth is None:
+            return False
+        elif not Jump(command.label_name, depth):
+          return False
+      elif depth is None:
+        continue
+      elif command_type is GotoCommand:
+        if not Jump(command.label_name, depth):
+          return False
+        depth = None
+      elif command_type is IfGotoCommand:
+        depth -= 1
+        if depth < 0 or not Jump(command.label_name, depth):
+          return False
+      elif command_type is ReturnCommand:
+        if depth != 1:
+          return False
+        depth = None
+      else:
+        depth += HackFunctionInliner._STACK_EFFECTS[command_type]
+        if depth < 0:
+          return False
+    return depth is None
+
+  @staticmethod
+  def _ExpandCall(call_command, number, inline_function):
+    # Returns the commands replacing call_command on line number.
+    def Label(label_name):
+      return "inline%d$%s" % (number, label_name)
+
+    locals_base = call_command.arguments
+    saves_base = locals_base + inline_function.local_variables
+    commands = [PopCommand("inline", index)
+                for index in reversed(range(call_command.arguments))]
+    for index in range(inline_function.local_variables):
+      commands += [PushCommand("constant", 0),
+                   PopCommand("inline", locals_base + index)]
+    for offset, pointer in enumerate(inline_function.saved_pointers):
+      commands += [PushCommand("pointer", pointer),
+                   PopCommand("inline", saves_base + offset)]
+
+    end_label = None
+    last_index = len(inline_function.commands) - 1
+    for index, command in enumerate(inline_function.commands):
+      command_type = command.__class__
+      if (command_type in (PushCommand, PopCommand)
+          and command.segment in ("argument", "local")):
+        inline_index = command.index
+        if command.segment == "local":
+          inline_index += locals_base
+        commands.append(command_type("inline", inline_index))
+      elif command_type in (LabelCommand, GotoCommand, IfGotoCommand):
+        commands.append(command_type(Label(command.label_name)))
+      elif command_type is ReturnCommand:
+        for offset, pointer in enumerate(inline_function.saved_pointers):
+          commands += [PushCommand("inline", saves_base + offset),
+                       PopCommand("pointer", pointer)]
+        if index != last_index:
+          # VM labels cannot start with "$", so no label of the body can
+          # clash with this one.
+          end_label = "inline%d$$end" % (number,)
+          commands.append(GotoCommand(end_label))
+      else:
+        commands.append(command)
+    if end_label is not None:
+      commands.append(LabelCommand(end_label))
+    return commands
 
 
 class HackCodeGenerator(object):
@@ -332,6 +863,142 @@ class HackCodeGenerator(object):
       "static": 16
   }
 
+  # The command types that assembly can be generated for.
+  _COMMAND_TYPES = [
+      AddCommand,
+      SubCommand,
+      NegCommand,
+      EqCommand,
+      GtCommand,
+      LtCommand,
+      AndCommand,
+      OrCommand,
+      NotCommand,
+      PushCommand,
+      PopCommand,
+      LabelCommand,
+      GotoCommand,
+      IfGotoCommand,
+      FunctionCommand,
+      CallCommand,
+      ReturnCommand,
+      EmptyCommand
+  ]
+
+  # The prefix of the variables of the inline pseudo segment.
+  _INLINE_VARIABLES = "$$INLINE"
+
+  # The labels of the shared routines used when trampolines are enabled.
+  _CALL_ROUTINE = "$$CALL"
+  _RETURN_ROUTINE = "$$RETURN"
+
+  # The labels of the shared comparison routines and the jump conditions
+  # they test on the difference of the two topmost stack values.
+  _EQ_ROUTINE = "$$EQ"
+  _GT_ROUTINE = "$$GT"
+  _LT_ROUTINE = "$$LT"
+  _COMPARISON_ROUTINES = [
+      (_EQ_ROUTINE, "JEQ"),
+      (_GT_ROUTINE, "JLT"),
+      (_LT_ROUTINE, "JGT")
+  ]
+
+  # The command types whose code depends on nothing but their type.
+  _CONSTANT_TEMPLATE_TYPES = [
+      AddCommand,
+      SubCommand,
+      NegCommand,
+      AndCommand,
+      OrCommand,
+      NotCommand
+  ]
+
+  # The memoized code of memory access commands, keyed by (generator,
+  # segment, index) tuples, and the number of entries at which it is
+  # cleared.
+  _templates = {}
+  _MAX_TEMPLATES = 4096
+
+  @staticmethod
+  def GetGenerators(options):
+    """Selects the code generator of every command type.
+
+    Args:
+      options: A TranslationOptions instance.
+
+    Returns:
+      A dictionary mapping command types to functions with the signature of
+      GenerateAsm. The code of the commands that do not depend on their
+      context, such as "push constant 0" or "add", is generated once and
+      shared by all occurrences, so the functions may return tuples which
+      must not be modified.
+    """
+    generators = {}
+    for command_type in HackCodeGenerator._COMMAND_TYPES:
+      generators[command_type] = getattr(
+          HackCodeGenerator, "GenerateAsm" + command_type.__name__)
+    for command_type in HackCodeGenerator._CONSTANT_TEMPLATE_TYPES:
+      generators[command_type] = HackCodeGenerator._MemoizeConstantTemplate(
+          generators[command_type])
+    for command_type in (PushCommand, PopCommand):
+      generators[command_type] = HackCodeGenerator._MemoizeMemoryAccess(
+          generators[command_type])
+    if options.trampolines:
+      generators[CallCommand] = HackCodeGenerator.GenerateAsmTrampolineCall
+      generators[ReturnCommand] = (
+          HackCodeGenerator.GenerateAsmTrampolineReturn)
+    generators[FusedCommand] = HackCommandFuser.GenerateAsm
+    if options.shared_comparisons:
+      generators[EqCommand] = HackCodeGenerator.GenerateAsmSharedEq
+      generators[GtCommand] = HackCodeGenerator.GenerateAsmSharedGt
+      generators[LtCommand] = HackCodeGenerator.GenerateAsmSharedLt
+    return generators
+
+  @staticmethod
+  def _MemoizeMemoryAccess(generator):
+    """Memoizes the code generated for push and pop commands.
+
+    The code of every segment and index is generated once and shared as a
+    tuple. The static segment is excluded, since its code depends on the
+    name of the file. At most _MAX_TEMPLATES entries are kept; once there
+    are that many, all of them are evicted at once.
+
+    Args:
+      generator: A function taking a push or pop command, the name of the
+          file in which it resides and possibly further arguments, and
+          returning a list of assembly instructions.
+
+    Returns:
+      A function with the signature of generator.
+    """
+    templates = HackCodeGenerator._templates
+
+    def MemoizedGenerator(command, name, *arguments):
+      key = (generator, command.segment, command.index)
+      asm = templates.get(key)
+      if asm is None:
+        asm = generator(command, name, *arguments)
+        if command.segment == "static":
+          return asm
+        if len(templates) >= HackCodeGenerator._MAX_TEMPLATES:
+          templates.clear()
+        asm = tuple(asm)
+        templates[key] = asm
+      return asm
+
+    return MemoizedGenerator
+
+  @staticmethod
+  def _MemoizeConstantTemplate(generator):
+    # Returns a generator handing out the code of generator, which depends
+    # on the type of the command only.
+    asm = tuple(generator(None, None, None, None))
+
+    def MemoizedGenerator(command, name, function_name, number):
+      return asm
+
+    return MemoizedGenerator
+
   @staticmethod
   def GenerateAsm(command, name, function_name, number):
     """Transforms a VM command into a list of Hack assembly instructions.
@@ -398,6 +1065,9 @@ class HackCodeGenerator(object):
     elif command.segment == "static":
       return HackCodeGenerator._ApplyPushDirectTemplate(
           "%s.%d" % (name, command.index))
+    elif command.segment == "inline":
+      return HackCodeGenerator._ApplyPushDirectTemplate(
+          "%s.%d" % (HackCodeGenerator._INLINE_VARIABLES, command.index))
 
   @staticmethod
   def GenerateAsmPopCommand(command, name, function_name, number):
@@ -410,6 +1080,9 @@ class HackCodeGenerator(object):
     elif command.segment == "static":
       return HackCodeGenerator._ApplyPopDirectTemplate(
           "%s.%d" % (name, command.index))
+    elif command.segment == "inline":
+      return HackCodeGenerator._ApplyPopDirectTemplate(
+          "%s.%d" % (HackCodeGenerator._INLINE_VARIABLES, command.index))
 
   @staticmethod
   def GenerateAsmLabelCommand(command, name, function_name, number):
@@ -511,7 +1184,48 @@ class HackCodeGenerator(object):
     return []
 
   @staticmethod
-  def GenerateBootstrapAsm():
+  def GenerateAsmTrampolineCall(command, name, function_name, number):
+    """Generates a call that jumps to the shared call routine.
+
+    The routine expects the number of arguments in D, the return address in
+    R13 and the address of the called function in R14.
+    """
+    return_address = "%s$%d$return_address" % (name, number)
+    return sum([
+        HackCodeGenerator._LoadConstantToD(return_address),
+        HackCodeGenerator._FromDToMemory(13),
+        HackCodeGenerator._LoadConstantToD(command.function_name),
+        HackCodeGenerator._FromDToMemory(14),
+        HackCodeGenerator._LoadConstantToD(command.arguments),
+        HackCodeGenerator._GotoLabel(HackCodeGenerator._CALL_ROUTINE),
+        HackCodeGenerator._CreateLabel(return_address)
+    ], [])
+
+  @staticmethod
+  def GenerateAsmTrampolineReturn(command, name, function_name, number):
+    """Generates a return that jumps to the shared return routine."""
+    return HackCodeGenerator._GotoLabel(HackCodeGenerator._RETURN_ROUTINE)
+
+  @staticmethod
+  def GenerateAsmSharedEq(command, name, function_name, number):
+    return HackCodeGenerator._ApplySharedComparisonTemplate(
+        HackCodeGenerator._EQ_ROUTINE, name, number)
+
+  @staticmethod
+  def GenerateAsmSharedGt(command, name, function_name, number):
+    return HackCodeGenerator._ApplySharedComparisonTemplate(
+        HackCodeGenerator._GT_ROUTINE, name, number)
+
+  @staticmethod
+  def GenerateAsmSharedLt(command, name, function_name, number):
+    return HackCodeGenerator._ApplySharedComparisonTemplate(
+        HackCodeGenerator._LT_ROUTINE, name, number)
+
+  @staticmethod
+  def GenerateBootstrapAsm(options=None):
+    if options is None:
+      options = TranslationOptions()
+    call_generator = HackCodeGenerator.GetGenerators(options)[CallCommand]
     return sum([
         [
             "@256",
@@ -519,8 +1233,67 @@ class HackCodeGenerator(object):
             "@0",
             "M=D"
         ],
-        HackCodeGenerator.GenerateAsmCallCommand(
-            CallCommand("Sys.init", 0), "Sys", "", 1000000)
+        call_generator(CallCommand("Sys.init", 0), "Sys", "", 1000000),
+        HackCodeGenerator.GenerateRuntimeAsm(options)
+    ], [])
+
+  @staticmethod
+  def GenerateRuntimeAsm(options):
+    """Generates the shared routines required by the options.
+
+    Args:
+      options: A TranslationOptions instance.
+
+    Returns:
+      A list of Hack assembly instructions, empty unless the options require
+      shared routines.
+    """
+    runtime_asm = []
+    if options.trampolines:
+      runtime_asm += HackCodeGenerator._CallRoutine()
+      runtime_asm += HackCodeGenerator._ReturnRoutine()
+    if options.shared_comparisons:
+      for routine, op in HackCodeGenerator._COMPARISON_ROUTINES:
+        runtime_asm += HackCodeGenerator._ComparisonRoutine(routine, op)
+    return runtime_asm
+
+  @staticmethod
+  def _CallRoutine():
+    # Saves the frame of the caller and jumps to the called function, see
+    # GenerateAsmTrampolineCall for the inputs. The number of arguments is
+    # kept in R15 while the frame is pushed.
+    return sum([
+        HackCodeGenerator._CreateLabel(HackCodeGenerator._CALL_ROUTINE),
+        HackCodeGenerator._FromDToMemory(15),
+        HackCodeGenerator._PushFromMemory(13),
+        HackCodeGenerator._PushFromMemory(
+            HackCodeGenerator._SEGMENT_MAPPING["local"]),
+        HackCodeGenerator._PushFromMemory(
+            HackCodeGenerator._SEGMENT_MAPPING["argument"]),
+        HackCodeGenerator._PushFromMemory(
+            HackCodeGenerator._SEGMENT_MAPPING["this"]),
+        HackCodeGenerator._PushFromMemory(
+            HackCodeGenerator._SEGMENT_MAPPING["that"]),
+        HackCodeGenerator._FromMemoryToD(15),
+        HackCodeGenerator._AddConstantToD(5),
+        [
+            "@%d" % (HackCodeGenerator._SEGMENT_MAPPING["sp"],),
+            "D=M-D"
+        ],
+        HackCodeGenerator._FromDToMemory(
+            HackCodeGenerator._SEGMENT_MAPPING["argument"]),
+        HackCodeGenerator._FromMemoryToMemory(
+            HackCodeGenerator._SEGMENT_MAPPING["sp"],
+            HackCodeGenerator._SEGMENT_MAPPING["local"]),
+        HackCodeGenerator._GotoLocationFromMemory(14)
+    ], [])
+
+  @staticmethod
+  def _ReturnRoutine():
+    return sum([
+        HackCodeGenerator._CreateLabel(HackCodeGenerator._RETURN_ROUTINE),
+        HackCodeGenerator.GenerateAsmReturnCommand(
+            ReturnCommand(), "", "", 0)
     ], [])
 
   @staticmethod
@@ -569,6 +1342,42 @@ class HackCodeGenerator(object):
         "(%s)" % (end_label,)
     ]
 
+  @staticmethod
+  def _ApplySharedComparisonTemplate(routine, name, number):
+    # The shared routine expects the return address in D.
+    end_label = "%s$%d$end" % (name, number)
+    return sum([
+        HackCodeGenerator._LoadConstantToD(end_label),
+        HackCodeGenerator._GotoLabel(routine),
+        HackCodeGenerator._CreateLabel(end_label)
+    ], [])
+
+  @staticmethod
+  def _ComparisonRoutine(routine, op):
+    # Replaces the two topmost stack values with the result of their
+    # comparison and returns to the address passed in D, see
+    # _ApplySharedComparisonTemplate.
+    end_label = routine + "$end"
+    return sum([
+        HackCodeGenerator._CreateLabel(routine),
+        HackCodeGenerator._FromDToMemory(13),
+        [
+            "@SP",
+            "AM=M-1",
+            "D=M",
+            "A=A-1",
+            "D=D-M",
+            "M=-1",
+            "@%s" % (end_label,),
+            "D;%s" % (op,),
+            "@SP",
+            "A=M-1",
+            "M=0"
+        ],
+        HackCodeGenerator._CreateLabel(end_label),
+        HackCodeGenerator._GotoLocationFromMemory(13)
+    ], [])
+
   @staticmethod
   def _ApplyPushTemplate():
     return [
@@ -595,13 +1404,22 @@ class HackCodeGenerator(object):
 
   @staticmethod
   def _ApplyPushIndirectTemplate(segment_base, index):
-    return [
+    # The address of the entry is either the sum of the base address and
+    # index, or reached by stepping A from the base address. Every
+    # instruction costs one ROM word and one cycle, so the shorter code is
+    # used; stepping wins for the first few entries.
+    adding = [
         "@%d" % (segment_base,),
         "D=M",
         "@%d" % (index,),
         "A=D+A",
         "D=M"
-    ] + HackCodeGenerator._ApplyPushTemplate()
+    ]
+    stepping = HackCodeGenerator._SegmentEntryToA(segment_base, index) + [
+        "D=M"
+    ]
+    return min(adding, stepping, key=len) + (
+        HackCodeGenerator._ApplyPushTemplate())
 
   @staticmethod
   def _ApplyPopDirectTemplate(value):
@@ -616,7 +1434,11 @@ class HackCodeGenerator(object):
 
   @staticmethod
   def _ApplyPopIndirectTemplate(segment_base, index):
-    return [
+    # Computing the sum of the base address and index takes D, so the
+    # address is parked in R13 while the value is popped. Stepping A from
+    # the base address leaves the popped value in D instead, which is
+    # shorter for all but the larger indices.
+    parking = [
         "@%d" % (segment_base,),
         "D=M",
         "@%d" % (index,),
@@ -631,6 +1453,23 @@ class HackCodeGenerator(object):
         "A=M",
         "M=D"
     ]
+    stepping = [
+        "@SP",
+        "AM=M-1",
+        "D=M"
+    ] + HackCodeGenerator._SegmentEntryToA(segment_base, index) + [
+        "M=D"
+    ]
+    return min(parking, stepping, key=len)
+
+  @staticmethod
+  def _SegmentEntryToA(segment_base, index):
+    # Returns the code pointing A to the entry index of the segment whose
+    # base address is stored at segment_base, without touching D. It takes
+    # one instruction per entry after the second.
+    if index == 0:
+      return ["@%d" % (segment_base,), "A=M"]
+    return ["@%d" % (segment_base,), "A=M+1"] + ["A=A+1"] * (index - 1)
 
   @staticmethod
   def _FromMemoryToD(address):
@@ -689,6 +1528,13 @@ class HackCodeGenerator(object):
         "D=M"
     ]
 
+  @staticmethod
+  def _LoadConstantToD(constant):
+    return [
+        "@" + str(constant),
+        "D=A"
+    ]
+
   @staticmethod
   def _PushConstant(constant):
     return [
@@ -732,21 +1578,1204 @@ class HackCodeGenerator(object):
     ]
 
 
-def ParseProgram(program_lines, program_name):
-  """Transforms the lines of a VM program to a list of parsed commands.
+class HackStackCachingCodeGenerator(HackCodeGenerator):
+  """This class generates Hack assembly that caches the stack top in D.
 
-  Args:
-    program_line: A list of strings with the VM program.
-    program_name: the name of the file containing the program.
+  The HackCodeGenerator keeps the whole VM stack in memory, so every command
+  reloads its operands through SP and writes its result back. This generator
+  keeps the topmost stack value in the D register across straight-line
+  sequences of commands instead, which saves most of the stack traffic of
+  expression code. The cached value is spilled to memory before labels,
+  branches, calls and returns, so every jump target sees the whole stack in
+  memory, exactly as with code from HackCodeGenerator. The two generators
+  can therefore be mixed at command boundaries where nothing is cached.
 
-  Returns:
-    A list of parsed commands.
+  Since the code for a command depends on whether the stack top is cached
+  after the preceding command, this generator works on a whole stream of
+  commands rather than on one command at a time.
+  """
+
+  # The computation of the binary operations, with the second operand in D
+  # and the first one in M.
+  _BINARY_OPERATIONS = {
+      AddCommand: "D=D+M",
+      SubCommand: "D=M-D",
+      AndCommand: "D=D&M",
+      OrCommand: "D=D|M"
+  }
+
+  _UNARY_OPERATIONS = {
+      NegCommand: "D=-D",
+      NotCommand: "D=!D"
+  }
+
+  # The jump conditions of the comparisons, tested on the second operand
+  # minus the first one, exactly as in HackCodeGenerator.
+  _COMPARISON_JUMPS = {
+      EqCommand: "JEQ",
+      GtCommand: "JLT",
+      LtCommand: "JGT"
+  }
+
+  # Pushes D to the stack in memory.
+  _SPILL = [
+      "@SP",
+      "AM=M+1",
+      "A=A-1",
+      "M=D"
+  ]
+
+  # Pops the stack in memory into D.
+  _FILL = [
+      "@SP",
+      "AM=M-1",
+      "D=M"
+  ]
+
+  @staticmethod
+  def StreamGenerateAsm(decorated_program_commands, options):
+    """Lazily transforms decorated commands into assembly instruction lists.
+
+    Args:
+      decorated_program_commands: An iterable of (command, program_name,
+          enclosing_function, line_number) tuples.
+      options: A TranslationOptions instance. The commands that are not
+          handled by this generator, such as calls and returns, are
+          generated as selected by HackCodeGenerator.GetGenerators.
+
+    Yields:
+      Lists containing Hack assembly instruction strings, one per command.
+    """
+    generators = HackCodeGenerator.GetGenerators(options)
+    load_to_d = HackCodeGenerator._MemoizeMemoryAccess(
+        HackStackCachingCodeGenerator._LoadToD)
+    store_from_d = HackCodeGenerator._MemoizeMemoryAccess(
+        HackStackCachingCodeGenerator._StoreFromD)
+    cached = False
+    previous_asm = None
+    for command, name, function_name, number in decorated_program_commands:
+      command_type = command.__class__
+      asm = []
+      if command_type is EmptyCommand:
+        pass
+      elif command_type is PushCommand:
+        if cached:
+          asm += HackStackCachingCodeGenerator._SPILL
+        asm += load_to_d(command, name)
+        cached = True
+      elif command_type is PopCommand:
+        if not cached:
+          asm += HackStackCachingCodeGenerator._FILL
+        asm += store_from_d(command, name)
+        cached = False
+      elif command_type in HackStackCachingCodeGenerator._BINARY_OPERATIONS:
+        if not cached:
+          asm += HackStackCachingCodeGenerator._FILL
+        asm += [
+            "@SP",
+            "AM=M-1",
+            HackStackCachingCodeGenerator._BINARY_OPERATIONS[command_type]
+        ]
+        cached = True
+      elif command_type in HackStackCachingCodeGenerator._UNARY_OPERATIONS:
+        if not cached:
+          asm += HackStackCachingCodeGenerator._FILL
+        asm.append(
+            HackStackCachingCodeGenerator._UNARY_OPERATIONS[command_type])
+        cached = True
+      elif (command_type in HackStackCachingCodeGenerator._COMPARISON_JUMPS
+            and not options.shared_comparisons):
+        if not cached:
+          asm += HackStackCachingCodeGenerator._FILL
+        asm += HackStackCachingCodeGenerator._ApplyCachedComparisonTemplate(
+            HackStackCachingCodeGenerator._COMPARISON_JUMPS[command_type],
+            name, number)
+        cached = True
+      elif command_type is IfGotoCommand and cached:
+        asm += [
+            "@%s$%s" % (function_name, command.label_name),
+            "D;JNE"
+        ]
+        cached = False
+      else:
+        if cached:
+          asm += HackStackCachingCodeGenerator._SPILL
+        asm += generators[command_type](command, name, function_name, number)
+        cached = False
+
+      if previous_asm is not None:
+        yield previous_asm
+      previous_asm = asm
+
+    if previous_asm is not None:
+      if cached:
+        previous_asm += HackStackCachingCodeGenerator._SPILL
+      yield previous_asm
+
+  @staticmethod
+  def _LoadToD(command, name):
+    segment, index = command.segment, command.index
+    if segment == "constant":
+      if index in (0, 1):
+        return ["D=%d" % (index,)]
+      return HackCodeGenerator._LoadConstantToD(index)
+    elif segment in ("temp", "pointer"):
+      return HackCodeGenerator._FromMemoryToD(
+          HackCodeGenerator._SEGMENT_MAPPING[segment] + index)
+    elif segment == "static":
+      return HackCodeGenerator._FromMemoryToD("%s.%d" % (name, index))
+    elif segment == "inline":
+      return HackCodeGenerator._FromMemoryToD(
+          "%s.%d" % (HackCodeGenerator._INLINE_VARIABLES, index))
+    segment_base = HackCodeGenerator._SEGMENT_MAPPING[segment]
+    adding = [
+        "@%d" % (segment_base,),
+        "D=M",
+        "@%d" % (index,),
+        "A=D+A",
+        "D=M"
+    ]
+    stepping = HackCodeGenerator._SegmentEntryToA(segment_base, index) + [
+        "D=M"
+    ]
+    return min(adding, stepping, key=len)
+
+  @staticmethod
+  def _StoreFromD(command, name):
+    segment, index = command.segment, command.index
+    if segment in ("temp", "pointer"):
+      return HackCodeGenerator._FromDToMemory(
+          HackCodeGenerator._SEGMENT_MAPPING[segment] + index)
+    elif segment == "static":
+      return HackCodeGenerator._FromDToMemory("%s.%d" % (name, index))
+    elif segment == "inline":
+      return HackCodeGenerator._FromDToMemory(
+          "%s.%d" % (HackCodeGenerator._INLINE_VARIABLES, index))
+
+    # The address of an indirect segment entry has to be computed without
+    # touching D: either by stepping A through the segment, or by parking
+    # the value in R13 and the address in R14. Use whichever is shorter.
+    segment_base = HackCodeGenerator._SEGMENT_MAPPING[segment]
+    stepping = HackCodeGenerator._SegmentEntryToA(segment_base, index) + [
+        "M=D"
+    ]
+    parking = sum([
+        HackCodeGenerator._FromDToMemory(13),
+        [
+            "@%d" % (segment_base,),
+            "D=M",
+            "@%d" % (index,),
+            "D=D+A"
+        ],
+        HackCodeGenerator._FromDToMemory(14),
+        HackCodeGenerator._FromMemoryToD(13),
+        HackCodeGenerator._FromDToMemoryIndirect(14)
+    ], [])
+    return min(stepping, parking, key=len)
+
+  @staticmethod
+  def _ApplyCachedComparisonTemplate(op, name, number):
+    branch_label = "%s$%d$branch" % (name, number)
+    end_label = "%s$%d$end" % (name, number)
+    return [
+        "@SP",
+        "AM=M-1",
+        "D=D-M",
+        "@%s" % (branch_label,),
+        "D;%s" % (op,),
+        "D=0",
+        "@%s" % (end_label,),
+        "0;JMP",
+        "(%s)" % (branch_label,),
+        "D=-1",
+        "(%s)" % (end_label,)
+    ]
+
+
+class HackCommandFuser(object):
+  """This class fuses frequent sequences of VM commands into one command.
+
+  Most statements of a program push one or two values, combine them and pop
+  the result or branch on it, e.g. "push local 0, push constant 1, add, pop
+  local 0". Translated one command at a time, every value takes a trip
+  through the stack in memory. A fused sequence is translated as a whole
+  instead: its values are combined in D and the result is stored or tested
+  right away, so the stack in memory is not touched at all.
+
+  A sequence of commands can be fused if it consists of a push, any number
+  of neg, not or a push followed by add, sub, and or or, and finally either
+  a pop, an if-goto, or a push, a comparison, an optional not and an
+  if-goto. Such a sequence leaves the stack as it found it, so the fused
+  command can take its place with both code generators.
+
+  Only the sequences matching a fusion of the table are fused. A fusion is a
+  (name, pattern) tuple. The pattern is a list of command shapes, each
+  matching one command: the name of the command as written in a VM program,
+  such as "add" or "if-goto", followed by the segment for a push or pop, such
+  as "push local". The segment "*" matches every segment, and alternatives
+  are separated by "|". MineFusions reports frequent sequences that can be
+  fused, but are not, in the same format, so they can be added to the table.
+  """
+
+  _FUSIONS = [
+      # Assignments, e.g. "push argument 0, pop pointer 0".
+      ("move", ["push *", "pop *"]),
+      ("unary", ["push *", "neg|not", "pop *"]),
+      # Assignments of expressions, e.g. increments and array addresses.
+      ("binary", ["push *", "push *", "add|sub|and|or", "pop *"]),
+      # The conditions of if and while statements.
+      ("branch", ["push *", "if-goto"]),
+      ("not-branch", ["push *", "not", "if-goto"]),
+      ("compare-branch", ["push *", "push *", "eq|gt|lt", "if-goto"]),
+      ("compare-not-branch",
+       ["push *", "push *", "eq|gt|lt", "not", "if-goto"])
+  ]
+
+  # The shapes of the commands that can be fused, besides push and pop.
+  _SHAPES = {
+      AddCommand: "add",
+      SubCommand: "sub",
+      NegCommand: "neg",
+      EqCommand: "eq",
+      GtCommand: "gt",
+      LtCommand: "lt",
+      AndCommand: "and",
+      OrCommand: "or",
+      NotCommand: "not",
+      IfGotoCommand: "if-goto"
+  }
+
+  _BINARY_OPERATIONS = frozenset(["add", "sub", "and", "or"])
+
+  # The jump conditions of the comparisons and of their negations, tested on
+  # the second operand minus the first one, exactly as in HackCodeGenerator.
+  _COMPARISON_JUMPS = {
+      "eq": ("JEQ", "JNE"),
+      "gt": ("JLT", "JGE"),
+      "lt": ("JGT", "JLE")
+  }
+
+  # The computations combining the first operand in D with the second one,
+  # either in A or M, or in D with the first one parked in M.
+  _COMBINATIONS = {
+      "add": ("D=D+%s", "D=D+M"),
+      "sub": ("D=D-%s", "D=M-D"),
+      "and": ("D=D&%s", "D=D&M"),
+      "or": ("D=D|%s", "D=D|M"),
+      "eq": ("D=%s-D", "D=D-M"),
+      "gt": ("D=%s-D", "D=D-M"),
+      "lt": ("D=%s-D", "D=D-M")
+  }
+
+  # The compiled tables, see _Compile.
+  _compiled = {}
+
+  def __init__(self, fusions=None, statistics=None):
+    """Creates a fuser.
+
+    Args:
+      fusions: An optional list of fusions replacing the default table.
+      statistics: An optional collections.Counter receiving the number of
+          times each fusion was applied, keyed by "fusion.<fusion name>".
+    """
+    if fusions is None:
+      fusions = HackCommandFuser._FUSIONS
+    if statistics is None:
+      statistics = collections.Counter()
+    self.fusions = fusions
+    self.statistics = statistics
+    self._patterns, self._any_pattern = HackCommandFuser._Compile(fusions)
+
+  def StreamFuse(self, decorated_program_commands):
+    """Lazily fuses the sequences of a stream of decorated commands.
+
+    Empty commands are dropped, since they generate no code.
+
+    Args:
+      decorated_program_commands: An iterable of (command, program_name,
+          enclosing_function, line_number) tuples.
+
+    Yields:
+      The decorated commands, with every fused sequence replaced by a
+      FusedCommand taking over the decoration of its last command.
+    """
+    for function_commands in HackCommandOptimizer._StreamFunctions(
+        decorated_program_commands):
+      for decorated_command in self.Fuse(function_commands):
+        yield decorated_command
+
+  def Fuse(self, decorated_commands):
+    """Fuses the sequences of a list of decorated commands, see StreamFuse."""
+    shapes = [HackCommandFuser.Shape(decorated_command[0])
+              for decorated_command in decorated_commands]
+    text = "\n".join([shape or "-" for shape in shapes]) + "\n"
+    result = []
+    # The commands before start are in result, those before search_start,
+    # whose line starts at search_offset, cannot start a fusion.
+    start = 0
+    search_start = 0
+    search_offset = 0
+    while search_start < len(decorated_commands):
+      match = self._any_pattern.search(text, search_offset)
+      if match is None:
+        break
+      fusion_start = search_start + text.count(
+          "\n", search_offset, match.start())
+      fusion = self._Match(decorated_commands, shapes, text, match,
+                           fusion_start)
+      if fusion is None:
+        search_start = fusion_start + 1
+        search_offset = text.index("\n", match.start()) + 1
+        continue
+      name, length, search_offset = fusion
+      end = fusion_start + length
+      result += decorated_commands[start:fusion_start]
+      result.append((FusedCommand(name, tuple(
+          decorated_command[0]
+          for decorated_command in decorated_commands[fusion_start:end])),) +
+                    decorated_commands[end - 1][1:])
+      self.statistics["fusion." + name] += 1
+      start = search_start = end
+    result += decorated_commands[start:]
+    return result
+
+  def MineFusions(self, programs, max_length=8, limit=10):
+    """Finds the most frequent sequences that could be fused, but are not.
+
+    Args:
+      programs: An iterable of (program_name, program_lines) tuples.
+      max_length: The maximum number of commands of a sequence.
+      limit: The maximum number of sequences to return.
+
+    Returns:
+      A list of (pattern, count) tuples, most frequent first, where pattern
+      is a list with the shape of every command of a sequence, in the format
+      of the fusion table, and count the number of its occurrences.
+
+    Raises:
+      VMError: If a program contains errors.
+    """
+    fuser = HackCommandFuser(self.fusions)
+    counts = collections.Counter()
+    for program_name, program_lines in programs:
+      shapes = [
+          HackCommandFuser.Shape(decorated_command[0])
+          for decorated_command in fuser.StreamFuse(StreamDecorateCommands(
+              StreamParseProgram(program_lines, program_name), program_name))]
+      for start in range(len(shapes)):
+        for end in range(start + 2, min(start + max_length, len(shapes)) + 1):
+          sequence = tuple(shapes[start:end])
+          if HackCommandFuser.IsFusable(sequence):
+            counts[sequence] += 1
+    return [(list(sequence), count)
+            for sequence, count in counts.most_common(limit)]
+
+  @staticmethod
+  def Shape(command):
+    """Returns the shape of a command or None if it cannot be fused."""
+    command_type = command.__class__
+    if command_type is PushCommand:
+      return "push " + command.segment
+    elif command_type is PopCommand:
+      return "pop " + command.segment
+    return HackCommandFuser._SHAPES.get(command_type)
+
+  @staticmethod
+  def IsFusable(shapes):
+    """Checks whether a sequence of command shapes can be fused."""
+    if len(shapes) < 2 or not (shapes[0] or "").startswith("push "):
+      return False
+    position = 1
+    while position < len(shapes):
+      shape = shapes[position] or ""
+      if shape in ("neg", "not"):
+        position += 1
+      elif (shape.startswith("push ") and position + 1 < len(shapes)
+            and shapes[position + 1] in HackCommandFuser._BINARY_OPERATIONS):
+        position += 2
+      else:
+        break
+    end = list(shapes[position:])
+    if len(end) == 1:
+      return end[0] == "if-goto" or (end[0] or "").startswith("pop ")
+    return (len(end) >= 3 and (end[0] or "").startswith("push ")
+            and end[1] in HackCommandFuser._COMPARISON_JUMPS
+            and end[2:] in (["if-goto"], ["not", "if-goto"]))
+
+  @staticmethod
+  def GenerateAsm(command, name, function_name, number):
+    """Generates the code of a FusedCommand.
+
+    The code has the signature of HackCodeGenerator.GenerateAsm.
+    """
+    commands = command.commands
+    asm = list(HackStackCachingCodeGenerator._LoadToD(commands[0], name))
+    comparison = None
+    jump = "JNE"
+    position = 1
+    while position < len(commands):
+      current = commands[position]
+      shape = HackCommandFuser.Shape(current)
+      position += 1
+      if shape == "not" and comparison is not None:
+        # The negation of a comparison negates its jump condition.
+        jump = HackCommandFuser._COMPARISON_JUMPS[comparison][1]
+      elif shape in ("neg", "not"):
+        asm.append(HackStackCachingCodeGenerator._UNARY_OPERATIONS[
+            current.__class__])
+      elif shape.startswith("push "):
+        operation = HackCommandFuser.Shape(commands[position])
+        asm += HackCommandFuser._Combine(current, operation, name)
+        if operation in HackCommandFuser._COMPARISON_JUMPS:
+          comparison = operation
+          jump = HackCommandFuser._COMPARISON_JUMPS[operation][0]
+        position += 1
+      elif shape == "if-goto":
+        asm += ["@%s$%s" % (function_name, current.label_name), "D;" + jump]
+      else:
+        asm += HackStackCachingCodeGenerator._StoreFromD(current, name)
+    return asm
+
+  @staticmethod
+  def _Combine(command, operation, name):
+    # Returns the code combining the value in D with the value pushed by
+    # command by operation. The second value is either used as a constant,
+    # addressed without touching D, or loaded into D after parking the first
+    # one in R13, whichever is shortest.
+    with_second, with_parked_first = HackCommandFuser._COMBINATIONS[operation]
+    segment, index = command.segment, command.index
+    candidates = [
+        HackCodeGenerator._FromDToMemory(13) +
+        HackStackCachingCodeGenerator._LoadToD(command, name) +
+        ["@13", with_parked_first]
+    ]
+    if segment == "constant":
+      candidates.append(["@%d" % (index,), with_second % ("A",)])
+    else:
+      if segment in ("temp", "pointer"):
+        address = [
+            "@%d" % (HackCodeGenerator._SEGMENT_MAPPING[segment] + index,)]
+      elif segment == "static":
+        address = ["@%s.%d" % (name, index)]
+      elif segment == "inline":
+        address = [
+            "@%s.%d" % (HackCodeGenerator._INLINE_VARIABLES, index)]
+      else:
+        address = HackCodeGenerator._SegmentEntryToA(
+            HackCodeGenerator._SEGMENT_MAPPING[segment], index)
+      candidates.append(address + [with_second % ("M",)])
+    return min(candidates, key=len)
+
+  @staticmethod
+  def _Compile(fusions):
+    # Returns the (patterns, any_pattern) of a table. The patterns are
+    # matched against the shapes of the commands, one per line. patterns is
+    # a list of (name, length, expression) tuples, longest fusion first,
+    # and any_pattern finds the lines where any of them starts. Every table
+    # is only compiled once.
+    key = tuple((name, tuple(pattern)) for name, pattern in fusions)
+    compiled = HackCommandFuser._compiled.get(key)
+    if compiled is None:
+      patterns = [
+          (name, len(pattern), re.compile("".join(
+              HackCommandFuser._ShapeExpression(shapes)
+              for shapes in pattern)))
+          for name, pattern in sorted(
+              fusions, key=lambda fusion: -len(fusion[1]))]
+      any_pattern = re.compile("(?m)^(?:%s)" % ("|".join(
+          "(?P<f%d>%s)" % (number, expression.pattern)
+          for number, (_, _, expression) in enumerate(patterns)) or "(?!)",))
+      compiled = (patterns, any_pattern)
+      HackCommandFuser._compiled[key] = compiled
+    return compiled
+
+  @staticmethod
+  def _ShapeExpression(shapes):
+    # Returns a regular expression matching the line of a command whose
+    # shape is one of the alternatives in shapes.
+    alternatives = []
+    for shape in shapes.split("|"):
+      if shape.endswith(" *"):
+        alternatives.append(re.escape(shape[:-1]) + "[^\n]+")
+      else:
+        alternatives.append(re.escape(shape))
+    return "(?:%s)\n" % ("|".join(alternatives),)
+
+  def _Match(self, decorated_commands, shapes, text, match, start):
+    # Returns the (name, length, end_offset) of the first fusion matching the
+    # commands at start or None, given the match of the line of the command
+    # at start in text by _any_pattern. end_offset is the offset of the line
+    # following the fusion. All commands have to come from the same
+    # function of the same program.
+    offset = match.start()
+    for name, length, expression in self._patterns[
+        int(match.lastgroup[1:]):]:
+      end = start + length
+      fusion_match = expression.match(text, offset)
+      if fusion_match is None:
+        continue
+      decoration = decorated_commands[start][1:3]
+      if (all(decorated_command[1:3] == decoration
+              for decorated_command in decorated_commands[start:end])
+          and HackCommandFuser.IsFusable(shapes[start:end])):
+        return (name, length, fusion_match.end())
+    return None
+
+
+class HackPeepholeOptimizer(object):
+  """This class rewrites the generated assembly into cheaper sequences.
+
+  The code generator composes templates without looking at their neighbors,
+  so e.g. a push directly followed by a pop stores a value on the stack only
+  to load it back. The optimizer slides a small window over the instruction
+  stream and replaces the instructions at the end of the window whenever
+  they match one of its rules, repeating until no rule matches. Labels are
+  never matched, so no rule rewrites code across a jump target.
+
+  A rule is a (name, pattern, replacement) tuple. The pattern is a list of
+  regular expressions, each matching one full instruction; the expressions
+  are matched as one, so a group captured by an earlier expression can be
+  referred to by a later one. The replacement is a list of instructions
+  which may refer to the groups as well.
+  """
+
+  _RULES = [
+      # A push to the stack directly followed by a pop into D: D already
+      # holds the value, but A has to point to the top of the stack.
+      ("push-pop",
+       ["@SP", "A=M", "M=D", "@SP", r"M=M\+1",
+        "@SP", "M=M-1", "A=M", "D=M"],
+       ["@SP", "A=M"]),
+      # The same with the stack pointer decremented and loaded at once, as
+      # in the pops of the first entries of a segment.
+      ("push-pop-decrement",
+       ["@SP", "A=M", "M=D", "@SP", r"M=M\+1", "@SP", "AM=M-1", "D=M"],
+       ["@SP", "A=M"]),
+      # A push directly followed by a pop to an argument, local, this or that
+      # entry: the value is parked at the top of the stack while the target
+      # address is computed, so the stack pointer does not have to change.
+      ("push-pop-indirect",
+       ["@SP", "A=M", "M=D", "@SP", r"M=M\+1",
+        r"(@\d+)", "D=M", r"(@\d+)", r"D=D\+A", "@13", "M=D",
+        "@SP", "M=M-1", "A=M", "D=M", "@13", "A=M", "M=D"],
+       ["@SP", "A=M", "M=D",
+        r"\1", "D=M", r"\2", "D=D+A", "@13", "M=D",
+        "@SP", "A=M", "D=M", "@13", "A=M", "M=D"]),
+      # Loading a value that was just stored from D.
+      ("store-load",
+       ["(@.+)", "M=D", r"\1", "D=M"],
+       [r"\1", "M=D"]),
+      ("address-decrement",
+       ["A=M", "A=A-1"],
+       ["A=M-1"]),
+      # An address computation that is overwritten before it is used.
+      ("dead-address",
+       ["A=[^;]*", "(@.+)"],
+       [r"\1"]),
+      ("dead-load",
+       ["@.+", "(@.+)"],
+       [r"\1"])
+  ]
+
+  def __init__(self, rules=None, statistics=None):
+    """Creates an optimizer.
+
+    Args:
+      rules: An optional list of rules replacing the default rules.
+      statistics: An optional collections.Counter receiving the number of
+          times each rule was applied, keyed by "peephole.<rule name>".
+    """
+    if rules is None:
+      rules = HackPeepholeOptimizer._RULES
+    if statistics is None:
+      statistics = collections.Counter()
+    self.statistics = statistics
+    self._rules = []
+    for name, pattern, replacement in rules:
+      self._rules.append((
+          "peephole." + name,
+          len(pattern),
+          re.compile(pattern[-1] + r"\Z"),
+          re.compile("\n".join(pattern) + r"\Z"),
+          "\n".join(replacement)))
+    self._window_size = max(rule[1] for rule in self._rules)
+
+  def Optimize(self, program_asm):
+    """Lazily rewrites a stream of Hack assembly instructions.
+
+    Args:
+      program_asm: An iterable of Hack assembly strings.
+
+    Yields:
+      The rewritten Hack assembly strings.
+    """
+    window = []
+    for instruction in program_asm:
+      window.append(instruction)
+      self._Rewrite(window)
+      while len(window) > self._window_size:
+        yield window.pop(0)
+    for instruction in window:
+      yield instruction
+
+  def OptimizeTagged(self, tagged_asm):
+    """Like Optimize, but keeps track of the origin of every instruction.
+
+    Instructions produced by a rule take the origins of the instructions
+    they replace, aligned at the end of the window: the rules mostly drop
+    instructions that lead up to the last one.
+
+    Args:
+      tagged_asm: An iterable of (instruction, origin) tuples.
+
+    Yields:
+      (instruction, origin) tuples with the rewritten instructions.
+    """
+    window = []
+    origins = []
+    for instruction, origin in tagged_asm:
+      window.append(instruction)
+      origins.append(origin)
+      self._Rewrite(window, origins)
+      while len(window) > self._window_size:
+        yield (window.pop(0), origins.pop(0))
+    for tagged_instruction in zip(window, origins):
+      yield tagged_instruction
+
+  def _Rewrite(self, window, origins=None):
+    rewritten = True
+    while rewritten and window:
+      rewritten = False
+      for name, length, last_pattern, pattern, replacement in self._rules:
+        if length > len(window) or not last_pattern.match(window[-1]):
+          continue
+        match = pattern.match("\n".join(window[-length:]))
+        if match:
+          replacement = match.expand(replacement)
+          instructions = replacement.split("\n") if replacement else []
+          window[-length:] = instructions
+          if origins is not None:
+            replaced_origins = origins[-length:]
+            if len(instructions) > length:
+              replaced_origins[:0] = replaced_origins[:1] * (
+                  len(instructions) - length)
+            origins[-length:] = replaced_origins[
+                len(replaced_origins) - len(instructions):]
+          self.statistics[name] += 1
+          rewritten = True
+          break
+
+
+class LinkPlan(object):
+  """Whole-program decisions shared by the translation of all programs.
+
+  Programs are translated independently of each other, possibly in other
+  processes, so everything the linker decides by looking at all programs at
+  once is collected up front in a plan that accompanies every program.
+
+  Attributes:
+    dead_functions: A dict mapping program names to sets with the names of
+        the functions defined in the program that can never be called.
+    inline_functions: A dict mapping the names of the functions whose calls
+        are inlined to InlineFunction instances.
+    line_counts: A dict mapping program names to their number of lines.
+  """
+
+  def __init__(self, dead_functions=None, inline_functions=None,
+               line_counts=None):
+    self.dead_functions = dead_functions or {}
+    self.inline_functions = inline_functions or {}
+    self.line_counts = line_counts or {}
+    digest = hashlib.sha1()
+    for function_name in sorted(self.inline_functions):
+      inline_function = self.inline_functions[function_name]
+      digest.update("%s\0%s\0%d\0%d\0%r\0%r\0" % (
+          function_name, inline_function.program_name,
+          inline_function.arguments, inline_function.local_variables,
+          inline_function.saved_pointers, inline_function.uses_static))
+      for command in inline_function.commands:
+        digest.update("%s%r\0" % (
+            command.__class__.__name__, CommandFields(command)))
+    self._inline_digest = digest.hexdigest()
+
+  def DeadFunctions(self, program_name):
+    """Returns the set of functions of a program that are not translated."""
+    return self.dead_functions.get(program_name, frozenset())
+
+  def Fingerprint(self, program_name):
+    """Returns a string identifying the plan for a program, e.g. for keys."""
+    return "%s;%s" % (",".join(sorted(self.DeadFunctions(program_name))),
+                      self._inline_digest)
+
+
+class TranslationProfile(object):
+  """Records where the translation of programs spends its time.
+
+  Every phase of the pipeline is timed separately for every program. The
+  phases are chained generators, so a phase is timed whenever it is asked
+  for its next element, and the time spent in the phases feeding it is
+  subtracted. The phases therefore add up to the total time of the
+  translation. With several workers the phases of every program are timed
+  in the worker translating it, and the time spent waiting for the workers
+  counts towards the phase consuming their output.
+
+  Python 2 cannot trace allocations, so the memory use is sampled: whenever
+  a phase of a program finishes, the peak resident set size of the process
+  is recorded.
+
+  Attributes:
+    records: A collections.OrderedDict mapping (phase, program_name) tuples
+        to dicts with the "seconds" spent in the phase, the number of
+        "items" it produced and the "peak_rss" in kilobytes. program_name is
+        None for phases that concern all programs.
+  """
+
+  # The number of the slowest programs listed by Summary.
+  _SUMMARY_PROGRAMS = 10
+
+  def __init__(self):
+    self.records = collections.OrderedDict()
+    # The time spent in nested phases, one entry per running phase.
+    self._nested = []
+
+  def Wrap(self, phase, program_name, iterable):
+    """Times the iteration over iterable as phase of program_name.
+
+    Args:
+      phase: The name of the phase.
+      program_name: The name of the program or None.
+      iterable: The output of the phase.
+
+    Returns:
+      An iterator over the elements of iterable.
+    """
+    # The record is created right away, so that the records are ordered
+    # like the phases of the pipeline rather than like their first use.
+    return self._Time(self._Record(phase, program_name), iter(iterable))
+
+  @contextlib.contextmanager
+  def Measure(self, phase, program_name=None, items=0):
+    """A context manager timing its body as phase of program_name.
+
+    Args:
+      phase: The name of the phase.
+      program_name: The name of the program or None.
+      items: The number of items to add to the record.
+    """
+    record = self._Record(phase, program_name)
+    record["items"] += items
+    self._nested.append(0.0)
+    start = time.time()
+    try:
+      yield
+    finally:
+      self._Finish(record, time.time() - start)
+
+  def Update(self, profile):
+    """Adds the records of another profile, e.g. from a worker process."""
+    for key, other_record in profile.records.items():
+      record = self._Record(*key)
+      record["seconds"] += other_record["seconds"]
+      record["items"] += other_record["items"]
+      record["peak_rss"] = max(record["peak_rss"], other_record["peak_rss"])
+
+  def ToJson(self):
+    """Returns the profile as a dict that can be serialized as JSON."""
+    phases = collections.OrderedDict()
+    programs = collections.OrderedDict()
+    for (phase, program_name), record in self.records.items():
+      for totals, name in ((phases, phase), (programs, program_name)):
+        if name is None:
+          continue
+        total = totals.setdefault(name, collections.OrderedDict(
+            [("seconds", 0.0), ("peak_rss", 0)]))
+        total["seconds"] += record["seconds"]
+        total["peak_rss"] = max(total["peak_rss"], record["peak_rss"])
+      if phase in ("read", "parse") and program_name is not None:
+        programs[program_name][
+            "lines" if phase == "read" else "commands"] = record["items"]
+      phases[phase]["items"] = (
+          phases[phase].get("items", 0) + record["items"])
+    return collections.OrderedDict([
+        ("seconds", sum(phase["seconds"] for phase in phases.values())),
+        ("peak_rss", max([phase["peak_rss"] for phase in phases.values()] +
+                         [0])),
+        ("phases", phases),
+        ("programs", programs),
+        ("records", [
+            collections.OrderedDict(
+                [("phase", phase), ("program", program_name)] +
+                sorted(record.items()))
+            for (phase, program_name), record in self.records.items()])
+    ])
+
+  def Summary(self):
+    """Returns a human readable summary of the profile as a string."""
+    profile = self.ToJson()
+    total_seconds = max(profile["seconds"], 1e-9)
+    lines = ["%-12s %10s %6s %10s" % ("phase", "seconds", "%", "items")]
+    for phase, total in profile["phases"].items():
+      lines.append("%-12s %10.4f %5.1f%% %10d" % (
+          phase, total["seconds"], 100.0 * total["seconds"] / total_seconds,
+          total["items"]))
+    lines.append("%-12s %10.4f" % ("total", profile["seconds"]))
+    lines.append("peak memory: %d KB" % (profile["peak_rss"],))
+    slowest = sorted(profile["programs"].items(),
+                     key=lambda item: -item[1]["seconds"])
+    for program_name, total in slowest[:TranslationProfile._SUMMARY_PROGRAMS]:
+      lines.append("%s: %.4f seconds, %d lines, %d commands" % (
+          program_name, total["seconds"], total.get("lines", 0),
+          total.get("commands", 0)))
+    return os.linesep.join(lines)
+
+  def _Record(self, phase, program_name):
+    record = self.records.get((phase, program_name))
+    if record is None:
+      record = {"seconds": 0.0, "items": 0, "peak_rss": 0}
+      self.records[(phase, program_name)] = record
+    return record
+
+  def _Time(self, record, iterator):
+    # Yields the elements of iterator, timing every step into record.
+    nested = self._nested
+    clock = time.time
+    while True:
+      nested.append(0.0)
+      start = clock()
+      try:
+        element = next(iterator)
+      except StopIteration:
+        self._Finish(record, clock() - start)
+        return
+      except:
+        self._Finish(record, clock() - start)
+        raise
+      elapsed = clock() - start
+      record["seconds"] += elapsed - nested.pop()
+      record["items"] += 1
+      if nested:
+        nested[-1] += elapsed
+      yield element
+
+  def _Finish(self, record, elapsed):
+    # Ends the timing of a phase started by pushing onto _nested.
+    record["seconds"] += elapsed - self._nested.pop()
+    if self._nested:
+      self._nested[-1] += elapsed
+    record["peak_rss"] = max(
+        record["peak_rss"],
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+class SourceMap(object):
+  """Maps the ROM addresses of a translated program to VM source lines.
+
+  Consecutive ROM words generated from the same VM command form a run, and
+  only the first address and the origin of every run are kept, so a lookup
+  is a binary search over the starts of the runs. The origin of a word is a
+  (program_name, line_number, function_name) tuple, with line numbers
+  starting at 1, or None for the bootstrap code. The code of an inlined
+  call is attributed to the line of the call.
+
+  Attributes:
+    starts: A list with the first ROM address of every run.
+    origins: A list with the origin of every run.
+    rom_words: The number of ROM words covered by the map.
+  """
+
+  _FORMAT_VERSION = 1
+
+  def __init__(self):
+    self.starts = []
+    self.origins = []
+    self.rom_words = 0
+
+  def Record(self, tagged_asm):
+    """Records the origins of a stream of (instruction, origin) tuples.
+
+    Args:
+      tagged_asm: An iterable of (instruction, origin) tuples, with origin
+          being the origin of the ROM word of the instruction.
+
+    Yields:
+      The instructions.
+    """
+    starts = self.starts
+    origins = self.origins
+    for instruction, origin in tagged_asm:
+      if not instruction.startswith("("):
+        if not origins or origins[-1] != origin:
+          starts.append(self.rom_words)
+          origins.append(origin)
+        self.rom_words += 1
+      yield instruction
+
+  def Extend(self, source_map):
+    """Appends the runs of a map of the code that follows the mapped code."""
+    for start, origin in zip(source_map.starts, source_map.origins):
+      if not self.origins or self.origins[-1] != origin:
+        self.starts.append(self.rom_words + start)
+        self.origins.append(origin)
+    self.rom_words += source_map.rom_words
+
+  def Lookup(self, address):
+    """Returns the origin of the ROM word at address or None."""
+    if not 0 <= address < self.rom_words:
+      return None
+    return self.origins[bisect.bisect_right(self.starts, address) - 1]
+
+  def Write(self, map_file):
+    """Writes the map as JSON.
+
+    The names of programs and functions are stored once in tables, and the
+    runs are stored as one flat list of (start, program index, line number,
+    function index) integers, with -1 as the program and function index of
+    words without an origin.
+
+    Args:
+      map_file: A file object opened for writing.
+    """
+    program_indices = {}
+    function_indices = {}
+    runs = []
+    for start, origin in zip(self.starts, self.origins):
+      if origin is None:
+        runs += [start, -1, 0, -1]
+        continue
+      program_name, line_number, function_name = origin
+      runs += [
+          start,
+          program_indices.setdefault(program_name, len(program_indices)),
+          line_number,
+          function_indices.setdefault(function_name, len(function_indices))
+      ]
+    json.dump(collections.OrderedDict([
+        ("version", SourceMap._FORMAT_VERSION),
+        ("rom_words", self.rom_words),
+        ("programs", sorted(program_indices, key=program_indices.get)),
+        ("functions", sorted(function_indices, key=function_indices.get)),
+        ("runs", runs)
+    ]), map_file, separators=(",", ":"))
+
+  @staticmethod
+  def Read(map_file):
+    """Reads a map written by Write.
+
+    Args:
+      map_file: A file object opened for reading.
+
+    Returns:
+      A SourceMap instance.
+
+    Raises:
+      ValueError: If the file does not contain a map.
+    """
+    contents = json.load(map_file)
+    if contents.get("version") != SourceMap._FORMAT_VERSION:
+      raise ValueError("Unsupported source map version")
+    source_map = SourceMap()
+    source_map.rom_words = contents["rom_words"]
+    runs = contents["runs"]
+    for offset in range(0, len(runs), 4):
+      start, program_index, line_number, function_index = (
+          runs[offset:offset + 4])
+      origin = None
+      if program_index >= 0:
+        origin = (str(contents["programs"][program_index]), line_number,
+                  str(contents["functions"][function_index]))
+      source_map.starts.append(start)
+      source_map.origins.append(origin)
+    return source_map
+
+
+class ProgramFile(object):
+  """The lines of a .vm file, read lazily whenever they are iterated.
+
+  Every iteration opens the file and yields its lines one at a time, so the
+  lines never have to be held in memory as a whole. A ProgramFile can be
+  iterated several times, e.g. by the link plan and by the translation, and
+  it is cheap to send to a worker process, which then reads the file
+  itself.
+
+  Attributes:
+    path: The name of the file.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self._line_count = None
+
+  def __iter__(self):
+    line_count = 0
+    with open(self.path, "r") as program_file:
+      for line in program_file:
+        line_count += 1
+        yield line
+    self._line_count = line_count
+
+  def __len__(self):
+    if self._line_count is None:
+      self._line_count = sum(1 for _ in self)
+    return self._line_count
+
+
+def AssemblyCacheKey(program_name, program_lines, options=None, plan=None):
+  """Computes the key of the cached assembly of a program.
+
+  Args:
+    program_name: The name of the file that contains the program.
+    program_lines: An iterable of strings with the lines of the program.
+    options: The TranslationOptions the program is translated with.
+    plan: The LinkPlan the program is translated with.
+
+  Returns:
+    A string with the hex digest identifying the program.
+  """
+  if options is None:
+    options = TranslationOptions()
+  if plan is None:
+    plan = LinkPlan()
+  digest = hashlib.sha1()
+  digest.update("%s\0%s\0%s\0%s\0" % (
+      __version__, options.Fingerprint(), plan.Fingerprint(program_name),
+      program_name))
+  for line in program_lines:
+    digest.update(line)
+    digest.update("\0")
+  return digest.hexdigest()
+
+
+class AssemblyCache(object):
+  """An on-disk cache with the generated assembly of individual programs.
+
+  Every entry holds the assembly of one VM program and is keyed by a hash of
+  the program name, the program lines, the translator version, the
+  translation options and the link plan, so that a program only has to be
+  translated again when one of them changes. The total size of the entries
+  is capped; when the cap is exceeded the least recently used entries are
+  evicted. Recency is tracked through the modification time of the entry
+  files, which is updated on every hit.
+  """
+
+  _ENTRY_SUFFIX = ".asm"
+
+  def __init__(self, directory, max_bytes=_DEFAULT_CACHE_BYTES):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+  def Key(self, program_name, program_lines, options=None, plan=None):
+    """Computes the key of the entry for a program, see AssemblyCacheKey."""
+    return AssemblyCacheKey(program_name, program_lines, options, plan)
+
+  def Lookup(self, key):
+    """Checks whether there is an entry for key and records a hit or miss."""
+    if os.path.isfile(self._EntryPath(key)):
+      self.hits += 1
+      return True
+    self.misses += 1
+    return False
+
+  def Get(self, key):
+    """Returns the cached assembly for key or None if there is no entry."""
+    try:
+      with open(self._EntryPath(key), "r") as entry_file:
+        content = entry_file.read()
+      os.utime(self._EntryPath(key), None)
+    except (IOError, OSError):
+      return None
+    return content.split("\n") if content else []
+
+  def Put(self, key, program_asm):
+    """Stores the assembly instructions of a program under key."""
+    temporary_path = "%s.%d.tmp" % (self._EntryPath(key), os.getpid())
+    with open(temporary_path, "w") as entry_file:
+      entry_file.write("\n".join(program_asm))
+    os.rename(temporary_path, self._EntryPath(key))
+
+  def Trim(self):
+    """Evicts the least recently used entries until the size cap is met."""
+    entries = []
+    total_bytes = 0
+    for file_name in os.listdir(self.directory):
+      if file_name.endswith(AssemblyCache._ENTRY_SUFFIX):
+        path = os.path.join(self.directory, file_name)
+        try:
+          status = os.stat(path)
+        except OSError:
+          continue
+        entries.append((status.st_mtime, status.st_size, path))
+        total_bytes += status.st_size
+
+    entries.sort()
+    for _, size, path in entries:
+      if total_bytes <= self.max_bytes:
+        break
+      try:
+        os.remove(path)
+      except OSError:
+        continue
+      total_bytes -= size
+      self.evictions += 1
+
+  def Statistics(self):
+    """Returns a human readable summary of the cache activity."""
+    return "Cache: %d hits, %d misses, %d evictions" % (
+        self.hits, self.misses, self.evictions)
+
+  def _EntryPath(self, key):
+    return os.path.join(self.directory, key + AssemblyCache._ENTRY_SUFFIX)
+
+
+def StreamParseProgram(program_lines, program_name):
+  """Lazily transforms the lines of a VM program into parsed commands.
+
+  Commands are yielded as soon as their line is parsed, so the program never
+  has to be held in memory as a whole. Erroneous lines are not yielded; they
+  are collected instead and reported once all lines have been consumed.
+
+  Args:
+    program_lines: An iterable of strings with the VM program.
+    program_name: the name of the file containing the program.
+
+  Yields:
+    Parsed commands.
+
+  Raises:
+    VMError: If parsing results in an ErrorCommand.
+  """
+  errors = []
+  commands = HackParser.StreamLines(program_lines)
+  for line_number, command in enumerate(commands):
+    if command.__class__.__name__ == "ErrorCommand":
+      errors.append(
+          "%s.%d: %s" % (program_name, line_number + 1, command.line))
+    else:
+      yield command
+
+  if len(errors) > 0:
+    raise VMError("Error: " + os.linesep.join(errors))
+
+
+def ParseProgram(program_lines, program_name):
+  """Transforms the lines of a VM program to a list of parsed commands.
+
+  Args:
+    program_line: A list of strings with the VM program.
+    program_name: the name of the file containing the program.
+
+  Returns:
+    A list of parsed commands.
 
   Raises:
     VMError: If parsing results in an ErrorCommand.
   """
-  program_commands = map(HackParser.ParseCommand, program_lines)
-  
+  program_commands = HackParser.ParseLines(program_lines)
+
   errors = []
   for line_number in range(len(program_commands)):
     command = program_commands[line_number]
@@ -779,36 +2808,80 @@ def IdentifyParentFunctions(program_commands):
   return parent_functions
 
 
+def StreamDecorateCommands(program_commands, program_name):
+  """Lazily decorates a stream of program commands.
+
+  Empty commands are dropped, so the later stages never see them, but the
+  line numbers still count them.
+
+  Args:
+    program_commands: An iterable of command type instances, one per line.
+    program_name: The name of the file containing the commands.
+
+  Yields:
+    (command, program_name, enclosing_function, line_number) tuples.
+  """
+  current_function = "DEFAULT_FUNCTION"
+  for line_number, command in enumerate(program_commands):
+    command_type = command.__class__
+    if command_type is EmptyCommand:
+      continue
+    if command_type is FunctionCommand:
+      current_function = command.function_name
+    yield (command, program_name, current_function, line_number)
+
+
 def DecorateCommands(program_commands, program_name):
   """Decorates a list of program commands.
 
   Args:
-    program_commands: A list of command type instances.
+    program_commands: A list of command type instances, one per line.
     program_name: The name of the file containing the commands.
 
   Returns:
-    A list of (command, program_name, enclosing_function, line_number) tuples.
+    A list of (command, program_name, enclosing_function, line_number) tuples
+    for the commands that are not empty.
   """
-  return zip(
-      program_commands,
-      [program_name] * len(program_commands),
-      IdentifyParentFunctions(program_commands),
-      range(len(program_commands)))
+  return list(StreamDecorateCommands(program_commands, program_name))
 
 
-def GenerateAsm(decorated_program_commands):
+def StreamGenerateAsm(decorated_program_commands, options=None):
+  """Lazily transforms decorated commands into assembly instruction lists.
+
+  Args:
+    decorated_program_commands: An iterable of (command, program_name,
+        enclosing_function, line_number) tuples.
+    options: An optional TranslationOptions instance.
+
+  Yields:
+    Sequences of Hack assembly instruction strings, one per command. They
+    may be shared between commands and must not be modified.
+  """
+  if options is None:
+    options = TranslationOptions()
+  if options.stack_caching:
+    for asm in HackStackCachingCodeGenerator.StreamGenerateAsm(
+        decorated_program_commands, options):
+      yield asm
+    return
+  generators = HackCodeGenerator.GetGenerators(options)
+  for command, name, function_name, number in decorated_program_commands:
+    yield generators[command.__class__](command, name, function_name, number)
+
+
+def GenerateAsm(decorated_program_commands, options=None):
   """Transforms the command list into a list of assembly instruction lists.
 
   Args:
     decorated_program_commands: A list of (command, program_name,
         enclosing_function, line_number) tuples.
+    options: An optional TranslationOptions instance.
 
   Returns:
-    A list of lists containing Hack assembly instruction strings.
+    A list with a sequence of Hack assembly instruction strings for every
+    command, see StreamGenerateAsm.
   """
-  return map(
-      lambda c: HackCodeGenerator.GenerateAsm(c[0], c[1], c[2], c[3]),
-      decorated_program_commands)
+  return list(StreamGenerateAsm(decorated_program_commands, options))
 
 
 def FlattenAsm(asm_chunks):
@@ -820,87 +2893,856 @@ def FlattenAsm(asm_chunks):
   Returns:
     A list of Hack assembly instruction strings.
   """
-  return sum(asm_chunks, [])
+  return list(itertools.chain.from_iterable(asm_chunks))
+
+
+def _StreamTaggedAsm(decorated_program_commands, options, call_sites):
+  """Like StreamGenerateAsm, but yields (instruction, origin) tuples.
+
+  The origin of an instruction is the (program_name, line_number,
+  function_name) tuple of the command it was generated for, see SourceMap.
+  """
+  pending = collections.deque()
+
+  def Track(decorated_commands):
+    for decorated_command in decorated_commands:
+      pending.append(decorated_command)
+      yield decorated_command
+
+  # Every command results in one list of instructions, but a generator may
+  # look at the next command before it yields the list of the current one.
+  for asm in StreamGenerateAsm(Track(decorated_program_commands), options):
+    _, name, function_name, number = pending.popleft()
+    origin = (name, call_sites.get(number, number) + 1, function_name)
+    for instruction in asm:
+      yield (instruction, origin)
+
+
+def _StreamLiveCommands(
+    decorated_program_commands, dead_functions, options, statistics):
+  """Drops the decorated commands of the functions in dead_functions.
+
+  The ROM words the code of every dropped function would have occupied are
+  recorded in statistics under "dead-function.<function name>".
+  """
+  generators = HackCodeGenerator.GetGenerators(options)
+  for decorated_command in decorated_program_commands:
+    function_name = decorated_command[2]
+    if function_name not in dead_functions:
+      yield decorated_command
+    elif statistics is not None:
+      command = decorated_command[0]
+      statistics["dead-function." + function_name] += CountRomWords(
+          generators[command.__class__](*decorated_command))
+
+
+def _Profiled(profile, phase, program_name, iterable):
+  """Times iterable as phase of program_name if there is a profile."""
+  if profile is None:
+    return iterable
+  return profile.Wrap(phase, program_name, iterable)
+
+
+def StreamAssembleProgram(
+    program_lines, program_name, options=None, statistics=None, plan=None,
+    profile=None, source_map=None):
+  """Lazily transforms the lines of a VM program into assembly instructions.
+
+  This is the streaming counterpart of AssembleProgram: every stage of the
+  pipeline (parse, decorate, optimize, code generation) consumes its input
+  one command or at most one function at a time, so the program is never
+  held in memory as a whole.
+
+  Args:
+    program_lines: An iterable of strings representing a VM program.
+    program_name: The name of the file that contains the program.
+    options: An optional TranslationOptions instance.
+    statistics: An optional collections.Counter receiving statistics about
+        the optimizations applied to the program.
+    plan: An optional LinkPlan with the decisions taken for all programs.
+    profile: An optional TranslationProfile timing every phase.
+    source_map: An optional SourceMap receiving the origins of the
+        instructions as they are generated.
+
+  Returns:
+    An iterator over Hack assembly instruction strings.
+  """
+  program_commands = StreamParseProgram(
+      _Profiled(profile, "read", program_name, program_lines), program_name)
+  decorated_commands = _Profiled(
+      profile, "decorate", program_name, StreamDecorateCommands(
+          _Profiled(profile, "parse", program_name, program_commands),
+          program_name))
+  return StreamAssembleCommands(
+      decorated_commands, program_name, options, statistics, plan, profile,
+      source_map)
 
 
-def AssembleProgram(program_lines, program_name):
+def StreamAssembleCommands(
+    decorated_program_commands, program_name, options=None, statistics=None,
+    plan=None, profile=None, source_map=None):
+  """Lazily transforms decorated commands into assembly instructions.
+
+  This runs the stages of StreamAssembleProgram that follow the decoration,
+  e.g. for commands that were parsed before.
+
+  Args:
+    decorated_program_commands: An iterable of (command, program_name,
+        enclosing_function, line_number) tuples.
+    program_name: The name of the file that contains the commands.
+    options: An optional TranslationOptions instance.
+    statistics: An optional collections.Counter receiving statistics about
+        the optimizations applied to the program.
+    plan: An optional LinkPlan with the decisions taken for all programs.
+    profile: An optional TranslationProfile timing every phase.
+    source_map: An optional SourceMap receiving the origins of the
+        instructions as they are generated.
+
+  Returns:
+    An iterator over Hack assembly instruction strings.
+  """
+  if options is None:
+    options = TranslationOptions()
+  call_sites = {}
+
+  def Profiled(phase, iterable):
+    return _Profiled(profile, phase, program_name, iterable)
+
+  decorated_commands = decorated_program_commands
+  if plan is not None and plan.DeadFunctions(program_name):
+    decorated_commands = Profiled("dead-code", _StreamLiveCommands(
+        decorated_commands, plan.DeadFunctions(program_name), options,
+        statistics))
+  if plan is not None and plan.inline_functions:
+    decorated_commands = Profiled("inline", HackFunctionInliner.StreamInline(
+        decorated_commands, plan.inline_functions,
+        plan.line_counts.get(program_name, 0), statistics,
+        call_sites if source_map is not None else None))
+  if options.optimize_commands:
+    decorated_commands = Profiled(
+        "optimize", HackCommandOptimizer.StreamOptimize(
+            decorated_commands, statistics))
+  if options.fuse_commands:
+    decorated_commands = Profiled("fuse", HackCommandFuser(
+        statistics=statistics).StreamFuse(decorated_commands))
+  if source_map is not None:
+    tagged_asm = Profiled("generate", _StreamTaggedAsm(
+        decorated_commands, options, call_sites))
+    if options.peephole:
+      tagged_asm = Profiled("peephole", HackPeepholeOptimizer(
+          statistics=statistics).OptimizeTagged(tagged_asm))
+    return Profiled("source-map", source_map.Record(tagged_asm))
+  program_asm = Profiled("flatten", itertools.chain.from_iterable(
+      Profiled("generate", StreamGenerateAsm(decorated_commands, options))))
+  if options.peephole:
+    program_asm = Profiled("peephole", HackPeepholeOptimizer(
+        statistics=statistics).Optimize(program_asm))
+  return program_asm
+
+
+def AssembleProgram(
+    program_lines, program_name, options=None, statistics=None, plan=None,
+    profile=None, source_map=None):
   """Transforms the lines of a VM program into a list of assembly instructions.
 
   Args:
     program_lines: A list of strings representing the lines of a VM program.
     program_name: The name of the file that contains the program.
+    options: An optional TranslationOptions instance.
+    statistics: An optional collections.Counter receiving statistics about
+        the optimizations applied to the program.
+    plan: An optional LinkPlan with the decisions taken for all programs.
+    profile: An optional TranslationProfile timing every phase.
+    source_map: An optional SourceMap receiving the origins of the
+        instructions.
 
   Returns:
     A list of Hack assembly instruction strings.
   """
-  return FlattenAsm(
-      GenerateAsm(
-          DecorateCommands(
-              ParseProgram(program_lines, program_name),
-              program_name)))
+  return list(StreamAssembleProgram(
+      program_lines, program_name, options, statistics, plan, profile,
+      source_map))
+
+
+def _AssembleProgramTask(task):
+  """Translates a (program_name, program_lines, options, plan, profiled,
+  mapped) task.
+
+  Returns:
+    A (program_asm, statistics, profile, source_map) tuple, where profile is
+    None unless profiled is set and source_map is None unless mapped is set.
+  """
+  program_name, program_lines, options, plan, profiled, mapped = task
+  statistics = collections.Counter()
+  profile = TranslationProfile() if profiled else None
+  source_map = SourceMap() if mapped else None
+  program_asm = AssembleProgram(
+      program_lines, program_name, options, statistics, plan, profile,
+      source_map)
+  return (program_asm, statistics, profile, source_map)
+
+
+def _StreamAssembleProgramsInPool(
+    programs, workers, options, statistics, plan, profile, source_map):
+  """Translates programs on a process pool, yielding results in order."""
+  pool = multiprocessing.Pool(workers)
+  try:
+    tasks = ((program_name, program_lines, options, plan,
+              profile is not None, source_map is not None)
+             for program_name, program_lines in programs)
+    for program_asm, program_statistics, program_profile, program_map in (
+        pool.imap(_AssembleProgramTask, tasks)):
+      if statistics is not None:
+        statistics.update(program_statistics)
+      if profile is not None:
+        profile.Update(program_profile)
+      if source_map is not None:
+        # The assembly of the previous program has been consumed, so the
+        # map of this one follows right after it.
+        source_map.Extend(program_map)
+      yield program_asm
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
+
+
+def _StreamAssemblePrograms(
+    programs, workers, options, statistics, plan, profile, source_map=None):
+  """Translates programs, yielding an assembly iterable for each in order."""
+  if workers > 1:
+    return _StreamAssembleProgramsInPool(
+        programs, workers, options, statistics, plan, profile, source_map)
+  return (
+      StreamAssembleProgram(
+          program_lines, program_name, options, statistics, plan, profile,
+          source_map)
+      for program_name, program_lines in programs)
+
+
+def _StreamCachedPrograms(
+    programs, workers, cache, options, statistics, plan, profile):
+  """Like _StreamAssemblePrograms, but looks up programs in cache first.
+
+  Only the programs without a cache entry are translated, and their assembly
+  is stored in the cache. Entries are evicted only once all programs have
+  been processed, so that the entries found at the start remain available.
+  The statistics and the profile only cover the programs that were
+  translated.
+  """
+  entries = []
+  misses = []
+  for program_name, program_lines in programs:
+    key = cache.Key(program_name, program_lines, options, plan)
+    hit = cache.Lookup(key)
+    if not hit:
+      misses.append((program_name, program_lines))
+    entries.append((program_name, program_lines, key, hit))
+  translated_programs = _StreamAssemblePrograms(
+      misses, workers, options, statistics, plan, profile)
+
+  for program_name, program_lines, key, hit in entries:
+    program_asm = cache.Get(key) if hit else None
+    if program_asm is None:
+      if hit:
+        # The entry vanished, e.g. it was evicted by another process.
+        program_asm = AssembleProgram(
+            program_lines, program_name, options, statistics, plan, profile)
+      else:
+        program_asm = list(next(translated_programs))
+      cache.Put(key, program_asm)
+    yield program_asm
+  cache.Trim()
+
+
+def BuildCallGraph(programs):
+  """Builds the call graph of a sequence of VM programs.
+
+  Only the function and call commands are looked at, so the lines are
+  tokenized but not parsed; errors in the programs are reported once they
+  are translated.
 
+  Args:
+    programs: An iterable of (program_name, program_lines) tuples.
 
-def LinkPrograms(programs):
+  Returns:
+    A (definitions, calls) tuple. definitions maps every program name to
+    the list of functions defined in the program. calls maps every function
+    name to the set of functions it calls; the calls made by the code that
+    precedes the first function of a program are listed under
+    "DEFAULT_FUNCTION".
+  """
+  definitions = {}
+  calls = collections.defaultdict(set)
+  for program_name, program_lines in programs:
+    functions = definitions.setdefault(program_name, [])
+    current_function = "DEFAULT_FUNCTION"
+    for line in program_lines:
+      tokens = line.split("//", 1)[0].split()
+      if len(tokens) < 2:
+        continue
+      if tokens[0] == "function":
+        current_function = tokens[1]
+        functions.append(current_function)
+        calls[current_function]
+      elif tokens[0] == "call":
+        calls[current_function].add(tokens[1])
+  return (definitions, dict(calls))
+
+
+def FindDeadFunctions(programs, entry_function="Sys.init"):
+  """Finds the functions that can never be called from entry_function.
+
+  The code that precedes the first function of a program is always
+  reachable. When no program defines entry_function nothing is dead, since
+  the programs are not a complete application then.
+
+  Args:
+    programs: An iterable of (program_name, program_lines) tuples.
+    entry_function: The name of the function called by the bootstrap code.
+
+  Returns:
+    A dict mapping program names to sets with the names of the functions
+    defined in the program that are unreachable.
+  """
+  definitions, calls = BuildCallGraph(programs)
+  if entry_function not in calls:
+    return {}
+
+  reachable = set()
+  pending = [entry_function, "DEFAULT_FUNCTION"]
+  while pending:
+    function_name = pending.pop()
+    if function_name not in reachable:
+      reachable.add(function_name)
+      pending.extend(calls.get(function_name, ()))
+
+  dead_functions = {}
+  for program_name, functions in definitions.items():
+    dead = set(functions) - reachable
+    if dead:
+      dead_functions[program_name] = dead
+  return dead_functions
+
+
+def PlanLink(programs, options=None):
+  """Takes the whole-program decisions required by the options.
+
+  Args:
+    programs: A list of (program_name, program_lines) tuples.
+    options: An optional TranslationOptions instance.
+
+  Returns:
+    A LinkPlan instance.
+  """
+  if options is None:
+    options = TranslationOptions()
+  dead_functions = None
+  if options.eliminate_dead_functions:
+    dead_functions = FindDeadFunctions(programs)
+  inline_functions = None
+  if options.inline_budget > 0:
+    inline_functions = HackFunctionInliner.FindInlineFunctions(
+        programs, options.inline_budget)
+  line_counts = dict((program_name, len(program_lines))
+                     for program_name, program_lines in programs)
+  return LinkPlan(dead_functions, inline_functions, line_counts)
+
+
+def StreamLinkPrograms(
+    programs, workers=1, cache=None, options=None, statistics=None,
+    profile=None, source_map=None):
+  """Lazily transforms a sequence of VM programs into one assembly stream.
+
+  Args:
+    programs: An iterable of (program_name, program_lines) tuples, see
+        LinkPrograms.
+    workers: The number of processes translating programs in parallel.
+    cache: An optional AssemblyCache with the assembly of programs that
+        have been translated before.
+    options: An optional TranslationOptions instance.
+    statistics: An optional collections.Counter receiving statistics about
+        the optimizations applied to the programs.
+    profile: An optional TranslationProfile timing every phase.
+    source_map: An optional SourceMap receiving the origins of the
+        instructions as they are generated. The cache does not keep the
+        origins, so it is not used when source_map is given.
+
+  Returns:
+    An iterator over Hack assembly instruction strings.
+  """
+  plan = None
+  if options is not None and options.NeedsLinkPlan():
+    # Whole-program decisions need to see all programs before the first
+    # one is translated.
+    programs = list(programs)
+    if profile is None:
+      plan = PlanLink(programs, options)
+    else:
+      with profile.Measure("plan"):
+        plan = PlanLink(programs, options)
+  if cache is not None and source_map is None:
+    return itertools.chain.from_iterable(_StreamCachedPrograms(
+        programs, workers, cache, options, statistics, plan, profile))
+  return itertools.chain.from_iterable(_StreamAssemblePrograms(
+      programs, workers, options, statistics, plan, profile, source_map))
+
+
+def LinkPrograms(
+    programs, workers=1, cache=None, options=None, statistics=None,
+    profile=None, source_map=None):
   """Transforms a list of VM programs into a single Hack assembly stream.
 
+  The programs are independent of each other, since all assembly labels are
+  qualified by file and function names, so they can be translated by several
+  worker processes at once. The output does not depend on workers. Options
+  that need to look at all programs, like eliminate_dead_functions and
+  inline_budget, are applied through a LinkPlan computed before the
+  translation starts.
+
   Args:
     programs: A list of Hack VM programs. A Hack VM program is a
         (program_name, program_lines) tuple, with program_name being the
         name of the program and program_lines being a list of strings
         with the programs commands.
+    workers: The number of processes translating programs in parallel.
+    cache: An optional AssemblyCache with the assembly of programs that
+        have been translated before.
+    options: An optional TranslationOptions instance.
+    statistics: An optional collections.Counter receiving statistics about
+        the optimizations applied to the programs.
+    profile: An optional TranslationProfile timing every phase.
+    source_map: An optional SourceMap receiving the origins of the
+        instructions, see StreamLinkPrograms.
 
   Returns:
     A list of Hack assembly instruction strings.
   """
-  return sum(
-      map(lambda p: AssembleProgram(p[1], p[0]), programs),
-      [])
+  return list(StreamLinkPrograms(
+      programs, workers, cache, options, statistics, profile, source_map))
+
 
+def StreamAttachBootstrapCode(program_asm, options=None, source_map=None):
+  """Lazily prepends a bootstrap header to a Hack assembly stream.
 
-def AttachBootstrapCode(program_asm):
+  Args:
+    program_asm: An iterable of Hack assembly strings.
+    options: An optional TranslationOptions instance.
+    source_map: An optional SourceMap that receives the origins of
+        program_asm. The header is recorded in it without an origin.
+
+  Returns:
+    An iterator over Hack assembly strings starting with a bootstrap header.
+  """
+  bootstrap_asm = HackCodeGenerator.GenerateBootstrapAsm(options)
+  if source_map is not None:
+    bootstrap_asm = source_map.Record(
+        (instruction, None) for instruction in bootstrap_asm)
+  return itertools.chain(bootstrap_asm, program_asm)
+
+
+def AttachBootstrapCode(program_asm, options=None):
   """Attaches a bootstrap header to a list of Hack assembly instructions.
 
+  The header also contains the shared routines required by the options, so
+  it has to be attached whenever the programs were translated with options.
+
   Args:
     program_asm: A list of Hack assembly strings.
+    options: An optional TranslationOptions instance.
 
   Returns:
     A list of Hack assembly strings with a bootstrap header.
   """
-  return sum([HackCodeGenerator.GenerateBootstrapAsm(), program_asm], [])
+  return list(StreamAttachBootstrapCode(program_asm, options))
 
 
-def main():
-  if len(sys.argv) != 2:
-    print "Please enter a file or directory."
-    return
+def CountRomWords(program_asm):
+  """Counts the ROM words occupied by Hack assembly instructions.
+
+  Args:
+    program_asm: An iterable of Hack assembly strings.
+
+  Returns:
+    The number of instructions, not counting label declarations.
+  """
+  return sum(
+      1 for instruction in program_asm if not instruction.startswith("("))
+
+
+def MeasureRomSavings(programs, options):
+  """Measures how many ROM words each non-default option saves.
+
+  Every setting of options that differs from its default is reset in turn
+  and the programs are translated again to compare the sizes.
+
+  Args:
+    programs: A list of (program_name, program_lines) tuples.
+    options: A TranslationOptions instance.
+
+  Returns:
+    A (rom_words, savings) tuple, where rom_words is the size of the
+    complete program built with options and savings is a list of
+    (setting_name, saved_rom_words) tuples.
+  """
+  def Measure(options):
+    return CountRomWords(
+        StreamAttachBootstrapCode(
+            StreamLinkPrograms(programs, options=options), options))
+
+  rom_words = Measure(options)
+  savings = [
+      (name, Measure(options.WithDefault(name)) - rom_words)
+      for name in options.ChangedSettings()]
+  return (rom_words, savings)
+
+
+def FindPrograms(path, recursive=False):
+  """Finds the VM programs of a .vm file or of a project directory.
+
+  Args:
+    path: The name of a .vm file or of a directory.
+    recursive: Whether the subdirectories of a directory are searched for
+        .vm files as well.
+
+  Returns:
+    A list of (program_name, program_lines) tuples, with program_lines
+    being a ProgramFile. The files of every directory come in the order of
+    their names, before those of its subdirectories. The name of a program
+    is the name of its file without the directory and the .vm extension.
+
+  Raises:
+    VMError: If two files define programs with the same name.
+  """
+  if os.path.isfile(path):
+    paths = [path] if path.endswith(".vm") else []
+  else:
+    paths = []
+    for directory, directory_names, file_names in os.walk(path):
+      if recursive:
+        directory_names.sort()
+      else:
+        del directory_names[:]
+      paths += [os.path.join(directory, file_name)
+                for file_name in sorted(file_names)
+                if file_name.endswith(".vm")]
 
   programs = []
-  if os.path.isfile(sys.argv[1]):
-    if sys.argv[1].endswith(".vm"):
-      try:
-        with open(sys.argv[1], "r") as program_file:
-          program_lines = program_file.readlines()
-          programs.append((sys.argv[1][:-3], program_lines))
-      except IOError as error:
-        print error.message
-  elif os.path.isdir(sys.argv[1]):
-    for file_name in os.listdir(sys.argv[1]):
-      if file_name.endswith(".vm"):
-        try:
-          with open(file_name, "r") as program_file:
-            program_lines = program_file.readlines()
-            programs.append((file_name[:-3], program_lines))
-        except IOError as error:
-          print error.message
+  program_paths = {}
+  errors = []
+  for program_path in paths:
+    program_name = os.path.basename(program_path)[:-3]
+    if program_name in program_paths:
+      errors.append("%s: program %s is also defined in %s" % (
+          program_path, program_name, program_paths[program_name]))
+    program_paths[program_name] = program_path
+    programs.append((program_name, ProgramFile(program_path)))
+  if len(errors) > 0:
+    raise VMError("Error: " + os.linesep.join(errors))
+  return programs
+
+
+def ReadAhead(programs, depth=_READ_AHEAD_PROGRAMS):
+  """Reads the lines of programs in a background thread.
+
+  The next programs are read while the current one is being translated, but
+  at most depth programs are held in memory besides the current one.
+
+  Args:
+    programs: An iterable of (program_name, program_lines) tuples, with
+        program_lines being an iterable such as a ProgramFile.
+    depth: The number of programs read ahead.
+
+  Yields:
+    (program_name, program_lines) tuples with program_lines being a list.
+
+  Raises:
+    IOError: If a program cannot be read. Any other exception raised while
+        reading is passed on as well.
+  """
+  results = Queue.Queue(depth)
+  stopped = threading.Event()
 
+  def Read():
+    try:
+      for program_name, program_lines in programs:
+        if stopped.is_set():
+          return
+        results.put((program_name, list(program_lines), None))
+    except:
+      results.put((None, None, sys.exc_info()))
+    finally:
+      # Nobody waits for the end of the stream once the translation stopped.
+      if not stopped.is_set():
+        results.put(None)
+
+  reader = threading.Thread(target=Read)
+  reader.daemon = True
+  reader.start()
   try:
-    program_asm = AttachBootstrapCode(LinkPrograms(programs))
-    with open("out.asm", "w") as asm_file:
-      asm_file.write(os.linesep.join(program_asm))
-  except VMError as error:
-    print error.message
-  except IOError as error:
+    while True:
+      result = results.get()
+      if result is None:
+        return
+      program_name, program_lines, error = result
+      if error is not None:
+        raise error[0], error[1], error[2]
+      yield (program_name, program_lines)
+  finally:
+    # Unblocks the reader if the translation stops early.
+    stopped.set()
+    while not results.empty():
+      results.get_nowait()
+
+
+def WriteAsm(program_asm, asm_file, buffer_lines=_WRITE_BUFFER_LINES):
+  """Writes a Hack assembly stream to a file in buffered chunks.
+
+  The output is identical to writing os.linesep.join(program_asm), but at
+  most buffer_lines instructions are held in memory at any time.
+
+  Args:
+    program_asm: An iterable of Hack assembly strings.
+    asm_file: A file object opened for writing.
+    buffer_lines: The number of instructions to write at once.
+  """
+  program_asm = iter(program_asm)
+  separator = ""
+  while True:
+    chunk = list(itertools.islice(program_asm, buffer_lines))
+    if not chunk:
+      return
+    asm_file.write(separator + os.linesep.join(chunk))
+    separator = os.linesep
+
+
+def WriteAsmFile(program_asm, file_name):
+  """Streams a Hack assembly stream into the file named file_name.
+
+  The instructions are written to a temporary file first, which replaces
+  file_name only once the whole stream was written successfully. This way a
+  translation error discovered late in the stream never leaves a truncated
+  file behind.
+
+  Args:
+    program_asm: An iterable of Hack assembly strings.
+    file_name: The name of the output file.
+  """
+  _ReplaceFile(
+      file_name, "w", lambda asm_file: WriteAsm(program_asm, asm_file))
+
+
+def WriteHackFile(program_asm, file_name, image_file_name=None):
+  """Assembles a Hack assembly stream into the .hack file named file_name.
+
+  The instructions are encoded in memory as they are generated, so the
+  assembly never takes the detour through a text file.
+
+  Args:
+    program_asm: An iterable of Hack assembly strings.
+    file_name: The name of the .hack output file.
+    image_file_name: The name of an optional raw ROM image output file.
+
+  Raises:
+    hack_assembler.AssemblerError: If the program does not fit into the ROM.
+  """
+  words, _ = hack_assembler.HackAssembler.Assemble(program_asm)
+  _ReplaceFile(
+      file_name, "w", lambda hack_file: hack_assembler.WriteHack(
+          words, hack_file))
+  if image_file_name is not None:
+    _ReplaceFile(
+        image_file_name, "wb", lambda image_file: hack_assembler.WriteImage(
+            words, image_file))
+
+
+def _ReplaceFile(file_name, mode, write):
+  # Calls write with a temporary file, which replaces file_name only if
+  # write succeeds.
+  temporary_name = file_name + ".tmp"
+  try:
+    with open(temporary_name, mode) as output_file:
+      write(output_file)
+    os.rename(temporary_name, file_name)
+  finally:
+    if os.path.exists(temporary_name):
+      os.remove(temporary_name)
+
+
+def AddTranslationArguments(parser):
+  """Adds the command line flags of the TranslationOptions to parser.
+
+  Args:
+    parser: An argparse.ArgumentParser instance.
+  """
+  parser.add_argument(
+      "--trampolines", action="store_true",
+      help="share one call and one return routine between all call sites")
+  parser.add_argument(
+      "--shared-comparisons", action="store_true",
+      help="share one routine for each of eq, gt and lt between all sites")
+  parser.add_argument(
+      "--optimize-commands", action="store_true",
+      help="fold constants and remove unreachable and redundant commands")
+  parser.add_argument(
+      "--fuse-commands", action="store_true",
+      help="translate frequent command sequences as one, without stack "
+           "traffic")
+  parser.add_argument(
+      "--stack-caching", action="store_true",
+      help="keep the top of the VM stack in the D register")
+  parser.add_argument(
+      "--peephole", action="store_true",
+      help="rewrite the generated assembly with the peephole optimizer")
+  parser.add_argument(
+      "--eliminate-dead-functions", action="store_true",
+      help="drop the functions that Sys.init can never call")
+  parser.add_argument(
+      "--inline-budget", metavar="COMMANDS", type=int, default=0,
+      help="inline calls to leaf functions of at most COMMANDS commands")
+
+
+def TranslationOptionsFromArguments(arguments):
+  """Creates the TranslationOptions selected by AddTranslationArguments flags.
+
+  Args:
+    arguments: The argparse.Namespace returned by the parser.
+
+  Returns:
+    A TranslationOptions instance.
+  """
+  return TranslationOptions(
+      eliminate_dead_functions=arguments.eliminate_dead_functions,
+      fuse_commands=arguments.fuse_commands,
+      inline_budget=arguments.inline_budget,
+      optimize_commands=arguments.optimize_commands,
+      peephole=arguments.peephole,
+      shared_comparisons=arguments.shared_comparisons,
+      stack_caching=arguments.stack_caching,
+      trampolines=arguments.trampolines)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="Translates Hack VM programs into Hack assembly (out.asm) "
+                  "or Hack machine code (out.hack).")
+  parser.add_argument(
+      "path",
+      help="a .vm file, a directory searched for .vm files or - to read one "
+           "program from the standard input")
+  parser.add_argument(
+      "-r", "--recursive", action="store_true",
+      help="search the subdirectories of the directory for .vm files as well")
+  parser.add_argument(
+      "--stdin-name", default="Main",
+      help="the name of the program read from the standard input")
+  parser.add_argument(
+      "-j", "--jobs", type=int, default=1,
+      help="the number of files to translate in parallel")
+  parser.add_argument(
+      "--cache-dir", metavar="DIRECTORY",
+      help="reuse the assembly of unchanged files cached in DIRECTORY")
+  parser.add_argument(
+      "--cache-size", metavar="MEGABYTES", type=int,
+      default=_DEFAULT_CACHE_BYTES / (1024 * 1024),
+      help="the size limit of the cache")
+  parser.add_argument(
+      "--cache-stats", action="store_true",
+      help="print cache hit and miss statistics")
+  AddTranslationArguments(parser)
+  parser.add_argument(
+      "--hack", action="store_true",
+      help="write machine code to out.hack instead of assembly to out.asm")
+  parser.add_argument(
+      "--image", action="store_true",
+      help="with --hack, also write a raw big-endian ROM image to out.bin")
+  parser.add_argument(
+      "--report", action="store_true",
+      help="print the ROM size, the words saved by each option and "
+           "optimization statistics")
+  parser.add_argument(
+      "--profile", action="store_true",
+      help="print the time and memory spent in every phase")
+  parser.add_argument(
+      "--profile-json", metavar="FILE",
+      help="write the profile of every phase and file as JSON to FILE")
+  parser.add_argument(
+      "--source-map", action="store_true",
+      help="write the VM file, line and function of every ROM address to "
+           "out.map")
+  parser.add_argument(
+      "--mine-fusions", metavar="COUNT", type=int,
+      help="print the COUNT most frequent command sequences that could be "
+           "fused, but are not, instead of translating")
+  arguments = parser.parse_args()
+  options = TranslationOptionsFromArguments(arguments)
+
+  profile = None
+  if arguments.profile or arguments.profile_json:
+    profile = TranslationProfile()
+
+  def Write(program_asm):
+    if arguments.hack:
+      WriteHackFile(
+          program_asm, "out.hack", "out.bin" if arguments.image else None)
+    else:
+      WriteAsmFile(program_asm, "out.asm")
+
+  try:
+    cache = None
+    if arguments.cache_dir:
+      cache = AssemblyCache(
+          arguments.cache_dir, arguments.cache_size * 1024 * 1024)
+    # Unless the programs are needed more than once, every program is read
+    # just before it is translated and dropped right after.
+    single_pass = (arguments.jobs <= 1 and cache is None
+                   and not options.NeedsLinkPlan() and not arguments.report)
+    if arguments.path == "-":
+      programs = [(arguments.stdin_name,
+                   sys.stdin if single_pass else sys.stdin.readlines())]
+    else:
+      programs = FindPrograms(arguments.path, arguments.recursive)
+    if arguments.mine_fusions:
+      for pattern, count in HackCommandFuser().MineFusions(
+          programs, limit=arguments.mine_fusions):
+        print "%8d  %s" % (count, json.dumps(pattern))
+      return
+    translated_programs = programs
+    if single_pass and arguments.path != "-":
+      translated_programs = ReadAhead(programs)
+
+    statistics = collections.Counter()
+    source_map = SourceMap() if arguments.source_map else None
+    program_asm = StreamAttachBootstrapCode(
+        StreamLinkPrograms(
+            translated_programs, arguments.jobs, cache, options, statistics,
+            profile, source_map),
+        options, source_map)
+    if profile is None:
+      Write(program_asm)
+    else:
+      with profile.Measure("assemble" if arguments.hack else "write"):
+        Write(program_asm)
+    if source_map is not None:
+      _ReplaceFile("out.map", "w", source_map.Write)
+    if cache is not None and arguments.cache_stats:
+      print cache.Statistics()
+    if arguments.report:
+      rom_words, savings = MeasureRomSavings(programs, options)
+      print "ROM words: %d of %d" % (rom_words, _ROM_WORDS)
+      for name, saved_words in savings:
+        print "  %s saves %d words" % (name, saved_words)
+      for name, count in sorted(statistics.items()):
+        print "%s: %d" % (name, count)
+    if arguments.profile:
+      print profile.Summary()
+    if arguments.profile_json:
+      with open(arguments.profile_json, "w") as profile_file:
+        json.dump(profile.ToJson(), profile_file, indent=2)
+  except (VMError, hack_assembler.AssemblerError) as error:
     print error.message
+  except (IOError, OSError) as error:
+    print error
 
 
 if __name__ == "__main__":
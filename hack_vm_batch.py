@@ -0,0 +1,345 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2011 Ivan Vladimirov Ivanov (ivan.vladimirov.ivanov@gmail.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+This module translates many independent Hack VM projects in one run.
+
+The projects are listed in a manifest, one per line: the directory of the
+project, optionally followed by the name of the output file. Relative names
+are relative to the directory of the manifest, blank lines and lines
+starting with # are ignored, e.g.:
+
+  # Project 8 submissions.
+  students/alice
+  students/bob  results/bob.hack
+
+An output file ending in .hack receives machine code, any other file
+assembly. Without an output file, out.asm (or out.hack with --hack) is
+written into the project directory.
+
+The projects are translated on a bounded pool of worker processes. Every
+worker keeps the assembly of the programs it translated in a bounded
+in-memory cache, keyed by the program name, its lines, the options and the
+link plan, so that files shared by many projects, like the Jack OS, are
+translated once per worker rather than once per project. Alternatively all
+workers can share an on-disk AssemblyCache.
+"""
+
+
+__author__ = "Ivan Vladimirov Ivanov (ivan.vladimirov.ivanov@gmail.com)"
+
+
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import hack_assembler
+import hack_vm
+
+
+# The default size limit of the in-memory cache of every worker.
+_DEFAULT_MEMORY_CACHE_BYTES = 32 * 1024 * 1024
+
+# The AssemblyCache of the current process, see _InitializeWorker.
+_worker_cache = None
+
+
+class MemoryAssemblyCache(object):
+  """A cache like hack_vm.AssemblyCache that keeps its entries in memory.
+
+  The keys are those of AssemblyCache. The size of an entry is the number
+  of characters of its assembly; when the total size exceeds the cap, the
+  least recently used entries are evicted.
+  """
+
+  def __init__(self, max_bytes=_DEFAULT_MEMORY_CACHE_BYTES):
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._entries = collections.OrderedDict()
+    self._total_bytes = 0
+
+  def Key(self, program_name, program_lines, options=None, plan=None):
+    return hack_vm.AssemblyCacheKey(
+        program_name, program_lines, options, plan)
+
+  def Lookup(self, key):
+    if key in self._entries:
+      self.hits += 1
+      return True
+    self.misses += 1
+    return False
+
+  def Get(self, key):
+    entry = self._entries.pop(key, None)
+    if entry is None:
+      return None
+    self._entries[key] = entry
+    return list(entry[0])
+
+  def Put(self, key, program_asm):
+    self._Remove(key)
+    program_asm = tuple(program_asm)
+    size = sum(len(instruction) + 1 for instruction in program_asm)
+    self._entries[key] = (program_asm, size)
+    self._total_bytes += size
+
+  def Trim(self):
+    while self._total_bytes > self.max_bytes and self._entries:
+      self._Remove(next(iter(self._entries)))
+      self.evictions += 1
+
+  def Statistics(self):
+    return "Cache: %d hits, %d misses, %d evictions" % (
+        self.hits, self.misses, self.evictions)
+
+  def _Remove(self, key):
+    entry = self._entries.pop(key, None)
+    if entry is not None:
+      self._total_bytes -= entry[1]
+
+
+def ReadManifest(path):
+  """Reads a manifest, see the description of the module.
+
+  Args:
+    path: The name of the manifest file.
+
+  Returns:
+    A list of (directory, output) tuples, with output being None if the
+    manifest does not name an output file.
+
+  Raises:
+    hack_vm.VMError: If a line has more than two fields.
+    IOError: If the manifest cannot be read.
+  """
+  base = os.path.dirname(path)
+  projects = []
+  errors = []
+  with open(path, "r") as manifest_file:
+    for line_number, line in enumerate(manifest_file):
+      fields = line.split()
+      if not fields or fields[0].startswith("#"):
+        continue
+      if len(fields) > 2:
+        errors.append("%s:%d: %s" % (path, line_number + 1, line.strip()))
+        continue
+      directory = os.path.join(base, fields[0])
+      output = os.path.join(base, fields[1]) if len(fields) == 2 else None
+      projects.append((directory, output))
+  if len(errors) > 0:
+    raise hack_vm.VMError("Error: " + os.linesep.join(errors))
+  return projects
+
+
+def TranslateProject(directory, output, options=None, cache=None):
+  """Translates one project and writes its output file.
+
+  Args:
+    directory: The directory of the project.
+    output: The name of the output file, which receives machine code if it
+        ends in .hack and assembly otherwise.
+    options: An optional TranslationOptions instance.
+    cache: An optional AssemblyCache for the assembly of single programs.
+
+  Returns:
+    An OrderedDict with the directory, the output, the status ("ok" or
+    "error"), the error message, the number of programs, the number of
+    programs found in the cache and the seconds spent.
+  """
+  start = time.time()
+  hits = cache.hits if cache is not None else 0
+  result = collections.OrderedDict([
+      ("directory", directory),
+      ("output", output),
+      ("status", "ok"),
+      ("message", None),
+      ("programs", 0),
+      ("reused", 0),
+      ("seconds", 0.0)
+  ])
+  try:
+    programs = hack_vm.FindPrograms(directory)
+    result["programs"] = len(programs)
+    if not programs:
+      raise hack_vm.VMError("Error: no .vm files in %s" % (directory,))
+    program_asm = hack_vm.StreamAttachBootstrapCode(
+        hack_vm.StreamLinkPrograms(programs, cache=cache, options=options),
+        options)
+    if output.endswith(".hack"):
+      hack_vm.WriteHackFile(program_asm, output)
+    else:
+      hack_vm.WriteAsmFile(program_asm, output)
+  except (hack_vm.VMError, hack_assembler.AssemblerError) as error:
+    result["status"] = "error"
+    result["message"] = error.message
+  except (IOError, OSError) as error:
+    result["status"] = "error"
+    result["message"] = str(error)
+  if cache is not None:
+    result["reused"] = cache.hits - hits
+  result["seconds"] = time.time() - start
+  return result
+
+
+def _InitializeWorker(cache_directory, cache_bytes):
+  """Creates the cache of the current worker process."""
+  global _worker_cache
+  if cache_directory is not None:
+    _worker_cache = hack_vm.AssemblyCache(cache_directory, cache_bytes)
+  else:
+    _worker_cache = MemoryAssemblyCache(cache_bytes)
+
+
+def _TranslateProjectTask(task):
+  """Translates a (directory, output, options) task with the worker cache."""
+  directory, output, options = task
+  return TranslateProject(directory, output, options, _worker_cache)
+
+
+def TranslateProjects(
+    projects, workers=1, options=None, cache_directory=None,
+    cache_bytes=_DEFAULT_MEMORY_CACHE_BYTES, hack=False):
+  """Translates projects on a pool of worker processes.
+
+  Args:
+    projects: A list of (directory, output) tuples as returned by
+        ReadManifest.
+    workers: The number of worker processes; with 1 the projects are
+        translated in the current process.
+    options: An optional TranslationOptions instance.
+    cache_directory: The directory of an on-disk AssemblyCache shared by all
+        workers or None for an in-memory cache in every worker.
+    cache_bytes: The size limit of the cache.
+    hack: Whether projects without an output file receive out.hack instead
+        of out.asm.
+
+  Yields:
+    The result of TranslateProject for every project, in the order of
+    projects.
+  """
+  default_output = "out.hack" if hack else "out.asm"
+  tasks = [(directory, output or os.path.join(directory, default_output),
+            options)
+           for directory, output in projects]
+  if workers <= 1:
+    _InitializeWorker(cache_directory, cache_bytes)
+    for task in tasks:
+      yield _TranslateProjectTask(task)
+    return
+
+  pool = multiprocessing.Pool(
+      workers, _InitializeWorker, (cache_directory, cache_bytes))
+  try:
+    for result in pool.imap(_TranslateProjectTask, tasks):
+      yield result
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
+
+
+def FormatSummary(results, seconds):
+  """Returns a human readable table of project results.
+
+  Args:
+    results: A list of results as returned by TranslateProject.
+    seconds: The wall clock time of the whole batch.
+
+  Returns:
+    A string with one line per project and a line with the totals.
+  """
+  lines = ["%-6s %8s %8s %6s  %s" % (
+      "Status", "Seconds", "Programs", "Reused", "Project")]
+  for result in results:
+    lines.append("%-6s %8.3f %8d %6d  %s" % (
+        result["status"], result["seconds"], result["programs"],
+        result["reused"], result["directory"]))
+    if result["message"]:
+      lines += ["         " + line
+                for line in result["message"].splitlines()]
+  failed = sum(1 for result in results if result["status"] != "ok")
+  lines.append("%d projects, %d failed, %.3f seconds" % (
+      len(results), failed, seconds))
+  return os.linesep.join(lines)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="Translates the Hack VM projects listed in a manifest.")
+  parser.add_argument(
+      "manifest",
+      help="a file with one project directory and optional output file per "
+           "line")
+  parser.add_argument(
+      "-j", "--jobs", type=int, default=multiprocessing.cpu_count(),
+      help="the number of projects to translate in parallel")
+  parser.add_argument(
+      "--cache-dir", metavar="DIRECTORY",
+      help="share an on-disk cache in DIRECTORY between all workers instead "
+           "of keeping one in the memory of every worker")
+  parser.add_argument(
+      "--cache-size", metavar="MEGABYTES", type=int,
+      default=_DEFAULT_MEMORY_CACHE_BYTES / (1024 * 1024),
+      help="the size limit of the cache")
+  parser.add_argument(
+      "--hack", action="store_true",
+      help="write machine code to out.hack for projects without an output "
+           "file")
+  parser.add_argument(
+      "--summary", metavar="FILE",
+      help="write the status and timing of every project as JSON to FILE")
+  hack_vm.AddTranslationArguments(parser)
+  arguments = parser.parse_args()
+
+  try:
+    projects = ReadManifest(arguments.manifest)
+  except hack_vm.VMError as error:
+    print error.message
+    sys.exit(1)
+  except IOError as error:
+    print error
+    sys.exit(1)
+
+  start = time.time()
+  results = list(TranslateProjects(
+      projects, arguments.jobs,
+      hack_vm.TranslationOptionsFromArguments(arguments), arguments.cache_dir,
+      arguments.cache_size * 1024 * 1024, arguments.hack))
+  seconds = time.time() - start
+  print FormatSummary(results, seconds)
+  if arguments.summary:
+    with open(arguments.summary, "w") as summary_file:
+      json.dump({"seconds": seconds, "projects": results}, summary_file,
+                indent=2)
+  if any(result["status"] != "ok" for result in results):
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
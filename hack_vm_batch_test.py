@@ -0,0 +1,127 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2011 Ivan Vladimirov Ivanov (ivan.vladimirov.ivanov@gmail.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Test cases for the hack_vm_batch module.
+"""
+
+
+__author__ = "Ivan Vladimirov Ivanov (ivan.vladimirov.ivanov@gmail.com)"
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import hack_vm
+import hack_vm_batch
+
+
+_MATH_PROGRAM = ["function Math.double 0", "push argument 0",
+                 "push argument 0", "add", "return"]
+
+_SYS_PROGRAM = ["function Sys.init 0", "push constant 21",
+                "call Math.double 1", "call Main.main 1", "pop static 0",
+                "label END", "goto END"]
+
+
+class TestHackVMBatch(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def _WriteFile(self, name, lines):
+    path = os.path.join(self.directory, name)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path, "w") as output_file:
+      output_file.write("\n".join(lines) + "\n")
+    return path
+
+  def _WriteProject(self, project, constant):
+    self._WriteFile(os.path.join(project, "Math.vm"), _MATH_PROGRAM)
+    self._WriteFile(os.path.join(project, "Sys.vm"), _SYS_PROGRAM)
+    self._WriteFile(os.path.join(project, "Main.vm"), [
+        "function Main.main 0", "push argument 0",
+        "push constant %d" % (constant,), "add", "return"])
+    return os.path.join(self.directory, project)
+
+  def testReadManifest(self):
+    manifest = self._WriteFile("batch/manifest.txt", [
+        "# Projects", "", "alice", "  bob  out/bob.hack  "])
+    base = os.path.join(self.directory, "batch")
+    self.assertEqual(
+        [(os.path.join(base, "alice"), None),
+         (os.path.join(base, "bob"), os.path.join(base, "out/bob.hack"))],
+        hack_vm_batch.ReadManifest(manifest))
+    manifest = self._WriteFile("manifest.txt", ["alice a.asm extra"])
+    self.assertRaises(
+        hack_vm.VMError, hack_vm_batch.ReadManifest, manifest)
+
+  def testMemoryAssemblyCache(self):
+    cache = hack_vm_batch.MemoryAssemblyCache(max_bytes=8)
+    self.assertFalse(cache.Lookup("a"))
+    cache.Put("a", ["@1", "D=A"])
+    cache.Put("b", ["@2"])
+    self.assertTrue(cache.Lookup("a"))
+    self.assertEqual(["@1", "D=A"], cache.Get("a"))
+    cache.Trim()
+    # "b" is the least recently used entry.
+    self.assertEqual(None, cache.Get("b"))
+    self.assertEqual(["@1", "D=A"], cache.Get("a"))
+    self.assertEqual((1, 1, 1), (cache.hits, cache.misses, cache.evictions))
+    self.assertEqual(
+        hack_vm.AssemblyCacheKey("Main", ["add"]), cache.Key("Main", ["add"]))
+
+  def testTranslateProjects(self):
+    options = hack_vm.TranslationOptions(peephole=True)
+    first = self._WriteProject("first", 1)
+    second = self._WriteProject("second", 2)
+    missing = os.path.join(self.directory, "missing")
+    output = os.path.join(self.directory, "second.hack")
+    for workers in (1, 2):
+      results = list(hack_vm_batch.TranslateProjects(
+          [(first, None), (second, output), (missing, None)], workers,
+          options))
+      self.assertEqual(["ok", "ok", "error"],
+                       [result["status"] for result in results])
+      self.assertEqual([3, 3, 0], [result["programs"] for result in results])
+      if workers == 1:
+        # Math and Sys are only translated for the first project.
+        self.assertEqual([0, 2, 0],
+                         [result["reused"] for result in results])
+      with open(os.path.join(first, "out.asm"), "r") as asm_file:
+        self.assertEqual(
+            hack_vm.AttachBootstrapCode(hack_vm.LinkPrograms(
+                hack_vm.FindPrograms(first), options=options), options),
+            asm_file.read().splitlines())
+      self.assertTrue(os.path.isfile(output))
+    self.assertTrue("1 failed" in hack_vm_batch.FormatSummary(results, 1.0))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,394 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2011 Ivan Vladimirov Ivanov (ivan.vladimirov.ivanov@gmail.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+This module benchmarks the translation of Hack VM programs by the hack_vm
+module on deterministic synthetic corpora.
+
+Every benchmark translates one corpus, timing each phase of the pipeline
+separately, and reports the throughput, the peak memory use and the size of
+the output. The results are written as JSON and can be compared against the
+results of a previous version to catch throughput regressions.
+"""
+
+
+__author__ = "Ivan Vladimirov Ivanov (ivan.vladimirov.ivanov@gmail.com)"
+
+
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import time
+
+import hack_vm
+
+
+# The kinds of synthetic corpora.
+CORPUS_KINDS = ["arithmetic", "calls", "branches", "files"]
+
+
+class CorpusGenerator(object):
+  """This class generates deterministic synthetic VM programs.
+
+  The programs are valid VM code of the shape a Jack compiler produces,
+  though they do not compute anything meaningful. Every corpus is made of
+  functions with about the same number of commands and a Sys.init function
+  calling the first of them. The mix of commands depends on the kind:
+
+    arithmetic: Long expressions over constants and variables.
+    calls: Small functions calling each other.
+    branches: Loops and conditionals.
+    files: A project with many small files mixing all of the above.
+  """
+
+  # The approximate number of commands of a function.
+  _FUNCTION_COMMANDS = 60
+
+  # The approximate number of commands of a file in a "files" corpus.
+  _FILE_COMMANDS = 300
+
+  _BINARY_OPERATIONS = ["add", "sub", "and", "or", "eq", "gt", "lt"]
+
+  _UNARY_OPERATIONS = ["neg", "not"]
+
+  _VARIABLE_SEGMENTS = ["argument", "local", "static", "this", "that"]
+
+  def __init__(self, seed=0):
+    self._random = random.Random(seed)
+
+  def Generate(self, kind, commands):
+    """Generates a corpus.
+
+    Args:
+      kind: One of CORPUS_KINDS.
+      commands: The approximate total number of commands of the corpus.
+
+    Returns:
+      A list of (program_name, program_lines) tuples.
+    """
+    if kind not in CORPUS_KINDS:
+      raise ValueError("Unknown corpus kind: " + kind)
+    if kind == "files":
+      files = max(1, commands // CorpusGenerator._FILE_COMMANDS)
+      kinds = CORPUS_KINDS[:-1]
+      programs = [
+          ("File%d" % (index,), self._GenerateProgram(
+              "File%d" % (index,), kinds[index % len(kinds)],
+              CorpusGenerator._FILE_COMMANDS))
+          for index in range(files)]
+    else:
+      programs = [("Main", self._GenerateProgram("Main", kind, commands))]
+    programs.append(("Sys", [
+        "function Sys.init 0",
+        "call %s.f0 0" % (programs[0][0],),
+        "pop temp 0",
+        "label HALT",
+        "goto HALT"
+    ]))
+    return programs
+
+  def _GenerateProgram(self, program_name, kind, commands):
+    # Generates the lines of one file with functions program_name.f<i>.
+    functions = max(1, commands // CorpusGenerator._FUNCTION_COMMANDS)
+    lines = []
+    for index in range(functions):
+      lines.append("function %s.f%d 4" % (program_name, index))
+      body = []
+      while len(body) < CorpusGenerator._FUNCTION_COMMANDS:
+        if kind == "arithmetic":
+          body += self._Statement()
+        elif kind == "calls":
+          body += self._Call(program_name, index, functions)
+        else:
+          body += self._Branch(len(body))
+      lines += body
+      lines += self._Expression(2) + ["return"]
+    return lines
+
+  def _Expression(self, depth):
+    # Returns the commands of an expression pushing one value.
+    choice = self._random.random()
+    if depth == 0 or choice < 0.3:
+      if self._random.random() < 0.4:
+        return ["push constant %d" % (self._random.randint(0, 32767),)]
+      return ["push %s %d" % (
+          self._random.choice(CorpusGenerator._VARIABLE_SEGMENTS),
+          self._random.randint(0, 3))]
+    if choice < 0.4:
+      return self._Expression(depth - 1) + [
+          self._random.choice(CorpusGenerator._UNARY_OPERATIONS)]
+    return (self._Expression(depth - 1) + self._Expression(depth - 1) +
+            [self._random.choice(CorpusGenerator._BINARY_OPERATIONS)])
+
+  def _Statement(self):
+    # Returns the commands of an assignment.
+    return self._Expression(3) + ["pop %s %d" % (
+        self._random.choice(CorpusGenerator._VARIABLE_SEGMENTS),
+        self._random.randint(0, 3))]
+
+  def _Call(self, program_name, index, functions):
+    # Returns the commands of a call to a function with a higher index.
+    if index + 1 >= functions:
+      return self._Statement()
+    callee = self._random.randint(index + 1, functions - 1)
+    arguments = self._random.randint(0, 2)
+    return (sum([self._Expression(1) for _ in range(arguments)], []) +
+            ["call %s.f%d %d" % (program_name, callee, arguments),
+             "pop local %d" % (self._random.randint(0, 3),)])
+
+  def _Branch(self, number):
+    # Returns the commands of a loop or a conditional.
+    if self._random.random() < 0.5:
+      return (["label LOOP%d" % (number,)] + self._Expression(2) +
+              ["not", "if-goto END%d" % (number,)] + self._Statement() +
+              ["goto LOOP%d" % (number,), "label END%d" % (number,)])
+    return (self._Expression(2) + ["if-goto ELSE%d" % (number,)] +
+            self._Statement() + ["goto END%d" % (number,),
+                                 "label ELSE%d" % (number,)] +
+            self._Statement() + ["label END%d" % (number,)])
+
+
+def TimePhases(programs, options=None, repeat=1):
+  """Times every phase of the translation of programs.
+
+  The phases are timed one after the other on lists, like AssembleProgram
+  used to run them, followed by the complete streaming LinkPrograms and the
+  writing of the output. Every phase is run repeat times and the fastest run
+  is reported.
+
+  Args:
+    programs: A list of (program_name, program_lines) tuples.
+    options: An optional hack_vm.TranslationOptions instance.
+    repeat: The number of runs of every phase.
+
+  Returns:
+    A (phases, program_asm) tuple, where phases is a collections.OrderedDict
+    mapping phase names to seconds and program_asm is the linked output.
+  """
+  if options is None:
+    options = hack_vm.TranslationOptions()
+  phases = collections.OrderedDict()
+
+  def Time(name, function):
+    result = None
+    for _ in range(repeat):
+      start = time.time()
+      result = function()
+      elapsed = time.time() - start
+      phases[name] = min(phases.get(name, elapsed), elapsed)
+    return result
+
+  commands = Time("parse", lambda: [
+      hack_vm.ParseProgram(program_lines, program_name)
+      for program_name, program_lines in programs])
+  decorated = Time("decorate", lambda: [
+      hack_vm.DecorateCommands(program_commands, program_name)
+      for (program_name, _), program_commands in zip(programs, commands)])
+  if options.optimize_commands:
+    decorated = Time("optimize", lambda: [
+        list(hack_vm.HackCommandOptimizer.StreamOptimize(program_decorated))
+        for program_decorated in decorated])
+  if options.fuse_commands:
+    decorated = Time("fuse", lambda: [
+        list(hack_vm.HackCommandFuser().StreamFuse(program_decorated))
+        for program_decorated in decorated])
+  chunks = Time("generate", lambda: [
+      hack_vm.GenerateAsm(program_decorated, options)
+      for program_decorated in decorated])
+  Time("flatten", lambda: [
+      hack_vm.FlattenAsm(program_chunks) for program_chunks in chunks])
+  program_asm = Time("link", lambda: hack_vm.AttachBootstrapCode(
+      hack_vm.LinkPrograms(programs, options=options), options))
+  with open(os.devnull, "w") as asm_file:
+    Time("write", lambda: hack_vm.WriteAsm(program_asm, asm_file))
+  return (phases, program_asm)
+
+
+def RunBenchmark(kind, commands, options=None, repeat=1, seed=0):
+  """Generates a corpus and benchmarks its translation.
+
+  Args:
+    kind: One of CORPUS_KINDS.
+    commands: The approximate number of commands of the corpus.
+    options: An optional hack_vm.TranslationOptions instance.
+    repeat: The number of runs of every phase.
+    seed: The seed of the corpus generator.
+
+  Returns:
+    A dict with the results, ready to be written as JSON.
+  """
+  if options is None:
+    options = hack_vm.TranslationOptions()
+  programs = CorpusGenerator(seed).Generate(kind, commands)
+  lines = sum(len(program_lines) for _, program_lines in programs)
+  phases, program_asm = TimePhases(programs, options, repeat)
+  return collections.OrderedDict([
+      ("corpus", kind),
+      ("seed", seed),
+      ("options", options.ChangedSettings()),
+      ("files", len(programs)),
+      ("lines", lines),
+      ("phases", phases),
+      ("lines_per_second", int(lines / max(phases["link"], 1e-9))),
+      ("instructions", len(program_asm)),
+      ("rom_words", hack_vm.CountRomWords(program_asm)),
+      # Kilobytes on Linux, the peak of the whole process.
+      ("peak_rss", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+  ])
+
+
+def _RunBenchmarkTask(task):
+  """Runs a (kind, commands, options, repeat, seed) benchmark in a worker."""
+  return RunBenchmark(*task)
+
+
+def RunBenchmarks(kinds, commands, options=None, repeat=1, seed=0,
+                  isolate=True):
+  """Runs a benchmark for every kind of corpus.
+
+  Args:
+    kinds: A list of corpus kinds.
+    commands: The approximate number of commands of every corpus.
+    options: An optional hack_vm.TranslationOptions instance.
+    repeat: The number of runs of every phase.
+    seed: The seed of the corpus generator.
+    isolate: Whether every benchmark runs in a fresh process, so that its
+        peak memory is not influenced by the previous benchmarks.
+
+  Returns:
+    A dict with the results of all benchmarks, ready to be written as JSON.
+  """
+  tasks = [(kind, commands, options, repeat, seed) for kind in kinds]
+  if isolate:
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+      benchmarks = pool.map(_RunBenchmarkTask, tasks)
+      pool.close()
+    finally:
+      pool.terminate()
+      pool.join()
+  else:
+    benchmarks = [_RunBenchmarkTask(task) for task in tasks]
+  return collections.OrderedDict([
+      ("version", hack_vm.__version__),
+      ("python", platform.python_version()),
+      ("benchmarks", benchmarks)
+  ])
+
+
+def FindRegressions(results, baseline, tolerance=0.1):
+  """Compares benchmark results against the results of a previous run.
+
+  Only benchmarks of the same corpus, seed, options and size are compared.
+
+  Args:
+    results: The results of RunBenchmarks.
+    baseline: The results of RunBenchmarks for a previous version.
+    tolerance: The fraction by which a phase may become slower.
+
+  Returns:
+    A list of strings describing every phase that became slower.
+  """
+  def Key(benchmark):
+    return (benchmark["corpus"], benchmark["seed"],
+            tuple(benchmark["options"]), benchmark["lines"])
+
+  baseline_benchmarks = dict(
+      (Key(benchmark), benchmark) for benchmark in baseline["benchmarks"])
+  regressions = []
+  for benchmark in results["benchmarks"]:
+    previous = baseline_benchmarks.get(Key(benchmark))
+    if previous is None:
+      continue
+    for phase, seconds in benchmark["phases"].items():
+      previous_seconds = previous["phases"].get(phase)
+      if previous_seconds and seconds > previous_seconds * (1 + tolerance):
+        regressions.append("%s/%s: %.4fs, was %.4fs (%+.0f%%)" % (
+            benchmark["corpus"], phase, seconds, previous_seconds,
+            100.0 * (seconds / previous_seconds - 1)))
+  return regressions
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="Benchmarks the translation of synthetic VM corpora.")
+  parser.add_argument(
+      "--kinds", default=",".join(CORPUS_KINDS),
+      help="a comma separated list of corpus kinds, out of " +
+           ", ".join(CORPUS_KINDS))
+  parser.add_argument(
+      "--commands", type=int, default=20000,
+      help="the approximate number of commands of every corpus")
+  parser.add_argument(
+      "--repeat", type=int, default=3,
+      help="the number of runs of every phase, the fastest is reported")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument(
+      "--output", metavar="FILE", help="write the results as JSON to FILE")
+  parser.add_argument(
+      "--compare", metavar="FILE",
+      help="report phases that are slower than in the results in FILE")
+  parser.add_argument(
+      "--tolerance", type=float, default=0.1,
+      help="the fraction by which a phase may become slower")
+  hack_vm.AddTranslationArguments(parser)
+  arguments = parser.parse_args()
+
+  try:
+    results = RunBenchmarks(
+        arguments.kinds.split(","), arguments.commands,
+        hack_vm.TranslationOptionsFromArguments(arguments), arguments.repeat,
+        arguments.seed)
+  except ValueError as error:
+    print error
+    sys.exit(2)
+
+  for benchmark in results["benchmarks"]:
+    print "%s: %d files, %d lines, %d lines/s, %d words, %d KB peak" % (
+        benchmark["corpus"], benchmark["files"], benchmark["lines"],
+        benchmark["lines_per_second"], benchmark["rom_words"],
+        benchmark["peak_rss"])
+    print "  " + ", ".join(
+        "%s %.4fs" % (phase, seconds)
+        for phase, seconds in benchmark["phases"].items())
+  if arguments.output:
+    with open(arguments.output, "w") as output_file:
+      json.dump(results, output_file, indent=2)
+  if arguments.compare:
+    with open(arguments.compare, "r") as baseline_file:
+      regressions = FindRegressions(
+          results, json.load(baseline_file), arguments.tolerance)
+    for regression in regressions:
+      print "Regression: " + regression
+    if regressions:
+      sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
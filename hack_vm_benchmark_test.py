@@ -0,0 +1,88 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2011 Ivan Vladimirov Ivanov (ivan.vladimirov.ivanov@gmail.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Test cases for the hack_vm_benchmark module.
+"""
+
+
+__author__ = "Ivan Vladimirov Ivanov (ivan.vladimirov.ivanov@gmail.com)"
+
+
+import json
+import unittest
+
+import hack_vm
+import hack_vm_benchmark
+
+
+class TestHackVMBenchmark(unittest.TestCase):
+
+  def testGenerateCorpus(self):
+    for kind in hack_vm_benchmark.CORPUS_KINDS:
+      programs = hack_vm_benchmark.CorpusGenerator(7).Generate(kind, 2000)
+      self.assertEqual(
+          programs, hack_vm_benchmark.CorpusGenerator(7).Generate(kind, 2000))
+      self.assertNotEqual(
+          programs, hack_vm_benchmark.CorpusGenerator(8).Generate(kind, 2000))
+      lines = sum(len(program_lines) for _, program_lines in programs)
+      self.assertTrue(1500 < lines < 3000, (kind, lines))
+      # Every corpus is valid and translates.
+      hack_vm.LinkPrograms(programs)
+    self.assertEqual(7, len(
+        hack_vm_benchmark.CorpusGenerator().Generate("files", 2000)))
+    self.assertRaises(
+        ValueError, hack_vm_benchmark.CorpusGenerator().Generate, "x", 10)
+
+  def testRunBenchmarks(self):
+    results = hack_vm_benchmark.RunBenchmarks(
+        ["arithmetic", "files"], 1000,
+        hack_vm.TranslationOptions(peephole=True), isolate=False)
+    self.assertEqual(hack_vm.__version__, results["version"])
+    self.assertEqual(2, len(results["benchmarks"]))
+    benchmark = results["benchmarks"][0]
+    self.assertEqual("arithmetic", benchmark["corpus"])
+    self.assertEqual(["peephole"], benchmark["options"])
+    self.assertEqual(
+        ["parse", "decorate", "generate", "flatten", "link", "write"],
+        benchmark["phases"].keys())
+    self.assertTrue(benchmark["rom_words"] > benchmark["lines"])
+    self.assertTrue(benchmark["peak_rss"] > 0)
+    # The results survive a round trip through JSON.
+    self.assertEqual(results, json.loads(json.dumps(results)))
+
+  def testFindRegressions(self):
+    def Results(link_seconds):
+      return {"benchmarks": [{
+          "corpus": "calls", "seed": 0, "options": [], "lines": 100,
+          "phases": {"parse": 1.0, "link": link_seconds}}]}
+
+    self.assertEqual(
+        [], hack_vm_benchmark.FindRegressions(Results(1.05), Results(1.0)))
+    regressions = hack_vm_benchmark.FindRegressions(Results(1.5), Results(1.0))
+    self.assertEqual(1, len(regressions))
+    self.assertTrue(regressions[0].startswith("calls/link"))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,378 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2011 Ivan Vladimirov Ivanov (ivan.vladimirov.ivanov@gmail.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+This module implements a long-running translator for Hack VM projects.
+
+The daemon keeps the lines, the parsed commands and the generated assembly
+of every file of a project in memory and answers build requests on a Unix
+socket. A build only translates the files that changed since the previous
+one, and a watcher thread polls the project for changes, so most builds
+merely write the assembly that is already there.
+
+Requests and responses are single lines of JSON. A request is a dict with a
+"command", which is one of:
+
+  build: Brings the assembly up to date and writes it to "output", as Hack
+      machine code if "hack" is true.
+  status: Describes the programs of the project.
+  stop: Stops the daemon.
+
+Every response has a "status", either "ok" or "error" with a "message".
+"""
+
+
+__author__ = "Ivan Vladimirov Ivanov (ivan.vladimirov.ivanov@gmail.com)"
+
+
+import argparse
+import collections
+import itertools
+import json
+import os
+import socket
+import SocketServer
+import sys
+import threading
+import time
+
+import hack_assembler
+import hack_vm
+
+
+# The default number of seconds between two checks for changed files.
+_DEFAULT_POLL_SECONDS = 0.5
+
+# The default name of the socket, relative to the working directory.
+_DEFAULT_SOCKET = ".hack_vm.sock"
+
+
+class _ProgramEntry(object):
+  """The state of one .vm file of a project.
+
+  Attributes:
+    path: The name of the file.
+    stamp: The (modification time, size) tuple of the file when it was read.
+    lines: A list with the lines of the file.
+    decorated_commands: A list with the decorated commands of the file or
+        None if they were not parsed yet.
+    program_asm: A list with the assembly of the file or None.
+    plan_fingerprint: The LinkPlan fingerprint program_asm was generated
+        with.
+  """
+
+  def __init__(self, path, stamp, lines):
+    self.path = path
+    self.stamp = stamp
+    self.lines = lines
+    self.decorated_commands = None
+    self.program_asm = None
+    self.plan_fingerprint = None
+
+
+class HackVMDaemon(object):
+  """Keeps the translation of a project up to date.
+
+  All methods may be called from several threads.
+
+  Attributes:
+    directory: The directory of the project.
+    options: The TranslationOptions of the project.
+    translations: The number of times a program was translated.
+  """
+
+  def __init__(self, directory, options=None):
+    if options is None:
+      options = hack_vm.TranslationOptions()
+    self.directory = directory
+    self.options = options
+    self.translations = 0
+    self._programs = collections.OrderedDict()
+    self._lock = threading.RLock()
+    self._stopped = threading.Event()
+
+  def Refresh(self):
+    """Rereads the files that changed since they were last read.
+
+    Returns:
+      A list with the names of the programs that were added, changed or
+      removed.
+
+    Raises:
+      hack_vm.VMError: If two files define programs with the same name.
+      IOError: If a file cannot be read.
+    """
+    with self._lock:
+      programs = collections.OrderedDict()
+      changed = []
+      for program_name, program_file in hack_vm.FindPrograms(self.directory):
+        status = os.stat(program_file.path)
+        stamp = (status.st_mtime, status.st_size)
+        entry = self._programs.get(program_name)
+        if (entry is None or entry.path != program_file.path
+            or entry.stamp != stamp):
+          entry = _ProgramEntry(program_file.path, stamp, list(program_file))
+          changed.append(program_name)
+        programs[program_name] = entry
+      changed += [program_name for program_name in self._programs
+                  if program_name not in programs]
+      self._programs = programs
+      return changed
+
+  def Build(self):
+    """Brings the assembly of all programs up to date.
+
+    Returns:
+      A (program_asm, translated) tuple, where program_asm is an iterator
+      over the assembly of the project, bootstrap code included, and
+      translated is a list with the names of the programs that had to be
+      translated.
+
+    Raises:
+      hack_vm.VMError: If a program contains errors.
+      IOError: If a file cannot be read.
+    """
+    with self._lock:
+      self.Refresh()
+      plan = None
+      if self.options.NeedsLinkPlan():
+        plan = hack_vm.PlanLink(
+            [(program_name, entry.lines)
+             for program_name, entry in self._programs.items()],
+            self.options)
+      translated = []
+      for program_name, entry in self._programs.items():
+        plan_fingerprint = plan.Fingerprint(program_name) if plan else None
+        if (entry.program_asm is not None
+            and entry.plan_fingerprint == plan_fingerprint):
+          continue
+        if entry.decorated_commands is None:
+          entry.decorated_commands = hack_vm.DecorateCommands(
+              hack_vm.ParseProgram(entry.lines, program_name), program_name)
+        entry.program_asm = list(hack_vm.StreamAssembleCommands(
+            entry.decorated_commands, program_name, self.options, plan=plan))
+        entry.plan_fingerprint = plan_fingerprint
+        self.translations += 1
+        translated.append(program_name)
+      program_asm = hack_vm.StreamAttachBootstrapCode(
+          itertools.chain.from_iterable(
+              [entry.program_asm for entry in self._programs.values()]),
+          self.options)
+      return (program_asm, translated)
+
+  def Status(self):
+    """Returns a dict describing the programs of the project."""
+    with self._lock:
+      return collections.OrderedDict([
+          ("directory", self.directory),
+          ("options", self.options.ChangedSettings()),
+          ("translations", self.translations),
+          ("programs", collections.OrderedDict(
+              (program_name, collections.OrderedDict([
+                  ("path", entry.path),
+                  ("lines", len(entry.lines)),
+                  ("translated", entry.program_asm is not None)
+              ]))
+              for program_name, entry in self._programs.items()))
+      ])
+
+  def HandleRequest(self, request):
+    """Answers a request, see the description of the module.
+
+    Args:
+      request: A dict with the request.
+
+    Returns:
+      A dict with the response.
+    """
+    command = request.get("command")
+    try:
+      if command == "build":
+        start = time.time()
+        program_asm, translated = self.Build()
+        output = request.get("output") or os.path.join(
+            self.directory, "out.hack" if request.get("hack") else "out.asm")
+        if request.get("hack"):
+          hack_vm.WriteHackFile(program_asm, output)
+        else:
+          hack_vm.WriteAsmFile(program_asm, output)
+        return collections.OrderedDict([
+            ("status", "ok"),
+            ("output", output),
+            ("translated", translated),
+            ("seconds", time.time() - start)
+        ])
+      elif command == "status":
+        response = self.Status()
+        response["status"] = "ok"
+        return response
+      elif command == "stop":
+        self._stopped.set()
+        return {"status": "ok"}
+      return {"status": "error", "message": "Unknown command: %s" % (command,)}
+    except (hack_vm.VMError, hack_assembler.AssemblerError) as error:
+      return {"status": "error", "message": error.message}
+    except (IOError, OSError) as error:
+      return {"status": "error", "message": str(error)}
+
+  def Watch(self, poll_seconds=_DEFAULT_POLL_SECONDS):
+    """Starts a thread that translates changed files until Stop is called.
+
+    Args:
+      poll_seconds: The number of seconds between two checks for changes.
+
+    Returns:
+      The watcher thread.
+    """
+    def Poll():
+      while not self._stopped.wait(poll_seconds):
+        try:
+          if self.Refresh():
+            self.Build()
+        except (hack_vm.VMError, IOError, OSError):
+          # The error is reported by the next build request.
+          pass
+
+    watcher = threading.Thread(target=Poll)
+    watcher.daemon = True
+    watcher.start()
+    return watcher
+
+  def Stop(self):
+    """Stops the watcher thread and Serve."""
+    self._stopped.set()
+
+  def Serve(self, socket_path, poll_seconds=_DEFAULT_POLL_SECONDS):
+    """Answers requests on a Unix socket until a stop request arrives.
+
+    Args:
+      socket_path: The name of the socket file, which is replaced if it
+          exists and removed when the daemon stops.
+      poll_seconds: The number of seconds between two checks for changes.
+    """
+    if os.path.exists(socket_path):
+      os.remove(socket_path)
+    server = SocketServer.UnixStreamServer(socket_path, _RequestHandler)
+    server.translator = self
+    server.timeout = poll_seconds
+    watcher = self.Watch(poll_seconds)
+    try:
+      while not self._stopped.is_set():
+        server.handle_request()
+    finally:
+      self._stopped.set()
+      server.server_close()
+      os.remove(socket_path)
+      watcher.join()
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+  """Answers the request on one connection to the daemon."""
+
+  def handle(self):
+    try:
+      request = json.loads(self.rfile.readline())
+    except ValueError:
+      response = {"status": "error", "message": "Malformed request"}
+    else:
+      response = self.server.translator.HandleRequest(request)
+    self.wfile.write(json.dumps(response) + "\n")
+
+
+def SendRequest(socket_path, request):
+  """Sends a request to a daemon and waits for the response.
+
+  Args:
+    socket_path: The name of the socket of the daemon.
+    request: A dict with the request.
+
+  Returns:
+    A dict with the response.
+
+  Raises:
+    socket.error: If the daemon cannot be reached.
+  """
+  connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    connection.connect(socket_path)
+    connection.sendall(json.dumps(request) + "\n")
+    response = connection.makefile("r").readline()
+  finally:
+    connection.close()
+  return json.loads(response)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="Keeps a Hack VM project translated and answers build "
+                  "requests on a Unix socket.")
+  parser.add_argument(
+      "--socket", default=_DEFAULT_SOCKET,
+      help="the name of the socket of the daemon")
+  commands = parser.add_subparsers(dest="command")
+  serve_parser = commands.add_parser("serve", help="start the daemon")
+  serve_parser.add_argument("directory", help="the directory of the project")
+  serve_parser.add_argument(
+      "--poll-seconds", type=float, default=_DEFAULT_POLL_SECONDS,
+      help="the time between two checks for changed files")
+  hack_vm.AddTranslationArguments(serve_parser)
+  build_parser = commands.add_parser("build", help="build the project")
+  build_parser.add_argument(
+      "--output", help="the output file, out.asm or out.hack in the project "
+                       "directory by default")
+  build_parser.add_argument(
+      "--hack", action="store_true",
+      help="write machine code instead of assembly")
+  commands.add_parser("status", help="describe the project")
+  commands.add_parser("stop", help="stop the daemon")
+  arguments = parser.parse_args()
+
+  if arguments.command == "serve":
+    HackVMDaemon(
+        arguments.directory,
+        hack_vm.TranslationOptionsFromArguments(arguments)).Serve(
+            arguments.socket, arguments.poll_seconds)
+    return
+
+  request = {"command": arguments.command}
+  if arguments.command == "build":
+    request["hack"] = arguments.hack
+    if arguments.output:
+      request["output"] = os.path.abspath(arguments.output)
+  try:
+    response = SendRequest(arguments.socket, request)
+  except socket.error as error:
+    print "Cannot reach the daemon: %s" % (error,)
+    sys.exit(1)
+  if response["status"] != "ok":
+    print response["message"]
+    sys.exit(1)
+  if arguments.command == "build":
+    print "Translated %d programs in %.3f seconds" % (
+        len(response["translated"]), response["seconds"])
+  elif arguments.command == "status":
+    print json.dumps(response, indent=2)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2011 Ivan Vladimirov Ivanov (ivan.vladimirov.ivanov@gmail.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Test cases for the hack_vm_daemon module.
+"""
+
+
+__author__ = "Ivan Vladimirov Ivanov (ivan.vladimirov.ivanov@gmail.com)"
+
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import hack_vm
+import hack_vm_daemon
+
+
+_PROGRAMS = [
+    ("Main", ["function Main.double 0", "push argument 0", "push argument 0",
+              "add", "return", "function Main.unused 0", "push constant 1",
+              "return"]),
+    ("Sys", ["function Sys.init 0", "push constant 21",
+             "call Main.double 1", "pop static 0", "label END", "goto END"])
+]
+
+
+class TestHackVMDaemon(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    for program_name, program_lines in _PROGRAMS:
+      self._WriteProgram(program_name, program_lines)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def _WriteProgram(self, program_name, program_lines):
+    path = os.path.join(self.directory, program_name + ".vm")
+    with open(path, "w") as vm_file:
+      vm_file.write("\n".join(program_lines) + "\n")
+    # The modification time may not change within the same second.
+    os.utime(path, (0, len(program_lines)))
+
+  def _Expected(self, options):
+    return hack_vm.AttachBootstrapCode(
+        hack_vm.LinkPrograms(hack_vm.FindPrograms(self.directory),
+                             options=options),
+        options)
+
+  def testBuildTranslatesChangedFiles(self):
+    options = hack_vm.TranslationOptions(eliminate_dead_functions=True)
+    daemon = hack_vm_daemon.HackVMDaemon(self.directory, options)
+    program_asm, translated = daemon.Build()
+    self.assertEqual(["Main", "Sys"], translated)
+    self.assertEqual(self._Expected(options), list(program_asm))
+    program_asm, translated = daemon.Build()
+    self.assertEqual([], translated)
+    self.assertEqual(self._Expected(options), list(program_asm))
+
+    self._WriteProgram("Sys", _PROGRAMS[1][1] + ["call Main.unused 0"])
+    self.assertEqual(["Sys"], daemon.Refresh())
+    # Main.unused is now live, so Main is translated again as well.
+    program_asm, translated = daemon.Build()
+    self.assertEqual(["Main", "Sys"], translated)
+    self.assertEqual(self._Expected(options), list(program_asm))
+
+    os.remove(os.path.join(self.directory, "Main.vm"))
+    self._WriteProgram("Math", _PROGRAMS[0][1])
+    self.assertEqual(["Math", "Main"], daemon.Refresh())
+    program_asm, translated = daemon.Build()
+    self.assertEqual(["Math"], translated)
+    self.assertEqual(self._Expected(options), list(program_asm))
+    self.assertEqual(5, daemon.translations)
+
+  def testHandleRequest(self):
+    daemon = hack_vm_daemon.HackVMDaemon(self.directory)
+    output = os.path.join(self.directory, "out.asm")
+    response = daemon.HandleRequest({"command": "build", "output": output})
+    self.assertEqual("ok", response["status"])
+    with open(output, "r") as asm_file:
+      self.assertEqual(self._Expected(None), asm_file.read().splitlines())
+
+    self._WriteProgram("Main", ["push nowhere 0"])
+    response = daemon.HandleRequest({"command": "build", "output": output})
+    self.assertEqual("error", response["status"])
+    self.assertTrue("nowhere" in response["message"])
+    response = daemon.HandleRequest({"command": "status"})
+    self.assertEqual(1, response["programs"]["Main"]["lines"])
+    self.assertFalse(response["programs"]["Main"]["translated"])
+    self.assertEqual(
+        "error", daemon.HandleRequest({"command": "restart"})["status"])
+
+  def testServe(self):
+    daemon = hack_vm_daemon.HackVMDaemon(self.directory)
+    socket_path = os.path.join(self.directory, "daemon.sock")
+    server = threading.Thread(target=daemon.Serve, args=(socket_path, 0.05))
+    server.start()
+    try:
+      while not os.path.exists(socket_path):
+        server.join(0.01)
+      response = hack_vm_daemon.SendRequest(
+          socket_path, {"command": "build", "hack": True})
+      self.assertEqual("ok", response["status"])
+      self.assertEqual(os.path.join(self.directory, "out.hack"),
+                       response["output"])
+      self.assertTrue(os.path.exists(response["output"]))
+      self.assertEqual("ok", hack_vm_daemon.SendRequest(
+          socket_path, {"command": "stop"})["status"])
+    finally:
+      daemon.Stop()
+      server.join()
+    self.assertFalse(os.path.exists(socket_path))
+
+
+if __name__ == "__main__":
+  unittest.main()
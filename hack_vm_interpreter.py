@@ -0,0 +1,365 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2011 Ivan Vladimirov Ivanov (ivan.vladimirov.ivanov@gmail.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+This module implements an interpreter for the virtual machine of the Hack
+platform described in chapter 7 and chapter 8 of the book "The Elements of
+Computing Systems: Building a Modern Computer from First Principles"
+(http://www1.idc.ac.il/tecs/).
+
+The interpreter executes the commands produced by the hack_vm parser
+directly, without translating them to assembly, which makes it a quick way
+to test VM programs.
+"""
+
+
+__author__ = "Ivan Vladimirov Ivanov (ivan.vladimirov.ivanov@gmail.com)"
+
+
+import argparse
+import os
+
+import hack_vm
+
+
+# The number of words in the data memory of the Hack computer.
+RAM_WORDS = 32768
+
+
+class HackVMInterpreter(object):
+  """This class executes linked VM programs.
+
+  Before execution every command is compiled into an (opcode, x, y) tuple:
+  segment accesses are resolved to RAM addresses or pointer addresses, and
+  labels and functions to indices into the list of instructions. The memory
+  layout is the one of the translated programs: the pointers live in RAM[0]
+  to RAM[4], the stack starts at 256 and call frames are stored on the stack
+  exactly as the generated assembly stores them, except that return
+  addresses are instruction indices. Static variables are allocated from
+  address 16 in the order the assembler would allocate them.
+
+  The program halts when it jumps to a goto that jumps to itself, as in
+  "label HALT; goto HALT", when it returns from Sys.init or when it runs past
+  its last command.
+
+  Attributes:
+    ram: The list of data memory words, unsigned 16 bit integers.
+    symbols: A dict mapping static variables like "Main.0" to addresses.
+    steps: The number of commands executed so far.
+    halted: Whether the program has halted.
+  """
+
+  (_PUSH_CONSTANT, _PUSH_DIRECT, _PUSH_INDIRECT, _POP_DIRECT, _POP_INDIRECT,
+   _ADD, _SUB, _NEG, _EQ, _GT, _LT, _AND, _OR, _NOT, _GOTO, _IF_GOTO,
+   _FUNCTION, _CALL, _RETURN, _HALT) = range(20)
+
+  _SIMPLE_OPCODES = {
+      hack_vm.AddCommand: _ADD,
+      hack_vm.SubCommand: _SUB,
+      hack_vm.NegCommand: _NEG,
+      hack_vm.EqCommand: _EQ,
+      hack_vm.GtCommand: _GT,
+      hack_vm.LtCommand: _LT,
+      hack_vm.AndCommand: _AND,
+      hack_vm.OrCommand: _OR,
+      hack_vm.NotCommand: _NOT,
+      hack_vm.ReturnCommand: _RETURN
+  }
+
+  # Segments addressed directly, mapped to their base address.
+  _DIRECT_SEGMENTS = {"temp": 5, "pointer": 3}
+
+  # Segments addressed through a pointer, mapped to the pointer address.
+  _INDIRECT_SEGMENTS = {"local": 1, "argument": 2, "this": 3, "that": 4}
+
+  _STACK_BASE = 256
+
+  _FIRST_STATIC_ADDRESS = 16
+
+  def __init__(self, programs, entry_function="Sys.init"):
+    """Compiles the programs.
+
+    Args:
+      programs: A list of (program_name, program_lines) tuples.
+      entry_function: The function called to start the programs. When it is
+          not defined, the execution starts at the first command instead.
+
+    Raises:
+      hack_vm.VMError: If a program does not parse or refers to a label or
+          function that does not exist.
+    """
+    self.symbols = {}
+    decorated_commands = []
+    for program_name, program_lines in programs:
+      decorated_commands.extend(hack_vm.DecorateCommands(
+          hack_vm.ParseProgram(program_lines, program_name), program_name))
+    self._ResolveLabels(decorated_commands)
+    self._code = self._Compile(decorated_commands)
+    self._entry = self._functions.get(entry_function)
+    self.Reset()
+
+  def Reset(self):
+    """Clears the memory and prepares the call of the entry function."""
+    self.ram = [0] * RAM_WORDS
+    self.steps = 0
+    self.halted = False
+    self._sp = HackVMInterpreter._STACK_BASE
+    self._pc = 0
+    if self._entry is not None:
+      # Like the bootstrap code, call the entry function with a frame whose
+      # return address is the end of the code.
+      self.ram[self._sp:self._sp + 5] = [len(self._code) - 1, 0, 0, 0, 0]
+      self._sp += 5
+      self.ram[1] = self._sp
+      self.ram[2] = self._sp - 5
+      self._pc = self._entry
+    self.ram[0] = self._sp
+
+  def Run(self, max_steps=None):
+    """Executes commands until the program halts.
+
+    Args:
+      max_steps: An optional limit on the total number of commands, after
+          which the execution stops even if the program did not halt.
+
+    Returns:
+      True if the program halted, False if the step limit was reached.
+    """
+    cls = HackVMInterpreter
+    code = self._code
+    ram = self.ram
+    sp, pc = self._sp, self._pc
+    steps = self.steps
+    limit = max_steps if max_steps is not None else float("inf")
+    try:
+      while steps < limit:
+        opcode, x, y = code[pc]
+        if opcode == cls._HALT:
+          self.halted = True
+          break
+        steps += 1
+        pc += 1
+        if opcode == cls._PUSH_CONSTANT:
+          ram[sp] = x
+          sp += 1
+        elif opcode == cls._PUSH_INDIRECT:
+          ram[sp] = ram[(ram[x] + y) & 0x7FFF]
+          sp += 1
+        elif opcode == cls._POP_INDIRECT:
+          sp -= 1
+          ram[(ram[x] + y) & 0x7FFF] = ram[sp]
+        elif opcode == cls._PUSH_DIRECT:
+          ram[sp] = ram[x]
+          sp += 1
+        elif opcode == cls._POP_DIRECT:
+          sp -= 1
+          ram[x] = ram[sp]
+        elif opcode == cls._ADD:
+          sp -= 1
+          ram[sp - 1] = (ram[sp - 1] + ram[sp]) & 0xFFFF
+        elif opcode == cls._SUB:
+          sp -= 1
+          ram[sp - 1] = (ram[sp - 1] - ram[sp]) & 0xFFFF
+        elif opcode == cls._IF_GOTO:
+          sp -= 1
+          if ram[sp]:
+            pc = x
+        elif opcode == cls._GOTO:
+          pc = x
+        elif opcode in (cls._EQ, cls._GT, cls._LT):
+          # Like the generated code, test the sign of the 16 bit difference
+          # of the second operand minus the first one, including its
+          # behavior on overflow: gt jumps on JLT and lt on JGT.
+          sp -= 1
+          difference = (ram[sp] - ram[sp - 1]) & 0xFFFF
+          if opcode == cls._EQ:
+            result = difference == 0
+          elif opcode == cls._GT:
+            result = difference >= 0x8000
+          else:
+            result = 0 < difference < 0x8000
+          ram[sp - 1] = 0xFFFF if result else 0
+        elif opcode == cls._NEG:
+          ram[sp - 1] = -ram[sp - 1] & 0xFFFF
+        elif opcode == cls._NOT:
+          ram[sp - 1] ^= 0xFFFF
+        elif opcode == cls._AND:
+          sp -= 1
+          ram[sp - 1] &= ram[sp]
+        elif opcode == cls._OR:
+          sp -= 1
+          ram[sp - 1] |= ram[sp]
+        elif opcode == cls._CALL:
+          ram[sp] = pc
+          ram[sp + 1:sp + 5] = ram[1:5]
+          sp += 5
+          ram[2] = sp - y - 5
+          ram[1] = sp
+          pc = x
+        elif opcode == cls._FUNCTION:
+          ram[sp:sp + x] = [0] * x
+          sp += x
+        elif opcode == cls._RETURN:
+          frame = ram[1]
+          argument = ram[2]
+          pc = ram[frame - 5]
+          ram[argument] = ram[sp - 1]
+          sp = argument + 1
+          ram[1:5] = ram[frame - 4:frame]
+    finally:
+      self._sp, self._pc = sp, pc
+      self.ram[0] = sp
+      self.steps = steps
+    return self.halted
+
+  def Peek(self, address):
+    """Returns the signed value of the data memory word at address."""
+    value = self.ram[address]
+    return value - 0x10000 if value & 0x8000 else value
+
+  def _ResolveLabels(self, decorated_commands):
+    # Maps every label and function to the index of its first instruction.
+    # Labels and empty commands are not compiled into instructions.
+    self._labels = {}
+    self._functions = {}
+    index = 0
+    for command, _, function_name, _ in decorated_commands:
+      command_type = command.__class__
+      if command_type is hack_vm.LabelCommand:
+        self._labels["%s$%s" % (function_name, command.label_name)] = index
+      elif command_type is not hack_vm.EmptyCommand:
+        if command_type is hack_vm.FunctionCommand:
+          self._functions[command.function_name] = index
+        index += 1
+
+  def _Compile(self, decorated_commands):
+    # Translates decorated commands into (opcode, x, y) tuples. A halt
+    # instruction is appended as the target of the final return.
+    cls = HackVMInterpreter
+    code = []
+    errors = []
+    for command, name, function_name, _ in decorated_commands:
+      command_type = command.__class__
+      if command_type in (hack_vm.EmptyCommand, hack_vm.LabelCommand):
+        continue
+      if command_type in cls._SIMPLE_OPCODES:
+        code.append((cls._SIMPLE_OPCODES[command_type], 0, 0))
+      elif command_type in (hack_vm.PushCommand, hack_vm.PopCommand):
+        code.append(self._CompileMemoryAccess(command, name))
+      elif command_type in (hack_vm.GotoCommand, hack_vm.IfGotoCommand):
+        target = self._labels.get(
+            "%s$%s" % (function_name, command.label_name))
+        if target is None:
+          errors.append("%s: undefined label %s" % (
+              function_name, command.label_name))
+        elif target == len(code) and command_type is hack_vm.GotoCommand:
+          code.append((cls._HALT, 0, 0))
+        else:
+          opcode = cls._GOTO
+          if command_type is hack_vm.IfGotoCommand:
+            opcode = cls._IF_GOTO
+          code.append((opcode, target, 0))
+      elif command_type is hack_vm.FunctionCommand:
+        code.append((cls._FUNCTION, command.local_variables, 0))
+      elif command_type is hack_vm.CallCommand:
+        target = self._functions.get(command.function_name)
+        if target is None:
+          errors.append("%s: undefined function %s" % (
+              function_name, command.function_name))
+        else:
+          code.append((cls._CALL, target, command.arguments))
+    if len(errors) > 0:
+      raise hack_vm.VMError("Error: " + os.linesep.join(errors))
+    code.append((cls._HALT, 0, 0))
+    return code
+
+  def _CompileMemoryAccess(self, command, name):
+    # Translates a push or pop command into an (opcode, x, y) tuple.
+    cls = HackVMInterpreter
+    push = command.__class__ is hack_vm.PushCommand
+    segment, index = command.segment, command.index
+    if segment == "constant":
+      return (cls._PUSH_CONSTANT, index, 0)
+    if segment in cls._INDIRECT_SEGMENTS:
+      return (cls._PUSH_INDIRECT if push else cls._POP_INDIRECT,
+              cls._INDIRECT_SEGMENTS[segment], index)
+    if segment == "static":
+      symbol = "%s.%d" % (name, index)
+      if symbol not in self.symbols:
+        self.symbols[symbol] = cls._FIRST_STATIC_ADDRESS + len(self.symbols)
+      address = self.symbols[symbol]
+    else:
+      address = cls._DIRECT_SEGMENTS[segment] + index
+    return (cls._PUSH_DIRECT if push else cls._POP_DIRECT, address, 0)
+
+
+def ReadPrograms(path):
+  """Reads the VM programs of a .vm file or of a project directory.
+
+  Args:
+    path: The name of a .vm file or of a directory.
+
+  Returns:
+    A list of (program_name, program_lines) tuples, sorted by file name.
+
+  Raises:
+    hack_vm.VMError: If two files define programs with the same name.
+  """
+  return [(program_name, list(program_lines))
+          for program_name, program_lines in hack_vm.FindPrograms(path)]
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="Executes Hack VM programs without translating them.")
+  parser.add_argument("path", help="a .vm file or a directory of .vm files")
+  parser.add_argument(
+      "--max-steps", type=int,
+      help="stop after this many commands if the program does not halt")
+  parser.add_argument(
+      "--peek", metavar="SYMBOL", action="append", default=[],
+      help="print the RAM word at an address or static variable")
+  arguments = parser.parse_args()
+
+  try:
+    interpreter = HackVMInterpreter(ReadPrograms(arguments.path))
+    interpreter.Run(arguments.max_steps)
+    print "Steps: %d" % (interpreter.steps,)
+    print "Halted: %s" % (interpreter.halted,)
+    for symbol in arguments.peek:
+      if symbol.isdigit():
+        address = int(symbol)
+      else:
+        address = interpreter.symbols.get(symbol)
+      if address is None:
+        print "%s: unknown symbol" % (symbol,)
+      else:
+        print "%s: %d" % (symbol, interpreter.Peek(address))
+  except hack_vm.VMError as error:
+    print error.message
+  except (IOError, OSError) as error:
+    print error
+
+
+if __name__ == "__main__":
+  main()
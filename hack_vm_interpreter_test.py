@@ -0,0 +1,133 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2011 Ivan Vladimirov Ivanov (ivan.vladimirov.ivanov@gmail.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Test cases for the hack_vm_interpreter module.
+"""
+
+
+__author__ = "Ivan Vladimirov Ivanov (ivan.vladimirov.ivanov@gmail.com)"
+
+
+import unittest
+
+import hack_emulator
+import hack_vm
+import hack_vm_interpreter
+
+
+_SAMPLE_PROGRAM = [
+    "function Main.sum 1",
+    "  push constant 0",
+    "  pop local 0",
+    "label LOOP",
+    "  push argument 0",
+    "  push constant 0",
+    "  eq",
+    "  if-goto END",
+    "  push local 0",
+    "  push argument 0",
+    "  add",
+    "  pop local 0",
+    "  push argument 0",
+    "  push constant 1",
+    "  sub",
+    "  pop argument 0",
+    "  goto LOOP",
+    "label END",
+    "  push local 0",
+    "  return",
+    "",
+    "function Sys.init 0",
+    "  push constant 10",
+    "  call Main.sum 1",
+    "  pop static 0",
+    "  push constant 20000",
+    "  push constant 20000",
+    "  neg",
+    "  gt",
+    "  pop static 1",
+    "  push constant 0",
+    "  push constant 32767",
+    "  push constant 1",
+    "  add",
+    "  gt",
+    "  pop static 2",
+    "  push constant 0",
+    "  push constant 32767",
+    "  push constant 1",
+    "  add",
+    "  lt",
+    "  pop static 3",
+    "  push constant 3000",
+    "  pop pointer 1",
+    "  push constant 7",
+    "  not",
+    "  pop that 2",
+    "label HALT",
+    "  goto HALT"
+]
+
+
+class TestHackVMInterpreter(unittest.TestCase):
+
+  def testRun(self):
+    interpreter = hack_vm_interpreter.HackVMInterpreter(
+        [("Main", _SAMPLE_PROGRAM)])
+    self.assertFalse(interpreter.Run(10))
+    self.assertEqual(10, interpreter.steps)
+    self.assertTrue(interpreter.Run())
+    self.assertEqual(55, interpreter.Peek(interpreter.symbols["Main.0"]))
+    self.assertEqual(-8, interpreter.Peek(3002))
+    self.assertEqual(261, interpreter.Peek(0))
+
+  def testMatchesTranslatedProgram(self):
+    programs = [("Main", _SAMPLE_PROGRAM)]
+    interpreter = hack_vm_interpreter.HackVMInterpreter(programs)
+    interpreter.Run()
+    emulator, symbols = hack_emulator.RunAsm(
+        hack_vm.AttachBootstrapCode(hack_vm.LinkPrograms(programs)))
+    self.assertTrue(emulator.halted)
+    for symbol, address in interpreter.symbols.items():
+      self.assertEqual(symbols[symbol], address)
+    # The comparison overflows, just like in the generated code.
+    self.assertEqual(0, interpreter.Peek(interpreter.symbols["Main.1"]))
+    # At a difference of 0x8000, 0 is greater than 32767 + 1.
+    self.assertEqual(-1, interpreter.Peek(interpreter.symbols["Main.2"]))
+    self.assertEqual(0, interpreter.Peek(interpreter.symbols["Main.3"]))
+    self.assertEqual(emulator.ram[:5], interpreter.ram[:5])
+    self.assertEqual(emulator.ram[16:20], interpreter.ram[16:20])
+    self.assertEqual(emulator.ram[3000:3003], interpreter.ram[3000:3003])
+
+  def testUndefinedTargets(self):
+    try:
+      hack_vm_interpreter.HackVMInterpreter(
+          [("Main", ["function Main.f 0", "goto L", "call Main.g 0"])])
+      self.fail("VMError expected")
+    except hack_vm.VMError as error:
+      self.assertTrue("undefined label L" in error.message)
+      self.assertTrue("undefined function Main.g" in error.message)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -29,10 +29,50 @@ Test cases for the hack_vm module.
 __author__ = "Ivan Vladimirov Ivanov (ivan.vladimirov.ivanov@gmail.com)"
 
 
+import StringIO
+import collections
+import os
+import shutil
+import tempfile
 import unittest
 
+import hack_assembler
+import hack_emulator
 import hack_vm
 
+
+_SAMPLE_PROGRAM = [
+    "// Computes the sum of the first n numbers.",
+    "function Main.sum 1",
+    "  push constant 0",
+    "  pop local 0",
+    "label LOOP",
+    "  push argument 0",
+    "  push constant 0",
+    "  eq",
+    "  if-goto END",
+    "  push local 0",
+    "  push argument 0",
+    "  add",
+    "  pop local 0",
+    "  push argument 0",
+    "  push constant 1",
+    "  sub",
+    "  pop argument 0",
+    "  goto LOOP",
+    "label END",
+    "  push local 0",
+    "  return",
+    "",
+    "function Sys.init 0",
+    "  push constant 10",
+    "  call Main.sum 1",
+    "  pop static 0",
+    "label HALT",
+    "  goto HALT"
+]
+
+
 class TestHackVM(unittest.TestCase):
 
   def testParseCommand(self):
@@ -61,6 +101,43 @@ class TestHackVM(unittest.TestCase):
     self.assertTrue(result3 != False)
     self.assertTrue(result3.__class__.__name__ == "ErrorCommand")
 
+  def testParseLines(self):
+    lines = [
+        "push constant 13 // comment",
+        "pop constant 1",
+        "push local",
+        "push local 1 2",
+        "add 1",
+        "goto 1abc",
+        "if-goto a-b // comment",
+        "call Foo.bar x",
+        "  label END",
+        "function Main.sum 1",
+        "return",
+        "  \t ",
+        "   pop  foo 2  //I like pie!"]
+    expected = [
+        hack_vm.PushCommand("constant", 13),
+        hack_vm.ErrorCommand("pop constant 1"),
+        hack_vm.ErrorCommand("push local"),
+        hack_vm.ErrorCommand("push local 1 2"),
+        hack_vm.ErrorCommand("add 1"),
+        hack_vm.ErrorCommand("goto 1abc"),
+        hack_vm.IfGotoCommand("a-b"),
+        hack_vm.ErrorCommand("call Foo.bar x"),
+        hack_vm.LabelCommand("END"),
+        hack_vm.FunctionCommand("Main.sum", 1),
+        hack_vm.ReturnCommand(),
+        hack_vm.EmptyCommand(),
+        hack_vm.ErrorCommand("pop  foo 2")]
+    for parsed in [hack_vm.HackParser.ParseLines(lines),
+                   map(hack_vm.HackParser.ParseCommand, lines)]:
+      self.assertEqual(
+          [(command.__class__, hack_vm.CommandFields(command))
+           for command in expected],
+          [(command.__class__, hack_vm.CommandFields(command))
+           for command in parsed])
+
   def testParseProgram(self):
     self.assertRaises(
         hack_vm.VMError, hack_vm.ParseProgram, ["foo"], "foo")
@@ -148,6 +225,585 @@ class TestHackVM(unittest.TestCase):
         hack_vm.PopCommand("static", 42), "foo", "bar", 3)
     self.assertTrue("@foo.42" in result3)
 
+  def testGenerateAsmSmallIndices(self):
+    def Generate(command):
+      return list(hack_vm.HackCodeGenerator.GenerateAsm(
+          command, "foo", "bar", 1))
+
+    self.assertEqual(
+        ["@1", "A=M", "D=M", "@SP", "A=M", "M=D", "@SP", "M=M+1"],
+        Generate(hack_vm.PushCommand("local", 0)))
+    self.assertEqual(
+        ["@4", "A=M+1", "A=A+1", "D=M", "@SP", "A=M", "M=D", "@SP",
+         "M=M+1"],
+        Generate(hack_vm.PushCommand("that", 2)))
+    self.assertTrue("A=D+A" in Generate(hack_vm.PushCommand("that", 3)))
+
+    self.assertEqual(
+        ["@SP", "AM=M-1", "D=M", "@2", "A=M+1", "M=D"],
+        Generate(hack_vm.PopCommand("argument", 1)))
+    self.assertEqual(12, len(Generate(hack_vm.PopCommand("this", 7))))
+    self.assertTrue("@13" in Generate(hack_vm.PopCommand("this", 8)))
+
+  def testGenerateAsmTrampolines(self):
+    options = hack_vm.TranslationOptions(trampolines=True)
+    generators = hack_vm.HackCodeGenerator.GetGenerators(options)
+    call_asm = generators[hack_vm.CallCommand](
+        hack_vm.CallCommand("Foo.bar", 2), "foo", "bar", 7)
+    self.assertTrue("@$$CALL" in call_asm)
+    self.assertTrue("@Foo.bar" in call_asm)
+    self.assertTrue("(foo$7$return_address)" in call_asm)
+    return_asm = generators[hack_vm.ReturnCommand](
+        hack_vm.ReturnCommand(), "foo", "bar", 8)
+    self.assertEqual(["@$$RETURN", "0;JMP"], return_asm)
+
+    program_asm = hack_vm.AttachBootstrapCode(
+        hack_vm.LinkPrograms([("Main", _SAMPLE_PROGRAM)], options=options),
+        options)
+    self.assertEqual(1, program_asm.count("($$CALL)"))
+    self.assertEqual(1, program_asm.count("($$RETURN)"))
+    self.assertEqual(
+        [], hack_vm.HackCodeGenerator.GenerateRuntimeAsm(
+            hack_vm.TranslationOptions()))
+
+  def testGenerateAsmSharedComparisons(self):
+    options = hack_vm.TranslationOptions(shared_comparisons=True)
+    generators = hack_vm.HackCodeGenerator.GetGenerators(options)
+    for command, routine in [
+        (hack_vm.EqCommand(), "$$EQ"),
+        (hack_vm.GtCommand(), "$$GT"),
+        (hack_vm.LtCommand(), "$$LT")]:
+      result = generators[command.__class__](command, "foo", "bar", 3)
+      self.assertTrue("@" + routine in result)
+      self.assertTrue("(foo$3$end)" in result)
+      self.assertEqual(4, hack_vm.CountRomWords(result))
+
+    runtime_asm = hack_vm.HackCodeGenerator.GenerateRuntimeAsm(options)
+    for routine, op in [("$$EQ", "JEQ"), ("$$GT", "JLT"), ("$$LT", "JGT")]:
+      self.assertTrue("(%s)" % (routine,) in runtime_asm)
+      self.assertTrue("D;" + op in runtime_asm)
+
+  def _OptimizeCommands(self, program_lines, statistics=None):
+    return [
+        hack_vm.HackCodeGenerator.GenerateAsm(*decorated_command)
+        for decorated_command in hack_vm.HackCommandOptimizer.StreamOptimize(
+            hack_vm.DecorateCommands(
+                hack_vm.ParseProgram(program_lines, "foo"), "foo"),
+            statistics)]
+
+  def testMemoizedTemplates(self):
+    generators = hack_vm.HackCodeGenerator.GetGenerators(
+        hack_vm.TranslationOptions())
+    generate_push = generators[hack_vm.PushCommand]
+    first = generate_push(hack_vm.PushCommand("local", 2), "foo", "bar", 1)
+    second = generate_push(hack_vm.PushCommand("local", 2), "baz", "qux", 9)
+    self.assertTrue(first is second)
+    self.assertEqual(
+        hack_vm.HackCodeGenerator.GenerateAsm(
+            hack_vm.PushCommand("local", 2), "foo", "bar", 1),
+        list(first))
+    self.assertTrue(
+        generators[hack_vm.AddCommand](hack_vm.AddCommand(), "a", "b", 1) is
+        generators[hack_vm.AddCommand](hack_vm.AddCommand(), "c", "d", 2))
+    # The code of static variables depends on the file name.
+    self.assertEqual(
+        ["@foo.1", "D=M"],
+        generate_push(hack_vm.PushCommand("static", 1), "foo", "bar", 1)[:2])
+    self.assertEqual(
+        ["@baz.1", "D=M"],
+        generate_push(hack_vm.PushCommand("static", 1), "baz", "bar", 1)[:2])
+
+    for index in range(2 * hack_vm.HackCodeGenerator._MAX_TEMPLATES):
+      generate_push(hack_vm.PushCommand("constant", index), "foo", "bar", 1)
+    self.assertTrue(
+        len(hack_vm.HackCodeGenerator._templates) <=
+        hack_vm.HackCodeGenerator._MAX_TEMPLATES)
+
+  def testFoldConstants(self):
+    statistics = collections.Counter()
+    self.assertEqual(
+        self._OptimizeCommands(["push constant 12"]),
+        self._OptimizeCommands([
+            "push constant 2", "push constant 3", "add",
+            "push constant 7", "neg", "sub",
+            "push constant 1", "push constant 1", "eq",
+            "and", "neg", "neg"],
+            statistics))
+    self.assertEqual(11, statistics["ir.constant-folding"])
+    self.assertEqual(
+        self._OptimizeCommands(["push constant 2", "neg"]),
+        self._OptimizeCommands(
+            ["push constant 1", "push constant 3", "sub"]))
+    self.assertEqual(
+        self._OptimizeCommands(["push constant 32767", "not"]),
+        self._OptimizeCommands(
+            ["push constant 32767", "push constant 1", "add"]))
+    # Expressions with operands that are not constant are kept.
+    self.assertEqual(
+        3, len(self._OptimizeCommands(
+            ["push local 0", "push constant 3", "add"])))
+
+  def testRemoveUnreachableCode(self):
+    statistics = collections.Counter()
+    result = self._OptimizeCommands(
+        ["function foo 0", "goto bar", "push constant 1", "// comment",
+         "label bar", "push constant 1", "return", "pop local 0",
+         "function baz 0", "push constant 2"],
+        statistics)
+    self.assertEqual(7, len(result))
+    self.assertEqual(2, statistics["ir.unreachable-code"])
+
+  def testRemoveRedundantMoves(self):
+    statistics = collections.Counter()
+    result = self._OptimizeCommands(
+        ["push local 0", "pop local 0", "push local 1", "pop local 2",
+         "push constant 3", "push static 1", "pop static 1", "pop temp 0"],
+        statistics)
+    self.assertEqual(4, len(result))
+    self.assertEqual(4, statistics["ir.redundant-moves"])
+
+  def testStackCachingCodeGenerator(self):
+    options = hack_vm.TranslationOptions(stack_caching=True)
+    result1 = hack_vm.AssembleProgram(
+        ["push constant 2", "push local 1", "add", "neg", "pop temp 0"],
+        "foo", options)
+    self.assertEqual(
+        ["@2", "D=A",
+         "@SP", "AM=M+1", "A=A-1", "M=D",
+         "@1", "A=M+1", "D=M",
+         "@SP", "AM=M-1", "D=D+M",
+         "D=-D",
+         "@5", "M=D"],
+        result1)
+
+    # The cached value is spilled before labels and at the end.
+    result2 = hack_vm.AssembleProgram(
+        ["push constant 1", "label foo", "push constant 0"], "foo", options)
+    self.assertEqual(
+        ["D=1", "@SP", "AM=M+1", "A=A-1", "M=D", "(DEFAULT_FUNCTION$foo)",
+         "D=0", "@SP", "AM=M+1", "A=A-1", "M=D"],
+        result2)
+
+    # A conditional jump consumes the cached value.
+    result3 = hack_vm.AssembleProgram(
+        ["push argument 0", "if-goto foo"], "foo", options)
+    self.assertEqual(["D;JNE"], result3[-1:])
+    self.assertFalse("@SP" in result3)
+
+    result4 = hack_vm.AssembleProgram(["pop local 2"], "foo", options)
+    self.assertEqual(
+        ["@SP", "AM=M-1", "D=M", "@1", "A=M+1", "A=A+1", "M=D"], result4)
+    result5 = hack_vm.AssembleProgram(["pop local 42"], "foo", options)
+    self.assertTrue("@42" in result5)
+    self.assertTrue("@14" in result5)
+
+  def testFuseCommands(self):
+    self.assertTrue(hack_vm.HackCommandFuser.IsFusable(
+        ["push local", "push constant", "add", "neg", "pop that"]))
+    self.assertTrue(hack_vm.HackCommandFuser.IsFusable(
+        ["push local", "push argument", "gt", "not", "if-goto"]))
+    self.assertFalse(hack_vm.HackCommandFuser.IsFusable(
+        ["push local", "push argument", "add"]))
+    self.assertFalse(hack_vm.HackCommandFuser.IsFusable(
+        ["push local", "push argument", "gt", "pop local"]))
+
+    statistics = collections.Counter()
+    program_lines = [
+        "function Main.f 1", "push local 0", "push constant 1", "add",
+        "pop local 0", "label LOOP", "push argument 0", "push constant 9",
+        "lt", "not", "if-goto LOOP", "push this 5", "push that 0", "add",
+        "return"]
+    fused_commands = list(
+        hack_vm.HackCommandFuser(statistics=statistics).StreamFuse(
+            hack_vm.DecorateCommands(
+                hack_vm.ParseProgram(program_lines, "Main"), "Main")))
+    self.assertEqual(8, len(fused_commands))
+    self.assertEqual(1, statistics["fusion.binary"])
+    self.assertEqual(1, statistics["fusion.compare-not-branch"])
+    self.assertEqual(
+        ["@1", "A=M", "D=M", "@1", "D=D+A", "@1", "A=M", "M=D"],
+        hack_vm.HackCommandFuser.GenerateAsm(*fused_commands[1]))
+    self.assertEqual(
+        ["@2", "A=M", "D=M", "@9", "D=A-D", "@Main.f$LOOP", "D;JLE"],
+        hack_vm.HackCommandFuser.GenerateAsm(*fused_commands[3]))
+    self.assertEqual(
+        [(["push local", "push constant", "add", "pop local"], 1)],
+        hack_vm.HackCommandFuser(fusions=[]).MineFusions(
+            [("Main", program_lines[:5])]))
+
+  def testPeepholeOptimizer(self):
+    statistics = collections.Counter()
+    optimizer = hack_vm.HackPeepholeOptimizer(statistics=statistics)
+    program_asm = hack_vm.AssembleProgram(
+        ["push constant 5", "pop temp 0"], "foo")
+    self.assertEqual(
+        ["@5", "D=A", "@5", "M=D"],
+        list(optimizer.Optimize(program_asm)))
+    self.assertEqual(1, statistics["peephole.push-pop"])
+    self.assertEqual(1, statistics["peephole.dead-address"])
+    self.assertEqual(1, statistics["peephole.dead-load"])
+    program_asm = hack_vm.AssembleProgram(
+        ["push constant 5", "pop local 0"], "foo")
+    self.assertEqual(
+        ["@5", "D=A", "@1", "A=M", "M=D"],
+        list(optimizer.Optimize(program_asm)))
+    self.assertEqual(1, statistics["peephole.push-pop-decrement"])
+
+    # Labels are never rewritten across.
+    self.assertEqual(
+        ["@5", "(foo)", "@6"],
+        list(optimizer.Optimize(["@5", "(foo)", "@6"])))
+
+    optimizer = hack_vm.HackPeepholeOptimizer(
+        rules=[("double-negation", ["M=-M", "M=-M"], [])])
+    self.assertEqual(
+        ["@SP", "A=M-1", "M=!M"],
+        list(optimizer.Optimize(
+            ["@SP", "A=M-1", "M=-M", "M=-M", "M=-M", "M=-M", "M=!M"])))
+    self.assertEqual(2, optimizer.statistics["peephole.double-negation"])
+
+  def testPeepholeOption(self):
+    programs = [("Main", _SAMPLE_PROGRAM)]
+    options = hack_vm.TranslationOptions(peephole=True)
+    statistics = collections.Counter()
+    optimized_asm = hack_vm.LinkPrograms(
+        programs, workers=2, options=options, statistics=statistics)
+    self.assertTrue(
+        len(optimized_asm) < len(hack_vm.LinkPrograms(programs)))
+    self.assertTrue(statistics["peephole.push-pop"] > 0)
+
+  def testMeasureRomSavings(self):
+    programs = [("Main", _SAMPLE_PROGRAM)] * 4
+    options = hack_vm.TranslationOptions(trampolines=True)
+    rom_words, savings = hack_vm.MeasureRomSavings(programs, options)
+    self.assertEqual(
+        hack_vm.CountRomWords(
+            hack_vm.AttachBootstrapCode(
+                hack_vm.LinkPrograms(programs, options=options), options)),
+        rom_words)
+    self.assertEqual(1, len(savings))
+    self.assertEqual("trampolines", savings[0][0])
+    self.assertTrue(savings[0][1] > 0)
+    self.assertEqual(
+        (rom_words + savings[0][1], []),
+        hack_vm.MeasureRomSavings(programs, hack_vm.TranslationOptions()))
+
+  def testEliminateDeadFunctions(self):
+    programs = [
+        ("Main", ["function Main.used 0", "push constant 1", "return",
+                  "function Main.unused 0", "call Main.used 0", "return"]),
+        ("Sys", ["function Sys.init 0", "call Main.used 0", "return"])]
+    self.assertEqual(
+        {"Main": set(["Main.unused"])}, hack_vm.FindDeadFunctions(programs))
+    self.assertEqual({}, hack_vm.FindDeadFunctions(programs[:1]))
+
+    options = hack_vm.TranslationOptions(eliminate_dead_functions=True)
+    statistics = collections.Counter()
+    program_asm = hack_vm.LinkPrograms(
+        programs, options=options, statistics=statistics)
+    self.assertTrue("(Main.used)" in program_asm)
+    self.assertFalse("(Main.unused)" in program_asm)
+    self.assertEqual(
+        hack_vm.CountRomWords(hack_vm.LinkPrograms(programs)),
+        hack_vm.CountRomWords(program_asm) +
+        statistics["dead-function.Main.unused"])
+
+  def testInlineLeafFunctions(self):
+    programs = [
+        ("Main", ["function Main.getX 0", "push argument 0", "pop pointer 0",
+                  "push this 0", "return",
+                  "function Main.wrap 0", "call Main.getX 1", "return",
+                  "function Main.drop 0", "push constant 1", "push constant 2",
+                  "return"]),
+        ("Sys", ["function Sys.init 0", "push constant 3000",
+                 "call Main.getX 1", "return"])]
+    inline_functions = hack_vm.HackFunctionInliner.FindInlineFunctions(
+        programs, 10)
+    self.assertEqual(["Main.getX"], list(inline_functions))
+    self.assertEqual(1, inline_functions["Main.getX"].arguments)
+    self.assertEqual([0], inline_functions["Main.getX"].saved_pointers)
+    self.assertEqual(
+        {}, hack_vm.HackFunctionInliner.FindInlineFunctions(programs, 3))
+
+    options = hack_vm.TranslationOptions(inline_budget=10)
+    statistics = collections.Counter()
+    program_asm = hack_vm.LinkPrograms(
+        programs, options=options, statistics=statistics)
+    self.assertEqual(2, statistics["inline.Main.getX"])
+    self.assertFalse("@Main.getX" in program_asm)
+    self.assertTrue("@$$INLINE.1" in program_asm)
+
+  def testInlineFunctionWithEndLabel(self):
+    # The label "end" of the body must not clash with the label the early
+    # return jumps to.
+    programs = [
+        ("Leaf", ["function Leaf.f 0", "push argument 0", "if-goto end",
+                  "push constant 1", "return", "label end",
+                  "push constant 2", "return"]),
+        ("Sys", ["function Sys.init 0", "push constant 0",
+                 "call Leaf.f 1", "pop static 0", "push constant 5",
+                 "call Leaf.f 1", "pop static 1", "label HALT",
+                 "goto HALT"])]
+    options = hack_vm.TranslationOptions(inline_budget=20)
+    statistics = collections.Counter()
+    program_asm = hack_vm.AttachBootstrapCode(hack_vm.LinkPrograms(
+        programs, options=options, statistics=statistics), options)
+    self.assertEqual(2, statistics["inline.Leaf.f"])
+    emulator, symbols = hack_emulator.RunAsm(program_asm, 10000)
+    self.assertTrue(emulator.halted)
+    self.assertEqual(1, emulator.Peek(symbols["Sys.0"]))
+    self.assertEqual(2, emulator.Peek(symbols["Sys.1"]))
+
+  def testTranslationOptions(self):
+    options = hack_vm.TranslationOptions(trampolines=True)
+    self.assertEqual(["trampolines"], options.ChangedSettings())
+    self.assertEqual([], options.WithDefault("trampolines").ChangedSettings())
+    self.assertNotEqual(
+        options.Fingerprint(), hack_vm.TranslationOptions().Fingerprint())
+    self.assertRaises(TypeError, hack_vm.TranslationOptions, foo=True)
+
+  def testStreamingMatchesLists(self):
+    expected = hack_vm.FlattenAsm(
+        hack_vm.GenerateAsm(
+            hack_vm.DecorateCommands(
+                hack_vm.ParseProgram(_SAMPLE_PROGRAM, "Main"), "Main")))
+    self.assertEqual(
+        expected, hack_vm.AssembleProgram(_SAMPLE_PROGRAM, "Main"))
+    self.assertEqual(
+        expected,
+        list(hack_vm.StreamAssembleProgram(iter(_SAMPLE_PROGRAM), "Main")))
+    self.assertEqual(
+        expected + expected,
+        hack_vm.LinkPrograms(
+            [("Main", _SAMPLE_PROGRAM), ("Main", _SAMPLE_PROGRAM)]))
+
+  def testLinkProgramsInParallel(self):
+    programs = [
+        ("Main%d" % (index,), _SAMPLE_PROGRAM) for index in range(5)]
+    self.assertEqual(
+        hack_vm.LinkPrograms(programs),
+        hack_vm.LinkPrograms(programs, workers=3))
+    self.assertRaises(
+        hack_vm.VMError, hack_vm.LinkPrograms,
+        programs + [("Broken", ["foo"])], 3)
+
+  def testLinkProgramsWithCache(self):
+    cache_directory = tempfile.mkdtemp()
+    try:
+      programs = [("Main", _SAMPLE_PROGRAM), ("Other", _SAMPLE_PROGRAM)]
+      expected = hack_vm.LinkPrograms(programs)
+
+      cache = hack_vm.AssemblyCache(cache_directory)
+      self.assertEqual(expected, hack_vm.LinkPrograms(programs, cache=cache))
+      self.assertEqual((0, 2), (cache.hits, cache.misses))
+      self.assertEqual(expected, hack_vm.LinkPrograms(programs, cache=cache))
+      self.assertEqual((2, 2), (cache.hits, cache.misses))
+
+      programs[1] = ("Other", _SAMPLE_PROGRAM + ["push constant 1"])
+      self.assertEqual(
+          hack_vm.LinkPrograms(programs),
+          hack_vm.LinkPrograms(programs, workers=2, cache=cache))
+      self.assertEqual((3, 3), (cache.hits, cache.misses))
+
+      cache.max_bytes = 0
+      cache.Trim()
+      self.assertEqual(3, cache.evictions)
+      self.assertEqual([], os.listdir(cache_directory))
+    finally:
+      shutil.rmtree(cache_directory)
+
+  def testLinkProgramsWithCacheAndInlining(self):
+    cache_directory = tempfile.mkdtemp()
+    try:
+      programs = [
+          ("Leaf", ["function Leaf.f 1", "push argument 0", "pop local 0",
+                    "push local 0", "return"]),
+          ("Sys", ["function Sys.init 0", "push constant 7", "call Leaf.f 1",
+                   "pop static 0", "label HALT", "goto HALT"])]
+      options = hack_vm.TranslationOptions(inline_budget=10)
+      cache = hack_vm.AssemblyCache(cache_directory)
+      hack_vm.LinkPrograms(programs, options=options, cache=cache)
+
+      # The code inlined into Sys depends on the local variables of Leaf.f.
+      programs[0] = ("Leaf", ["function Leaf.f 2"] + programs[0][1][1:])
+      self.assertEqual(
+          hack_vm.LinkPrograms(programs, options=options),
+          hack_vm.LinkPrograms(programs, options=options, cache=cache))
+      self.assertEqual((0, 4), (cache.hits, cache.misses))
+    finally:
+      shutil.rmtree(cache_directory)
+
+  def testProfile(self):
+    programs = [("Main", _SAMPLE_PROGRAM), ("Sys", ["function Sys.init 0",
+                                                     "call Main.sum 0",
+                                                     "return"])]
+    options = hack_vm.TranslationOptions(peephole=True, inline_budget=30)
+    for workers in [1, 2]:
+      profile = hack_vm.TranslationProfile()
+      self.assertEqual(
+          hack_vm.LinkPrograms(programs, options=options),
+          hack_vm.LinkPrograms(
+              programs, workers, options=options, profile=profile))
+      report = profile.ToJson()
+      self.assertEqual(
+          ["plan", "read", "parse", "decorate", "inline", "generate",
+           "flatten", "peephole"], list(report["phases"]))
+      self.assertEqual(
+          len(_SAMPLE_PROGRAM), report["programs"]["Main"]["lines"])
+      self.assertEqual(3, report["programs"]["Sys"]["commands"])
+      self.assertEqual(
+          len(_SAMPLE_PROGRAM) + 3, report["phases"]["parse"]["items"])
+      self.assertTrue(report["peak_rss"] > 0)
+      self.assertAlmostEqual(
+          report["seconds"],
+          sum(record["seconds"] for record in profile.records.values()))
+      self.assertTrue("peephole" in profile.Summary())
+
+  def testSourceMap(self):
+    programs = [
+        ("Main", ["function Main.double 0", "push argument 0",
+                  "push argument 0", "add", "return"]),
+        ("Sys", ["// Calls Main.double.", "function Sys.init 0",
+                 "push constant 7", "call Main.double 1", "return"])]
+    source_map = hack_vm.SourceMap()
+    program_asm = hack_vm.AttachBootstrapCode([])
+    program_asm += hack_vm.LinkPrograms(programs, source_map=source_map)
+    words, symbols = hack_assembler.HackAssembler.Assemble(program_asm)
+    bootstrap_words = hack_vm.CountRomWords(hack_vm.AttachBootstrapCode([]))
+    self.assertEqual(len(words) - bootstrap_words, source_map.rom_words)
+    self.assertEqual(("Main", 2, "Main.double"), source_map.Lookup(0))
+    self.assertEqual(("Sys", 3, "Sys.init"), source_map.Lookup(
+        symbols["Sys.init"] - bootstrap_words))
+    self.assertEqual(None, source_map.Lookup(source_map.rom_words))
+
+    options = hack_vm.TranslationOptions(peephole=True, inline_budget=10)
+    for workers in [1, 2]:
+      source_map = hack_vm.SourceMap()
+      program_asm = hack_vm.AttachBootstrapCode(
+          hack_vm.LinkPrograms(
+              programs, workers, options=options, source_map=source_map),
+          options)
+      self.assertEqual(
+          program_asm, hack_vm.AttachBootstrapCode(
+              hack_vm.LinkPrograms(programs, options=options), options))
+      map_file = StringIO.StringIO()
+      source_map.Write(map_file)
+      map_file.seek(0)
+      source_map = hack_vm.SourceMap.Read(map_file)
+      origins = set(source_map.Lookup(address)
+                    for address in range(source_map.rom_words))
+      # The inlined call is attributed to the line of the call.
+      self.assertEqual(
+          set([("Main", 2, "Main.double"), ("Main", 3, "Main.double"),
+               ("Main", 4, "Main.double"), ("Main", 5, "Main.double"),
+               ("Sys", 3, "Sys.init"), ("Sys", 4, "Sys.init"),
+               ("Sys", 5, "Sys.init")]),
+          origins)
+
+  def testFindPrograms(self):
+    project_directory = tempfile.mkdtemp()
+    try:
+      os.makedirs(os.path.join(project_directory, "lib", "os"))
+      for file_name in ["Main.vm", "notes.txt", os.path.join("lib", "A.vm"),
+                        os.path.join("lib", "os", "Sys.vm")]:
+        with open(os.path.join(project_directory, file_name), "w") as f:
+          f.write(os.linesep.join(_SAMPLE_PROGRAM))
+      self.assertEqual(
+          ["Main"],
+          [program_name for program_name, _ in hack_vm.FindPrograms(
+              project_directory)])
+      programs = hack_vm.FindPrograms(project_directory, recursive=True)
+      self.assertEqual(
+          ["Main", "A", "Sys"],
+          [program_name for program_name, _ in programs])
+      # The files are read whenever they are iterated.
+      program_lines = programs[0][1]
+      self.assertEqual(len(_SAMPLE_PROGRAM), len(program_lines))
+      self.assertEqual(
+          _SAMPLE_PROGRAM, [line.rstrip("\r\n") for line in program_lines])
+      self.assertEqual(
+          _SAMPLE_PROGRAM, [line.rstrip("\r\n") for line in program_lines])
+      self.assertEqual(
+          hack_vm.LinkPrograms(
+              [(name, _SAMPLE_PROGRAM) for name in ["Main", "A", "Sys"]]),
+          hack_vm.LinkPrograms(programs, workers=2))
+      self.assertEqual(
+          ["Main"],
+          [program_name for program_name, _ in hack_vm.FindPrograms(
+              os.path.join(project_directory, "Main.vm"))])
+
+      with open(os.path.join(project_directory, "lib", "Main.vm"), "w"):
+        pass
+      self.assertEqual(1, len(hack_vm.FindPrograms(project_directory)))
+      self.assertRaises(
+          hack_vm.VMError, hack_vm.FindPrograms, project_directory, True)
+    finally:
+      shutil.rmtree(project_directory)
+
+  def testReadAhead(self):
+    programs = [("P%d" % (index,), iter(["push constant %d" % (index,)]))
+                for index in range(10)]
+    self.assertEqual(
+        [("P%d" % (index,), ["push constant %d" % (index,)])
+         for index in range(10)],
+        list(hack_vm.ReadAhead(programs, 3)))
+
+    def FailingLines():
+      yield "add"
+      raise IOError("unreadable")
+
+    stream = hack_vm.ReadAhead([("A", ["add"]), ("B", FailingLines())])
+    self.assertEqual(("A", ["add"]), next(stream))
+    self.assertRaises(IOError, next, stream)
+
+    def FailingPrograms():
+      yield ("A", ["add"])
+      raise ValueError("broken")
+
+    stream = hack_vm.ReadAhead(FailingPrograms())
+    self.assertEqual(("A", ["add"]), next(stream))
+    self.assertRaises(ValueError, next, stream)
+
+    # The reader stops when the translation stops early.
+    stream = hack_vm.ReadAhead(
+        (("P%d" % (index,), ["add"]) for index in range(100)), 1)
+    next(stream)
+    stream.close()
+
+  def testStreamParseProgramReportsAllErrors(self):
+    stream = hack_vm.StreamParseProgram(["push foo 1", "add", "bar"], "foo")
+    try:
+      list(stream)
+      self.fail("VMError expected")
+    except hack_vm.VMError as error:
+      self.assertTrue("foo.1: push foo 1" in error.message)
+      self.assertTrue("foo.3: bar" in error.message)
+
+  def testWriteAsm(self):
+    program_asm = hack_vm.AttachBootstrapCode(
+        hack_vm.LinkPrograms([("Main", _SAMPLE_PROGRAM)]))
+    for buffer_lines in [1, 7, len(program_asm), 2 * len(program_asm)]:
+      asm_file = StringIO.StringIO()
+      hack_vm.WriteAsm(iter(program_asm), asm_file, buffer_lines)
+      self.assertEqual(os.linesep.join(program_asm), asm_file.getvalue())
+
+  def testWriteHackFile(self):
+    program_asm = hack_vm.AttachBootstrapCode(
+        hack_vm.LinkPrograms([("Main", _SAMPLE_PROGRAM)]))
+    words, _ = hack_assembler.HackAssembler.Assemble(program_asm)
+    output_directory = tempfile.mkdtemp()
+    try:
+      hack_name = os.path.join(output_directory, "out.hack")
+      image_name = os.path.join(output_directory, "out.bin")
+      hack_vm.WriteHackFile(iter(program_asm), hack_name, image_name)
+      with open(hack_name, "r") as hack_file:
+        self.assertEqual([int(line, 2) for line in hack_file], words)
+      self.assertEqual(2 * len(words), os.path.getsize(image_name))
+      self.assertEqual(
+          ["out.bin", "out.hack"], sorted(os.listdir(output_directory)))
+    finally:
+      shutil.rmtree(output_directory)
+
 
 if __name__ == "__main__":
   unittest.main()